@@ -43,18 +43,22 @@ function applyStatModifiers(stat) {
 }
 
 function setProficiencyBonus() {
-    var score = document.getElementById('level').value;
+    var level = document.getElementById('level');
+    if (!level) {
+        return;
+    }
+    var score = level.value;
     var bonus = Math.ceil(1 + (0.25 * score));
     document.getElementById('proficiency_bonus').innerHTML = bonus;
 }
 
 function setSpellSaveDC() {
-    var score = 8 + proficiency() + bonus('wis');
+    var score = 8 + proficiency() + bonus('wisdom');
     document.getElementById('spell_save_dc').innerHTML = score;
 }
 
 (function () {
-    const stats = ['str', 'dex', 'con', 'int', 'wis', 'cha'];
+    const stats = ['strength', 'dexterity', 'constitution', 'intelligence', 'wisdom', 'charisma'];
     stats.forEach(applyStatModifiers);
     stats.forEach(setStatBonus);
     setProficiencyBonus();
@@ -1,14 +1,19 @@
+"""
+The ttfrog command. Everything but typer is imported by the commands that use it, so that starting the
+command, and commands like --help and db list, don't pay for the web application and its dependencies;
+see test/test_cli.py for the modules each command may import.
+"""
+
 import io
 import logging
 import os
+import sys
+import time
 from pathlib import Path
 from textwrap import dedent
 from typing import Optional
 
 import typer
-from dotenv import load_dotenv
-from rich import print
-from rich.logging import RichHandler
 
 from ttfrog.path import assets
 
@@ -34,6 +39,22 @@ DATA_PATH={default_data_path}
 
 HOST={default_host}
 PORT={default_port}
+
+# Uncomment these to serve with multiple workers and threads by default:
+#
+# PRODUCTION=1
+# WORKERS=4
+# THREADS=8
+
+# Database connection pool and SQLite tuning. The defaults suit a production SQLite database;
+# set a SQLITE_ pragma to an empty value to use SQLite's own default instead.
+#
+# DATABASE_POOL_SIZE=5
+# DATABASE_MAX_OVERFLOW=10
+# SQLITE_JOURNAL_MODE=WAL
+# SQLITE_SYNCHRONOUS=NORMAL
+# SQLITE_BUSY_TIMEOUT=5000
+# SQLITE_MMAP_SIZE=268435456
 """
 
 db_app = typer.Typer()
@@ -51,6 +72,9 @@ def main(
         help="Path to the TableTop Frog environment",
     ),
 ):
+    from dotenv import load_dotenv
+    from rich.logging import RichHandler
+
     app_state["env"] = root.expanduser() / Path("defaults")
     load_dotenv(stream=io.StringIO(SETUP_HELP))
     load_dotenv(app_state["env"])
@@ -74,18 +98,42 @@ def serve(
         help="bind port",
     ),
     debug: bool = typer.Option(False, help="Enable debugging output"),
+    production: bool = typer.Option(
+        False, envvar="PRODUCTION", help="Serve with waitress instead of the single-threaded development server"
+    ),
+    workers: int = typer.Option(1, envvar="WORKERS", help="Number of worker processes in production mode"),
+    threads: int = typer.Option(4, envvar="THREADS", help="Number of request threads per worker in production mode"),
+    backlog: int = typer.Option(1024, envvar="BACKLOG", help="Maximum number of connections waiting to be accepted"),
+    connection_limit: int = typer.Option(
+        100, envvar="CONNECTION_LIMIT", help="Maximum number of open connections per worker"
+    ),
+    channel_timeout: int = typer.Option(
+        120, envvar="CHANNEL_TIMEOUT", help="Seconds to keep idle keep-alive connections open"
+    ),
 ):
     """
     Start the TableTop Frog server.
     """
 
     # delay loading the app until we have configured our environment
+    from rich import print
+
     from ttfrog.db.bootstrap import bootstrap
     from ttfrog.webserver import application
 
     print("Starting TableTop Frog server...")
     bootstrap()
-    application.start(host=host, port=port, debug=debug)
+    application.start(
+        host=host,
+        port=port,
+        debug=debug,
+        production=production,
+        workers=workers,
+        threads=threads,
+        backlog=backlog,
+        connection_limit=connection_limit,
+        channel_timeout=channel_timeout,
+    )
 
 
 @db_app.command()
@@ -93,6 +141,8 @@ def setup(context: typer.Context):
     """
     (Re)Initialize TableTop Frog. Idempotent; will preserve any existing configuration.
     """
+    from rich import print
+
     from ttfrog.db.bootstrap import bootstrap
 
     if not os.path.exists(app_state["env"]):
@@ -104,20 +154,91 @@ def setup(context: typer.Context):
 
 @db_app.command()
 def list(context: typer.Context):
-    from ttfrog.db.manager import db
+    from rich import print
+
+    from ttfrog.db.registry import tables
+
+    print("\n".join(sorted(tables.names())))
 
-    print("\n".join(sorted(db.tables.keys())))
+
+def _dump_format(path: Optional[Path], format: Optional[str]) -> str:
+    if format:
+        return format
+    if path and ".ndjson" in path.suffixes:
+        return "ndjson"
+    return "json"
+
+
+def _open_dump(path: Optional[Path], mode: str, compress: Optional[bool] = None):
+    """
+    Open a dump file for reading ("r") or writing ("w") as text, compressing it if the name ends in .gz.
+    A missing path or "-" means stdin or stdout.
+    """
+    import gzip
+
+    if compress is None:
+        compress = bool(path and path.suffix == ".gz")
+    if not path or str(path) == "-":
+        fh = sys.stdin.buffer if mode == "r" else sys.stdout.buffer
+        if compress:
+            fh = gzip.GzipFile(fileobj=fh, mode=mode)
+        return io.TextIOWrapper(fh, encoding="utf-8")
+    if compress:
+        return gzip.open(path, f"{mode}t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
 
 
 @db_app.command(context_settings={"allow_extra_args": True, "ignore_unknown_options": True})
-def dump(context: typer.Context):
+def dump(
+    context: typer.Context,
+    output: Optional[Path] = typer.Option(None, "--output", "-o", help="write to a file instead of stdout"),
+    format: Optional[str] = typer.Option(None, help="json or ndjson; by default, guessed from the file name"),
+    compress: Optional[bool] = typer.Option(None, help="gzip the output; the default for file names ending in .gz"),
+):
+    """
+    Dump tables (or the entire database) as JSON, streaming it to stdout or a file.
+    """
+    from ttfrog.db.manager import db
+
+    db.init()
+    with _open_dump(output, "w", compress) as stream:
+        db.dump_to(stream, context.args, format=_dump_format(output, format))
+
+
+@db_app.command()
+def load(
+    context: typer.Context,
+    source: Path = typer.Argument(..., help="a file written by dump, or - to read stdin"),
+    format: Optional[str] = typer.Option(None, help="json or ndjson; by default, guessed from the file name"),
+    compress: Optional[bool] = typer.Option(None, help="gunzip the input; the default for file names ending in .gz"),
+):
+    """
+    Load a dump into an empty database, inserting its records in batches.
+    """
+    from ttfrog.db.manager import db
+
+    db.init()
+    with _open_dump(source, "r", compress) as stream:
+        counts = db.load_from(stream, format=_dump_format(source, format))
+    for table_name, count in counts.items():
+        logging.info(f"Loaded {count} records into {table_name}")
+
+
+@db_app.command()
+def compact(
+    context: typer.Context,
+    days: int = typer.Option(30, help="keep every logged change to characters made in this many days"),
+):
     """
-    Dump tables (or the entire database) as a JSON blob.
+    Delete logged changes to characters older than some days, keeping the snapshots made of them.
     """
+    from ttfrog.db import transaction_log
     from ttfrog.db.manager import db
 
-    setup(context)
-    print(db.dump(context.args))
+    db.init()
+    with db.transaction():
+        count = transaction_log.compact(time.time() - days * 86400)
+    logging.info(f"Deleted {count} logged changes")
 
 
 if __name__ == "__main__":
@@ -4,19 +4,93 @@ import nanoid
 from nanoid_dictionary import human_alphabet
 from pyramid_sqlalchemy import BaseObject as _BaseObject
 from slugify import slugify
-from sqlalchemy import Column, String
+from sqlalchemy import Column, Enum, String, event, inspect, select
 
 
 def genslug():
     return nanoid.generate(human_alphabet[2:], 5)
 
 
+def slug_uri(slug, name):
+    return "-".join([slug, slugify(name.title().replace(" ", ""), ok="", only_ascii=True, lower=False)])
+
+
 class SlugMixin:
     slug = Column(String, index=True, unique=True, default=genslug)
 
     @property
     def uri(self):
-        return "-".join([self.slug, slugify(self.name.title().replace(" ", ""), ok="", only_ascii=True, lower=False)])
+        return slug_uri(self.slug, self.name)
+
+
+class JsonSerializer:
+    """
+    Converts instances of one model to JSON-compatible dicts. The columns to emit, and how to convert
+    their values, are worked out once from the model's mapper. Only attributes that are already loaded
+    are read, so serializing a record never issues a query; relationships are followed to the given
+    depth, if they have been loaded.
+    """
+
+    def __init__(self, model):
+        mapper = inspect(model)
+        self.model = model
+        self.columns = [(attr.key, self._converter(attr.columns[0].type)) for attr in mapper.column_attrs]
+        self.relationships = [(rel.key, rel.uselist) for rel in mapper.relationships]
+
+    @staticmethod
+    def _converter(column_type):
+        if isinstance(column_type, Enum) and column_type.enum_class:
+            return lambda value: value.value
+        return None
+
+    def select(self):
+        """
+        Return a statement selecting every column of the model, to serialize rows without loading instances.
+        """
+        return select(*[getattr(self.model, key) for key, _ in self.columns])
+
+    def row(self, row):
+        """
+        Return a row selected by select() as a dict.
+        """
+        return dict(
+            (key, convert(value) if convert and value is not None else value)
+            for (key, convert), value in zip(self.columns, row)
+        )
+
+    def __call__(self, obj, depth=0):
+        loaded = obj.__dict__
+        result = {}
+        for key, convert in self.columns:
+            if key in loaded:
+                value = loaded[key]
+                result[key] = convert(value) if convert and value is not None else value
+        if depth > 0:
+            for key, uselist in self.relationships:
+                if key not in loaded:
+                    continue
+                value = loaded[key]
+                if value is None:
+                    result[key] = None
+                elif uselist:
+                    result[key] = [rel.__json__(depth=depth - 1) for rel in value]
+                else:
+                    result[key] = value.__json__(depth=depth - 1)
+        return result
+
+
+_serializers = {}
+
+
+def serializer(model):
+    """
+    Return the JsonSerializer for a model, creating it on first use.
+    """
+    try:
+        return _serializers[model]
+    except KeyError:
+        _serializers[model] = JsonSerializer(model)
+        return _serializers[model]
 
 
 class BaseObject(_BaseObject):
@@ -44,11 +118,11 @@ class BaseObject(_BaseObject):
                     relvals.append(rel)
             yield relname, relvals
 
-    def __json__(self):
+    def __json__(self, request=None, depth=0):
         """
-        Provide a custom JSON encoder.
+        Return the record's loaded columns, and its loaded relationships to the given depth, as a dict.
         """
-        raise NotImplementedError()
+        return serializer(type(self))(self, depth=depth)
 
     def __repr__(self):
         return str(dict(self))
@@ -84,12 +158,59 @@ def multivalue_string_factory(name, column=Column(String), separator=";"):
     )
 
 
+class generation_cached:
+    """
+    A property of a model computed once per instance and reused until a generation changes, for values
+    derived from related records. generation is a function returning a counter that event handlers
+    increment whenever anything the value is derived from changes:
+
+        class CharacterClass(BaseObject):
+            attribute_generation = 0
+
+            @generation_cached(lambda: CharacterClass.attribute_generation)
+            def attribute_index(self):
+                return ClassAttributeIndex(self.attributes)
+
+    The value is also discarded when the instance is expired or refreshed, since its relationships are
+    then loaded again.
+    """
+
+    def __init__(self, generation):
+        self.generation = generation
+
+    def __call__(self, func):
+        self.func = func
+        self.__doc__ = func.__doc__
+        return self
+
+    def __set_name__(self, owner, name):
+        self.key = f"_{name}"
+        event.listen(owner, "expire", self.discard)
+        event.listen(owner, "refresh", self.discard)
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+        generation = self.generation()
+        cached = obj.__dict__.get(self.key)
+        if cached and cached[0] == generation:
+            return cached[1]
+        value = self.func(obj)
+        obj.__dict__[self.key] = (generation, value)
+        return value
+
+    def discard(self, target, *args):
+        # objects that have been garbage collected are expired without a target
+        if target is not None:
+            target.__dict__.pop(self.key, None)
+
+
 class EnumField(enum.Enum):
     """
     A serializable enum.
     """
 
-    def __json__(self):
+    def __json__(self, request=None):
         return self.value
 
 
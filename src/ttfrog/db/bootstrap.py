@@ -1,36 +1,71 @@
+"""
+Create or migrate the database, and seed it with the content every installation starts with.
+
+Seeding is idempotent: records with a name are inserted only if there is no record of the same model
+by that name, and records without a name, like the maps between ancestries and traits, are inserted only
+along with a record they refer to. The example characters are only added to a database without any
+characters, so that deleting them is not undone. Existing records are never changed, so seeding an
+installation that has been used keeps everything its users have done, and takes a query per seeded
+model however much the database holds.
+"""
+
+from sqlalchemy import select
+
 from ttfrog.db import schema
+from ttfrog.db.bulk import BulkImport, missing
 from ttfrog.db.manager import db
 
-
-def bootstrap():
-    db.metadata.drop_all(bind=db.engine)
-    db.init()
-    with db.transaction():
-        # ancestries
-        human = schema.Ancestry(name="human")
-        tiefling = schema.Ancestry(name="tiefling")
-        tiefling.add_modifier(schema.Modifier(name="Ability Score Increase", target="intelligence", relative_value=1))
-        tiefling.add_modifier(schema.Modifier(name="Ability Score Increase", target="charisma", relative_value=2))
-        darkvision = schema.AncestryTrait(
-            name="Darkvision",
-            description=(
+SEED = {
+    "Ancestry": [
+        {"name": "human"},
+        {
+            "name": "tiefling",
+            "modifiers": [
+                {"name": "Ability Score Increase", "target": "intelligence", "relative_value": 1},
+                {"name": "Ability Score Increase", "target": "charisma", "relative_value": 2},
+            ],
+        },
+    ],
+    "AncestryTrait": [
+        {
+            "name": "Darkvision",
+            "description": (
                 "You can see in dim light within 60 feet of you as if it were bright light, and in darkness as if it "
                 "were dim light. You can’t discern color in darkness, only shades of gray."
             ),
-        )
-        darkvision.add_modifier(schema.Modifier(name="Darkvision", target="vision_in_darkness", absolute_value=120))
-        tiefling.add_trait(darkvision)
+            "modifiers": [{"name": "Darkvision", "target": "vision_in_darkness", "absolute_value": 120}],
+        },
+    ],
+    "AncestryTraitMap": [{"ancestry_id": "tiefling", "ancestry_trait_id": "Darkvision", "level": 1}],
+    "CharacterClass": [
+        {"name": "fighter", "hit_dice": "1d10", "hit_dice_stat": "CON"},
+        {"name": "rogue", "hit_dice": "1d8", "hit_dice_stat": "DEX"},
+    ],
+}
+
+EXAMPLES = {
+    "Character": [
+        {"name": "Sabetha", "ancestry": "tiefling"},
+        {"name": "Bob", "ancestry": "human"},
+    ],
+    "CharacterClassMap": [
+        {"character_id": "Sabetha", "character_class_id": "fighter", "level": 2},
+        {"character_id": "Sabetha", "character_class_id": "rogue", "level": 3},
+    ],
+}
 
-        # classes
-        fighter = schema.CharacterClass(name="fighter", hit_dice="1d10", hit_dice_stat="CON")
-        rogue = schema.CharacterClass(name="rogue", hit_dice="1d8", hit_dice_stat="DEX")
 
-        # characters
-        sabetha = schema.Character(name="Sabetha", ancestry=tiefling)
-        sabetha.add_class(fighter, level=2)
-        sabetha.add_class(rogue, level=3)
+def seed(data=SEED, examples=EXAMPLES):
+    """
+    Insert the records of the seed data that are missing, and the examples if there are no characters,
+    returning the number inserted per model.
+    """
+    with db.transaction():
+        if examples and db.session.execute(select(schema.Character.id).limit(1)).first() is None:
+            data = {**data, **examples}
+        return BulkImport().run(missing(data))
 
-        bob = schema.Character(name="Bob", ancestry=human)
 
-        # persist all the records we've created
-        db.add_or_update([sabetha, bob])
+def bootstrap():
+    db.init()
+    return seed()
@@ -0,0 +1,241 @@
+"""
+Bulk import of records, such as test fixtures and rules content, with batches of multi-row INSERT
+statements instead of building and flushing ORM objects one at a time.
+
+Records are given per model name, in the form of keyword arguments to the model's constructor:
+
+    >>> with db.transaction():
+    ...     bulk_import({
+    ...         "Ancestry": [
+    ...             {"name": "tiefling", "modifiers": [{"name": "Infernal", "target": "charisma", "relative_value": 2}]},
+    ...         ],
+    ...         "AncestryTrait": [{"name": "Darkvision"}],
+    ...         "AncestryTraitMap": [{"ancestry_id": "tiefling", "ancestry_trait_id": "Darkvision"}],
+    ...         "Character": [{"name": "Sabetha", "ancestry": "tiefling"}],
+    ...     })
+    {'Ancestry': 1, 'AncestryTrait': 1, 'AncestryTraitMap': 1, 'Character': 1, 'Modifier': 1, 'ModifierMap': 1}
+
+    - Records without an id are given one up front, so that records can refer to each other.
+    - Foreign keys may be given by the name of the record they refer to, as the value of either the foreign
+      key column or a many-to-one relationship. Names are resolved against the imported records as well as
+      those already in the database, and must be unambiguous.
+    - Records of models with modifiers may list them under "modifiers". Each distinct modifier is inserted
+      once, and an identical Modifier already in the database is reused.
+    - Values for properties with setters, like CharacterClass.saving_throws, are converted to the columns
+      the setter would have set.
+
+Models are inserted in dependency order, regardless of the order they are given in. The import runs on
+db.session, so it should be called inside db.transaction(); no ORM events are emitted for the records.
+To import only the records that aren't in the database yet, as seeding does, pass them through missing().
+"""
+
+from collections import defaultdict
+from functools import cache
+from types import SimpleNamespace
+
+from sqlalchemy import func, insert, inspect, select
+
+from ttfrog.db import schema
+from ttfrog.db.manager import db
+from ttfrog.db.registry import tables
+from ttfrog.db.schema.modifiers import ModifierMap, ModifierMixin, modifier_table, modifiers_changed
+
+# the number of records inserted by each statement
+BATCH_SIZE = 500
+
+# the columns that identify a Modifier; modifiers with the same values are deduplicated
+MODIFIER_COLUMNS = ["name", "target", "absolute_value", "relative_value", "multiply_value", "new_value", "description"]
+
+
+@cache
+def _fields(model):
+    """
+    Map every key a record of the model may have to (column key, referenced model, property setter).
+    """
+    mapper = inspect(model)
+    fields = {}
+    for name in dir(model):
+        attr = getattr(model, name, None)
+        if isinstance(attr, property) and attr.fset:
+            fields[name] = (None, None, attr.fset)
+    for relationship in mapper.relationships:
+        if not relationship.uselist and len(relationship.local_columns) == 1:
+            column = mapper.get_property_by_column(next(iter(relationship.local_columns))).key
+            fields[relationship.key] = (column, relationship.mapper.class_, None)
+    for attr in mapper.column_attrs:
+        foreign_keys = attr.columns[0].foreign_keys
+        target = db.models[next(iter(foreign_keys)).column.table.name] if foreign_keys else None
+        fields[attr.key] = (attr.key, target, None)
+    return fields
+
+
+class BulkImport:
+    """
+    The state of one import: the ids assigned to each model, the names they can be referred to by, and
+    the modifiers seen so far.
+    """
+
+    def __init__(self, batch_size=BATCH_SIZE):
+        self.batch_size = batch_size
+        self.counts = defaultdict(int)
+        self._names = {}
+        self._modifier_maps = []
+        self._modifiers = None
+        self._new_modifiers = []
+        self._next_modifier_id = None
+
+    def names(self, model):
+        """
+        Return a dict of the ids of a model's records, keyed on name, loading the existing ones on first use.
+        """
+        if model not in self._names:
+            names = defaultdict(list)
+            if "name" in inspect(model).column_attrs:
+                for row in db.session.execute(select(model.id, model.name)):
+                    names[row.name].append(row.id)
+            self._names[model] = names
+        return self._names[model]
+
+    def lookup(self, model, name):
+        ids = self.names(model).get(name)
+        if not ids:
+            raise ValueError(f"There is no {model.__name__} named {name!r}")
+        if len(ids) > 1:
+            raise ValueError(f"The name {name!r} is ambiguous; {len(ids)} {model.__name__} records have it")
+        return ids[0]
+
+    def columns(self, model, record):
+        """
+        Return a record as a dict of column values, resolving references by name and applying property
+        setters, along with any modifiers it lists.
+        """
+        fields = _fields(model)
+        values = {}
+        modifiers = []
+        for key, value in record.items():
+            if key == "modifiers" and issubclass(model, ModifierMixin):
+                modifiers = value
+                continue
+            try:
+                column, target, setter = fields[key]
+            except KeyError:
+                raise ValueError(
+                    f"Cannot import {key!r}; {model.__name__} has no column, relationship or property by that name"
+                )
+            if setter:
+                # collect the attributes the setter assigns, rather than running it on an instance
+                assigned = SimpleNamespace()
+                setter(assigned, value)
+                values.update(vars(assigned))
+                continue
+            if target and isinstance(value, str):
+                value = self.lookup(target, value)
+            values[column] = value
+        return values, modifiers
+
+    def assign_ids(self, model, records):
+        """
+        Give every record without an id the next one after the largest in the table or the import.
+        """
+        if "id" not in inspect(model).column_attrs:
+            return
+        given = [rec["id"] for rec in records if rec.get("id") is not None]
+        next_id = max([db.session.execute(select(func.max(model.id))).scalar() or 0] + given) + 1
+        for rec in records:
+            if rec.get("id") is None:
+                rec["id"] = next_id
+                next_id += 1
+
+    def insert(self, model, records):
+        if not records:
+            return
+        for i in range(0, len(records), self.batch_size):
+            db.session.execute(insert(model), records[i : i + self.batch_size])
+        self.counts[model.__name__] += len(records)
+
+    def import_model(self, model, records):
+        converted = [self.columns(model, rec) for rec in records]
+        records = [values for values, _ in converted]
+        self.assign_ids(model, records)
+        if records and "name" in inspect(model).column_attrs:
+            names = self.names(model)
+            for rec in records:
+                if rec.get("name") is not None:
+                    names[rec["name"]].append(rec["id"])
+        for rec, (_, modifiers) in zip(records, converted):
+            for modifier in modifiers:
+                self._modifier_maps.append((modifier_table(model.__tablename__), rec["id"], modifier))
+        self.insert(model, records)
+
+    def modifier_id(self, modifier):
+        """
+        Return the id of the Modifier with the given values, adding it to the import if there isn't one yet.
+        """
+        if self._modifiers is None:
+            columns = [getattr(schema.Modifier, name) for name in MODIFIER_COLUMNS]
+            self._modifiers = dict(
+                (tuple(row[1:]), row[0]) for row in db.session.execute(select(schema.Modifier.id, *columns))
+            )
+            self._next_modifier_id = max(self._modifiers.values(), default=0) + 1
+        key = tuple(modifier.get(name) for name in MODIFIER_COLUMNS)
+        if key not in self._modifiers:
+            self._modifiers[key] = self._next_modifier_id
+            self._new_modifiers.append(dict(modifier, id=self._next_modifier_id))
+            self._next_modifier_id += 1
+        return self._modifiers[key]
+
+    def import_modifiers(self):
+        if not self._modifier_maps:
+            return
+        maps = {}
+        for primary_table, primary_table_id, modifier in self._modifier_maps:
+            modifier_id = self.modifier_id(modifier)
+            maps[(primary_table, primary_table_id, modifier_id)] = dict(
+                primary_table=primary_table, primary_table_id=primary_table_id, modifier_id=modifier_id
+            )
+        self.insert(schema.Modifier, self._new_modifiers)
+        self.insert(ModifierMap, list(maps.values()))
+        modifiers_changed()
+
+    def run(self, data):
+        models = dict((tables[name].model, records) for name, records in data.items())
+        order = list(db.tables)
+        for model in sorted(models, key=lambda model: order.index(model.__tablename__)):
+            self.import_model(model, models[model])
+        self.import_modifiers()
+        return dict(self.counts)
+
+
+def bulk_import(data, batch_size=BATCH_SIZE):
+    """
+    Insert records given as {model name: [record, ...]}, returning the number of records inserted per model.
+    """
+    return BulkImport(batch_size=batch_size).run(data)
+
+
+def missing(data):
+    """
+    Return the records of data, given as for bulk_import(), that are not in the database yet. Records
+    with a name are missing if there is no record of the same model by that name; records without one
+    are only missing if they refer to a missing record by name.
+    """
+    named = {}
+    unnamed = {}
+    for name, records in data.items():
+        model = tables[name].model
+        if "name" in inspect(model).column_attrs:
+            names = [rec["name"] for rec in records]
+            existing = set(db.session.scalars(select(model.name).where(model.name.in_(names))))
+            named[name] = [rec for rec in records if rec["name"] not in existing]
+        else:
+            unnamed[name] = records
+
+    inserted = dict((tables[name].model, set(rec["name"] for rec in records)) for name, records in named.items())
+    for name, records in unnamed.items():
+        fields = _fields(tables[name].model)
+        unnamed[name] = [
+            rec
+            for rec in records
+            if any(value in inserted.get(fields[key][1], ()) for key, value in rec.items() if key in fields)
+        ]
+    return dict((name, records) for name, records in {**named, **unnamed}.items() if records)
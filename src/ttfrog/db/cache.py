@@ -0,0 +1,150 @@
+"""
+Process-wide caches of values derived from whole tables, such as row counts and select field choices.
+
+Every model has a version number that is incremented whenever its rows are inserted, updated or
+deleted through the session, including bulk statements like query.delete(), and again when the
+transaction making the change ends. Cached values are stored along with the version of the model
+they were computed from, and are recomputed on the next read once the version has moved on:
+
+    >>> choices = ModelCache()
+    >>> choices.get(Ancestry, "names", lambda: [rec.name for rec in db.query(Ancestry)])
+    ['human', 'tiefling']
+
+Individual rows have versions too, for values derived from one record and the rows that belong to it:
+
+    >>> row_version(Character, 1)
+    0
+    >>> invalidate_row(Character, 1)
+    >>> row_version(Character, 1)
+    1
+
+Row versions are kept in a fixed number of buckets, so rows that share a bucket are invalidated together.
+
+Changes made by Core statements against tables are not seen. Nor are changes made by other processes,
+unless they were forked from the same parent after share_versions() was called.
+"""
+
+import multiprocessing
+from collections import defaultdict
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+
+from ttfrog.db.base import BaseObject
+
+# the number of buckets row versions are kept in
+ROW_VERSION_BUCKETS = 4096
+
+_versions = defaultdict(int)
+_row_versions = [0] * ROW_VERSION_BUCKETS
+
+
+def version(model) -> int:
+    return _versions[model]
+
+
+def _bucket(model, key):
+    return hash((model.__tablename__, key)) % ROW_VERSION_BUCKETS
+
+
+def row_version(model, *key) -> int:
+    """
+    Return the version of the row of a model with the given primary key.
+    """
+    return _row_versions[_bucket(model, key)]
+
+
+def invalidate(model, session=None):
+    """
+    Increment the version of a model, discarding any values cached for it.
+    """
+    _versions[model] += 1
+    if session is not None:
+        session.info.setdefault("modified_models", set()).add(model)
+
+
+def invalidate_row(model, *key, session=None):
+    """
+    Increment the version of one row of a model, given its primary key.
+    """
+    _row_versions[_bucket(model, key)] += 1
+    if session is not None:
+        session.info.setdefault("modified_rows", set()).add((model, key))
+
+
+class SharedVersions:
+    """
+    Model versions stored in memory that is shared with any processes forked after it is created.
+    """
+
+    def __init__(self, models, initial):
+        models = list(models)
+        self._index = dict((model, i) for i, model in enumerate(models))
+        self._array = multiprocessing.RawArray("q", [initial[model] for model in models])
+
+    def __getitem__(self, model):
+        return self._array[self._index[model]]
+
+    def __setitem__(self, model, value):
+        self._array[self._index[model]] = value
+
+
+def share_versions():
+    """
+    Move the versions of every mapped model into shared memory. Call this before forking worker processes.
+    """
+    global _versions, _row_versions
+    _versions = SharedVersions([mapper.class_ for mapper in BaseObject.registry.mappers], _versions)
+    _row_versions = multiprocessing.RawArray("q", _row_versions)
+
+
+class ModelCache:
+    """
+    A cache of values keyed on a model and an arbitrary hashable key.
+    """
+
+    def __init__(self):
+        self._values = {}
+
+    def get(self, model, key, factory):
+        """
+        Return the cached value for (model, key), calling factory() to compute it if it is missing or stale.
+        """
+        current = version(model)
+        cached = self._values.get((model, key))
+        if cached and cached[0] == current:
+            return cached[1]
+        value = factory()
+        self._values[(model, key)] = (current, value)
+        return value
+
+    def clear(self):
+        self._values.clear()
+
+
+@event.listens_for(BaseObject, "after_insert", propagate=True)
+@event.listens_for(BaseObject, "after_update", propagate=True)
+@event.listens_for(BaseObject, "after_delete", propagate=True)
+def _row_changed(mapper, connection, target):
+    session = object_session(target)
+    invalidate(mapper.class_, session)
+    invalidate_row(mapper.class_, *mapper.primary_key_from_instance(target), session=session)
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _statement_executed(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        mapper = orm_execute_state.bind_mapper
+        if mapper is not None:
+            invalidate(mapper.class_, orm_execute_state.session)
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _transaction_ended(session, transaction):
+    # Values cached by other sessions while this transaction was open were computed without its
+    # changes, and values cached by this session may include changes that were rolled back.
+    if transaction.parent is None:
+        for model in session.info.pop("modified_models", set()):
+            invalidate(model)
+        for model, key in session.info.pop("modified_rows", set()):
+            invalidate_row(model, *key)
@@ -0,0 +1,137 @@
+"""
+Named loading profiles, describing which relationships a query should load eagerly, and how.
+
+Relationships are loaded lazily by default. A consumer that knows what it will touch asks for a
+profile instead, and gets the relationships it needs in a fixed number of queries:
+
+    >>> db.query(Character, profile="sheet").filter_by(slug=slug).one()
+
+Profiles:
+    sheet   - everything needed to render a character sheet
+    list    - only the id, slug and name columns, for navigation and select fields
+    json    - columns plus the relationships of the model, to a depth of one by default
+
+When the STRICT_LOADING environment variable is set, every relationship a profile does not load is
+configured to raise on access, so that accidental lazy loads fail loudly (in tests, for example).
+"""
+
+import os
+
+from sqlalchemy import inspect
+from sqlalchemy.orm import joinedload, load_only, raiseload, selectinload
+
+from ttfrog.db.schema import (
+    Ancestry,
+    AncestryTrait,
+    AncestryTraitMap,
+    Character,
+    CharacterClass,
+    CharacterClassAttributeMap,
+    CharacterClassMap,
+    ClassAttribute,
+    ClassAttributeMap,
+)
+from ttfrog.db.schema.modifiers import ModifierMap
+
+# A profile is a tree of {relationship: (loader, {child relationship: (loader, {...})})}
+MODIFIERS = (selectinload, {ModifierMap.modifier: (joinedload, {})})
+
+CLASS_ATTRIBUTE = (joinedload, {ClassAttribute.options: (selectinload, {})})
+
+SHEET = {
+    Character.ancestry: (
+        joinedload,
+        {
+            Ancestry._traits: (
+                selectinload,
+                {AncestryTraitMap.trait: (joinedload, {AncestryTrait.modifier_map: MODIFIERS})},
+            ),
+            Ancestry.modifier_map: MODIFIERS,
+        },
+    ),
+    Character.modifier_map: MODIFIERS,
+    Character.class_map: (
+        selectinload,
+        {
+            CharacterClassMap.character_class: (
+                joinedload,
+                {
+                    CharacterClass.attributes: (
+                        selectinload,
+                        {ClassAttributeMap.attribute: CLASS_ATTRIBUTE},
+                    ),
+                },
+            ),
+        },
+    ),
+    Character.character_class_attribute_map: (
+        selectinload,
+        {
+            CharacterClassAttributeMap.class_attribute: CLASS_ATTRIBUTE,
+            CharacterClassAttributeMap.option: (joinedload, {}),
+        },
+    ),
+}
+
+LIST_COLUMNS = ["id", "slug", "name"]
+
+
+def strict_loading():
+    return bool(os.environ.get("STRICT_LOADING", False))
+
+
+def _build(tree, parent=None, strict=False):
+    options = []
+    if strict:
+        options.append(parent.raiseload("*") if parent else raiseload("*"))
+    for attr, (loader, children) in tree.items():
+        path = getattr(parent, loader.__name__)(attr) if parent else loader(attr)
+        options.append(path)
+        options.extend(_build(children, parent=path, strict=strict))
+    return options
+
+
+def _sheet(model, strict=False):
+    if model is not Character:
+        return _json(model, strict=strict)
+    return _build(SHEET, strict=strict)
+
+
+def _list(model, strict=False):
+    columns = inspect(model).column_attrs
+    options = [load_only(*[getattr(model, name) for name in LIST_COLUMNS if name in columns])]
+    if strict:
+        options.append(raiseload("*"))
+    return options
+
+
+def _relationships(model, depth):
+    if depth <= 0:
+        return {}
+    return dict(
+        (rel.class_attribute, (selectinload, _relationships(rel.mapper.class_, depth - 1)))
+        for rel in inspect(model).relationships
+    )
+
+
+def _json(model, strict=False, depth=1):
+    return _build(_relationships(model, depth), strict=strict)
+
+
+PROFILES = {
+    "sheet": _sheet,
+    "list": _list,
+    "json": _json,
+}
+
+
+def profile_options(name, model, strict=None, **kwargs):
+    """
+    Return the loader options implementing the named profile for the given model. Any keyword
+    arguments are passed to the profile, such as the depth of the json profile.
+    """
+    try:
+        profile = PROFILES[name]
+    except KeyError:
+        raise KeyError(f"Unknown loading profile {name}. Valid profiles are: {', '.join(PROFILES)}")
+    return profile(model, strict=strict_loading() if strict is None else strict, **kwargs)
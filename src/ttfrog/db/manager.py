@@ -1,5 +1,6 @@
 import base64
 import hashlib
+import io
 import json
 import os
 from contextlib import contextmanager
@@ -8,12 +9,22 @@ from functools import cached_property
 import transaction
 from pyramid_sqlalchemy import Session, init_sqlalchemy
 from pyramid_sqlalchemy import metadata as _metadata
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, insert
+from sqlalchemy.engine import make_url
+from zope.sqlalchemy import mark_changed
 
-import ttfrog.db.schema
+from ttfrog.db import cache, migrations, registry
+from ttfrog.db.base import serializer
+from ttfrog.db.loading import profile_options
 from ttfrog.path import database
 
-assert ttfrog.db.schema
+
+@event.listens_for(Session, "do_orm_execute")
+def _statement_executed(orm_execute_state):
+    # zope.sqlalchemy only commits sessions it knows to have changed, and doesn't notice insert, update
+    # or delete statements executed through them
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        mark_changed(orm_execute_state.session)
 
 
 class AlchemyEncoder(json.JSONEncoder):
@@ -24,18 +35,94 @@ class AlchemyEncoder(json.JSONEncoder):
             return super().default(obj)
 
 
+# Engine and connection settings. Each may be overridden by an environment variable of the same name in
+# upper case (DATABASE_POOL_SIZE, SQLITE_JOURNAL_MODE and so on), or by passing settings to the manager.
+# Setting a pragma to an empty string leaves SQLite's own default in place.
+DEFAULT_SETTINGS = {
+    # connection pool; ignored for in-memory databases, which use a single connection per thread
+    "database_pool_size": 5,
+    "database_max_overflow": 10,
+    "database_pool_timeout": 30,
+    "database_pool_recycle": -1,
+    # the number of compiled SQL statements SQLAlchemy caches per engine
+    "database_query_cache_size": 500,
+    # the number of prepared statements the sqlite3 module caches per connection
+    "sqlite_cached_statements": 256,
+    # pragmas run on every new SQLite connection. In WAL mode readers do not block writers and a writer
+    # does not block readers, so sheets can be read while another request is saving one.
+    "sqlite_journal_mode": "WAL",
+    "sqlite_synchronous": "NORMAL",
+    "sqlite_busy_timeout": 5000,
+    "sqlite_cache_size": -16000,
+    "sqlite_mmap_size": 268435456,
+}
+
+SQLITE_PRAGMAS = ["journal_mode", "synchronous", "busy_timeout", "cache_size", "mmap_size"]
+
+# the number of rows read from, or inserted into, one table at a time when dumping and loading
+DUMP_BATCH_SIZE = 1000
+
+DUMP_FORMATS = ["json", "ndjson"]
+
+
+def set_pragmas(dbapi_connection, pragmas):
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in pragmas:
+            if value is not None:
+                cursor.execute(f"PRAGMA {name} = {value}")
+    finally:
+        cursor.close()
+
+
 class SQLDatabaseManager:
     """
     A context manager for working with sqllite database.
     """
 
+    def __init__(self, **settings):
+        self._settings = settings
+
     @cached_property
     def url(self):
         return os.environ.get("DATABASE_URL", f"sqlite:///{database()}")
 
+    @cached_property
+    def settings(self):
+        """
+        The engine settings, from the defaults, the environment and the manager's own settings, in that order.
+        """
+        settings = {}
+        for name, default in DEFAULT_SETTINGS.items():
+            value = self._settings.get(name, os.environ.get(name.upper(), default))
+            settings[name] = None if value in (None, "") else type(default)(value)
+        return settings
+
+    def engine_options(self, url):
+        """
+        Return the keyword arguments passed to create_engine() for the given URL.
+        """
+        options = dict(query_cache_size=self.settings["database_query_cache_size"])
+        if url.get_backend_name() == "sqlite":
+            options["connect_args"] = dict(cached_statements=self.settings["sqlite_cached_statements"])
+            if url.database in (None, "", ":memory:"):
+                return options
+        options.update(
+            pool_size=self.settings["database_pool_size"],
+            max_overflow=self.settings["database_max_overflow"],
+            pool_timeout=self.settings["database_pool_timeout"],
+            pool_recycle=self.settings["database_pool_recycle"],
+        )
+        return options
+
     @cached_property
     def engine(self):
-        return create_engine(self.url)
+        url = make_url(self.url)
+        engine = create_engine(url, **self.engine_options(url))
+        if url.get_backend_name() == "sqlite":
+            pragmas = [(name, self.settings[f"sqlite_{name}"]) for name in SQLITE_PRAGMAS]
+            event.listen(engine, "connect", lambda conn, record: set_pragmas(conn, pragmas))
+        return engine
 
     @cached_property
     def session(self):
@@ -49,6 +136,10 @@ class SQLDatabaseManager:
     def tables(self):
         return dict((t.name, t) for t in self.metadata.sorted_tables)
 
+    @cached_property
+    def models(self):
+        return dict((info.name, info.model) for info in registry.tables)
+
     @contextmanager
     def transaction(self):
         with transaction.manager as tm:
@@ -66,8 +157,14 @@ class SQLDatabaseManager:
             self.session.add(rec, *args, **kwargs)
         self.session.flush()
 
-    def query(self, *args, **kwargs):
-        return self.session.query(*args, **kwargs)
+    def query(self, *args, profile=None, **kwargs):
+        """
+        Return a query, applying the loader options of the named loading profile to it if given.
+        """
+        query = self.session.query(*args, **kwargs)
+        if profile:
+            query = query.options(*profile_options(profile, args[0]))
+        return query
 
     def slugify(self, rec: dict) -> str:
         """
@@ -78,17 +175,94 @@ class SQLDatabaseManager:
 
     def init(self):
         init_sqlalchemy(self.engine)
-        self.metadata.create_all(self.engine)
+        migrations.migrate(self.engine, self.metadata)
 
     def dump(self, names: list = []):
-        results = {}
-        for table_name, table in self.tables.items():
-            if not names or table_name in names:
-                results[table_name] = [dict(row._mapping) for row in self.query(table).all()]
-        return json.dumps(results, indent=2, cls=AlchemyEncoder)
+        """
+        Return tables (or the entire database) as a JSON string. See dump_to().
+        """
+        output = io.StringIO()
+        self.dump_to(output, names)
+        return output.getvalue()
+
+    def _dump_rows(self, names):
+        """
+        Yield (table name, rows) for each table, reading and serializing the rows in batches.
+        """
+        for table_name in self.tables:
+            if names and table_name not in names:
+                continue
+            serialize = serializer(self.models[table_name])
+            result = self.session.execute(serialize.select(), execution_options=dict(yield_per=DUMP_BATCH_SIZE))
+            yield table_name, (serialize.row(row) for rows in result.partitions() for row in rows)
+
+    def dump_to(self, stream, names: list = [], format: str = "json"):
+        """
+        Write tables (or the entire database) to a text stream, one row at a time. The json format is a
+        single object mapping table names to lists of records; ndjson is one {"table": name, "record": {...}}
+        object per line, and can be loaded again without reading the whole dump into memory.
+        """
+        if format not in DUMP_FORMATS:
+            raise ValueError(f"Unsupported dump format {format}. Valid formats are: {', '.join(DUMP_FORMATS)}")
+        encoder = AlchemyEncoder()
+        if format == "ndjson":
+            for table_name, rows in self._dump_rows(names):
+                for row in rows:
+                    stream.write(encoder.encode({"table": table_name, "record": row}) + "\n")
+            return
+
+        separator = "\n"
+        stream.write("{")
+        for table_name, rows in self._dump_rows(names):
+            stream.write(f"{separator}  {json.dumps(table_name)}: [")
+            row_separator = "\n    "
+            for row in rows:
+                stream.write(row_separator + encoder.encode(row))
+                row_separator = ",\n    "
+            stream.write("\n  ]" if row_separator != "\n    " else "]")
+            separator = ",\n"
+        stream.write("\n}\n")
+
+    def load_from(self, stream, format: str = "json"):
+        """
+        Insert the records of a dump written by dump_to() in batches, in a single transaction. The json
+        format is parsed in full before inserting anything; ndjson is read and inserted a batch at a time.
+        """
+        if format not in DUMP_FORMATS:
+            raise ValueError(f"Unsupported dump format {format}. Valid formats are: {', '.join(DUMP_FORMATS)}")
+        if format == "ndjson":
+            records = (json.loads(line) for line in stream if line.strip())
+            records = ((rec["table"], rec["record"]) for rec in records)
+        else:
+            records = ((table_name, rec) for table_name, recs in json.load(stream).items() for rec in recs)
+
+        counts = {}
+        with self.transaction():
+            table_name = None
+            batch = []
+            for name, record in records:
+                if name not in self.tables:
+                    raise ValueError(f"Cannot load records into unknown table {name}")
+                if batch and (name != table_name or len(batch) >= DUMP_BATCH_SIZE):
+                    self.session.execute(insert(self.tables[table_name]), batch)
+                    batch = []
+                table_name = name
+                batch.append(record)
+                counts[name] = counts.get(name, 0) + 1
+            if batch:
+                self.session.execute(insert(self.tables[table_name]), batch)
+
+        # Core inserts are not seen by the model caches
+        for name in counts:
+            cache.invalidate(self.models[name])
+        return counts
 
     def __getattr__(self, name: str):
-        return self.query(getattr(ttfrog.db.schema, name))
+        # db.Character is db.query(Character); nothing but a model's name is looked up
+        info = registry.tables.get(name)
+        if info is None or info.model.__name__ != name:
+            raise AttributeError(f"{type(self).__name__} has no attribute {name}, and there is no model by that name")
+        return self.query(info.model)
 
 
 db = SQLDatabaseManager()
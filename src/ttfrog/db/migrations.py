@@ -0,0 +1,175 @@
+"""
+Versioned, incremental changes to the schema of an existing database.
+
+The version of a database's schema is kept in the schema_version table. Each migration brings the
+schema from one version to the next, so on startup only the migrations a database hasn't seen yet are
+run, and checking a database that is up to date takes a few queries however much it holds. An empty
+database is created from the models and stamped with the latest version; a database created before
+schema versions were recorded is taken to be at version 0.
+
+Migrations are written against the schema as it was when they were added, rather than the models, since
+the models will have moved on by the time an old database is migrated. To change the schema, change the
+models and append a migration that makes the same change to an existing database:
+
+    @migration
+    def character_notes(connection):
+        "Characters have notes."
+        connection.execute(text("ALTER TABLE character ADD COLUMN notes TEXT"))
+"""
+
+import logging
+
+from sqlalchemy import (
+    Column,
+    Float,
+    ForeignKey,
+    Index,
+    Integer,
+    MetaData,
+    SmallInteger,
+    String,
+    Table,
+    Text,
+    UniqueConstraint,
+)
+from sqlalchemy import inspect as inspect_db
+from sqlalchemy import select, text
+
+version_metadata = MetaData()
+schema_version = Table("schema_version", version_metadata, Column("version", Integer, nullable=False))
+
+MIGRATIONS = []
+
+
+def migration(func):
+    """
+    Add a migration; its version is its position in the list of migrations.
+    """
+    MIGRATIONS.append(func)
+    return func
+
+
+def latest_version():
+    return len(MIGRATIONS)
+
+
+def current_version(connection):
+    """
+    Return the schema version recorded in a database, or None if there isn't one.
+    """
+    return connection.execute(select(schema_version.c.version)).scalar()
+
+
+def _stamp(connection, version):
+    connection.execute(schema_version.delete())
+    connection.execute(schema_version.insert().values(version=version))
+
+
+def migrate(engine, metadata):
+    """
+    Bring a database up to the latest schema version, creating it if it is empty. Returns the migrations run.
+    """
+    with engine.begin() as connection:
+        tables = set(inspect_db(connection).get_table_names())
+        version_metadata.create_all(connection)
+        if not tables.intersection(metadata.tables):
+            metadata.create_all(connection)
+            _stamp(connection, latest_version())
+            return []
+        version = current_version(connection) or 0
+        pending = MIGRATIONS[version:]
+        for number, func in enumerate(pending, start=version + 1):
+            logging.info(f"Migrating the database to version {number}: {func.__doc__.strip()}")
+            func(connection)
+        if pending or "schema_version" not in tables:
+            _stamp(connection, latest_version())
+        return pending
+
+
+def _rebuild(connection, table, columns):
+    """
+    Replace a table with a new definition, copying the given columns (or expressions, keyed on the new
+    column) from the old one.
+    """
+    old_name = f"{table.name}_old"
+    connection.execute(text(f"ALTER TABLE {table.name} RENAME TO {old_name}"))
+    table.create(connection)
+    connection.execute(
+        text(f"INSERT INTO {table.name} ({', '.join(columns)}) SELECT {', '.join(columns.values())} FROM {old_name}")
+    )
+    connection.execute(text(f"DROP TABLE {old_name}"))
+
+
+@migration
+def modifier_map_primary_table(connection):
+    """
+    ModifierMap.primary_table is an integer identifying the table, instead of the table's name.
+    """
+    metadata = MetaData()
+    Table("modifier", metadata, Column("id", Integer, primary_key=True))
+    table = Table(
+        "modifier_map",
+        metadata,
+        Column("id", Integer, primary_key=True, autoincrement=True),
+        Column("modifier_id", Integer, ForeignKey("modifier.id"), nullable=False),
+        Column("primary_table", SmallInteger, nullable=False),
+        Column("primary_table_id", Integer, nullable=False),
+        UniqueConstraint("primary_table", "primary_table_id", "modifier_id"),
+        Index("ix_modifier_map_primary", "primary_table", "primary_table_id"),
+    )
+    # the values of MODIFIER_TABLES when the column was added
+    primary_table = (
+        "CASE primary_table_name WHEN 'ancestry' THEN 1 WHEN 'ancestry_trait' THEN 2 WHEN 'character' THEN 3 END"
+    )
+    _rebuild(
+        connection,
+        table,
+        dict(
+            id="id",
+            modifier_id="modifier_id",
+            primary_table=primary_table,
+            primary_table_id="primary_table_id",
+        ),
+    )
+
+
+@migration
+def column_transaction_log(connection):
+    """
+    The transaction log records the changed columns of one row per entry. Entries in the old format
+    cannot be restored, and are kept in the transaction_log_v0 table if there are any.
+    """
+    if connection.execute(text("SELECT COUNT(*) FROM transaction_log")).scalar():
+        connection.execute(text("ALTER TABLE transaction_log RENAME TO transaction_log_v0"))
+    else:
+        connection.execute(text("DROP TABLE transaction_log"))
+    Table(
+        "transaction_log",
+        MetaData(),
+        Column("id", Integer, primary_key=True, autoincrement=True),
+        Column("source_table_name", String, nullable=False),
+        Column("primary_key", Integer, nullable=False),
+        Column("operation", String, nullable=False),
+        Column("timestamp", Float, nullable=False),
+        Column("diff", Text, nullable=False),
+        Index("ix_transaction_log_row", "source_table_name", "primary_key", "id"),
+    ).create(connection)
+
+
+@migration
+def character_snapshots(connection):
+    """
+    Transaction log entries record the character they belong to, and characters are snapshotted.
+    """
+    connection.execute(text("ALTER TABLE transaction_log ADD COLUMN character_id INTEGER"))
+    connection.execute(text("CREATE INDEX ix_transaction_log_character ON transaction_log (character_id, id)"))
+    Table(
+        "character_snapshot",
+        MetaData(),
+        Column("id", Integer, primary_key=True, autoincrement=True),
+        Column("character_id", Integer, nullable=False),
+        Column("timestamp", Float, nullable=False),
+        Column("log_id", Integer, nullable=False),
+        Column("data", Text, nullable=False),
+        Index("ix_character_snapshot_character", "character_id", "timestamp"),
+    ).create(connection)
@@ -0,0 +1,102 @@
+"""
+Statistics about the SQL statements executed while a block of code runs, such as a web request:
+
+    >>> with collect() as stats:
+    ...     db.query(Character, profile="sheet").filter_by(slug=slug).one()
+    >>> stats.count, stats.duplicates
+    (11, 0)
+
+Statements are recorded by cursor execution hooks on the engine, which must first be installed with
+install(engine). Collection is tracked per thread (or task), so concurrent requests each see only their
+own statements.
+"""
+
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from sqlalchemy import event
+
+# the number of slowest statements kept by each collection
+SLOWEST = 5
+
+_current = ContextVar("query_stats", default=None)
+
+
+class QueryStats:
+    """
+    The number of statements executed, the total time spent executing them, the slowest of them, and
+    the statements executed more than once.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.slowest = []
+        self.statements = Counter()
+
+    def record(self, statement, seconds):
+        self.count += 1
+        self.seconds += seconds
+        self.statements[statement] += 1
+        if len(self.slowest) < SLOWEST or seconds > self.slowest[-1][1]:
+            self.slowest = sorted(self.slowest + [(statement, seconds)], key=lambda item: -item[1])[:SLOWEST]
+
+    @property
+    def duplicated(self):
+        """
+        The statements executed more than once, and the number of times each was executed.
+        """
+        return dict((statement, count) for statement, count in self.statements.most_common() if count > 1)
+
+    @property
+    def duplicates(self):
+        """
+        The number of executions that repeated an earlier statement.
+        """
+        return sum(count - 1 for count in self.duplicated.values())
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "milliseconds": round(self.seconds * 1000, 3),
+            "duplicates": self.duplicates,
+            "slowest": [
+                {"statement": statement, "milliseconds": round(secs * 1000, 3)} for statement, secs in self.slowest
+            ],
+            "duplicated": [{"statement": statement, "count": count} for statement, count in self.duplicated.items()],
+        }
+
+
+@contextmanager
+def collect():
+    """
+    Record statistics about the statements executed in the block.
+    """
+    stats = QueryStats()
+    token = _current.set(stats)
+    try:
+        yield stats
+    finally:
+        _current.reset(token)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current.get()
+    if stats is not None and conn.info.get("query_start_time"):
+        stats.record(statement, time.perf_counter() - conn.info["query_start_time"].pop())
+
+
+def install(engine):
+    """
+    Add the hooks that record statements executed by the engine. Safe to call more than once.
+    """
+    if not event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", _after_cursor_execute)
@@ -0,0 +1,102 @@
+"""
+Every mapped table, and what there is to know about it without reflecting on the database or the schema
+module again. The registry is built once, on import, and can look a table up by its table name, its
+model's name, or its model's name in snake case, which are the names a table can be given in URLs:
+
+    >>> tables["AncestryTraitMap"] is tables["ancestry_trait_map"] is tables["trait_map"]
+    True
+    >>> tables["trait_map"].indexed
+    frozenset({'ancestry_id', 'id'})
+
+A column is indexed if it leads an index, a unique constraint or the primary key, since only those can
+be looked up without scanning the whole table.
+"""
+
+import re
+from typing import NamedTuple
+
+from sqlalchemy import Table, UniqueConstraint
+from sqlalchemy.orm import Mapper
+
+import ttfrog.db.schema
+from ttfrog.db.base import BaseObject
+
+assert ttfrog.db.schema
+
+
+class TableInfo(NamedTuple):
+    name: str
+    model: type
+    mapper: Mapper
+    table: Table
+    columns: tuple
+    primary_key: tuple
+    indexed: frozenset
+    aliases: tuple
+
+
+def snake_case(name):
+    return re.sub(r"(?<!^)(?=[A-Z])", "_", name).lower()
+
+
+def table_info(mapper):
+    table = mapper.local_table
+    key = dict((column, mapper.get_property_by_column(column).key) for column in mapper.columns)
+    leading = [list(table.primary_key)[0]]
+    leading += [list(index.columns)[0] for index in table.indexes]
+    leading += [list(c.columns)[0] for c in table.constraints if isinstance(c, UniqueConstraint) and c.columns]
+    model = mapper.class_
+    return TableInfo(
+        name=table.name,
+        model=model,
+        mapper=mapper,
+        table=table,
+        columns=tuple(mapper.columns.keys()),
+        primary_key=tuple(key[column] for column in mapper.primary_key),
+        indexed=frozenset(key[column] for column in leading),
+        aliases=tuple(dict.fromkeys([table.name, model.__name__, snake_case(model.__name__)])),
+    )
+
+
+class TableRegistry:
+    """
+    The TableInfo of every mapped table, in dependency order, looked up by any of its aliases.
+    """
+
+    def __init__(self, base=BaseObject):
+        mappers = dict((mapper.local_table, mapper) for mapper in base.registry.mappers)
+        self._tables = dict(
+            (table.name, table_info(mappers[table])) for table in base.metadata.sorted_tables if table in mappers
+        )
+        self._aliases = {}
+        for info in self._tables.values():
+            for alias in info.aliases:
+                if self._aliases.setdefault(alias, info) is not info:
+                    raise ValueError(f"{alias} could refer to either {self._aliases[alias].name} or {info.name}")
+
+    def __getitem__(self, name):
+        try:
+            return self._aliases[name]
+        except KeyError:
+            raise KeyError(f"There is no table or model named {name}")
+
+    def get(self, name, default=None):
+        return self._aliases.get(name, default)
+
+    def __contains__(self, name):
+        return name in self._aliases
+
+    def __iter__(self):
+        return iter(self._tables.values())
+
+    def __len__(self):
+        return len(self._tables)
+
+    def names(self):
+        """
+        Return the table names, in dependency order.
+        """
+        return list(self._tables)
+
+
+tables = TableRegistry()
@@ -1,9 +1,24 @@
-from sqlalchemy import Column, Enum, ForeignKey, Integer, String, Text, UniqueConstraint
+from sqlalchemy import Column, Enum, ForeignKey, Integer, String, Text, UniqueConstraint, event
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.orm import relationship
 
-from ttfrog.db.base import BaseObject, CreatureTypesEnum, SavingThrowsMixin, SizesEnum, SkillsMixin, SlugMixin
-from ttfrog.db.schema.modifiers import Modifier, ModifierMixin
+from ttfrog.db.base import (
+    BaseObject,
+    CreatureTypesEnum,
+    SavingThrowsMixin,
+    SizesEnum,
+    SkillsMixin,
+    SlugMixin,
+    generation_cached,
+)
+from ttfrog.db.schema.modifiers import (
+    NO_MODIFIERS,
+    CompiledModifiers,
+    Modifier,
+    ModifierMixin,
+    load_modifier_maps,
+    modifiers_changed,
+)
 
 __all__ = [
     "Ancestry",
@@ -34,7 +49,7 @@ class AncestryTraitMap(BaseObject):
     id = Column(Integer, primary_key=True, autoincrement=True)
     ancestry_id = Column(Integer, ForeignKey("ancestry.id"))
     ancestry_trait_id = Column(Integer, ForeignKey("ancestry_trait.id"))
-    trait = relationship("AncestryTrait", uselist=False, lazy="immediate")
+    trait = relationship("AncestryTrait", uselist=False, lazy="joined")
     level = Column(Integer, nullable=False, info={"min": 1, "max": 20})
 
 
@@ -52,7 +67,7 @@ class Ancestry(BaseObject, ModifierMixin):
     _fly_speed = Column(Integer, info={"min": 0, "max": 99})
     _climb_speed = Column(Integer, info={"min": 0, "max": 99})
     _swim_speed = Column(Integer, info={"min": 0, "max": 99})
-    _traits = relationship("AncestryTraitMap", cascade="all,delete,delete-orphan", lazy="immediate")
+    _traits = relationship("AncestryTraitMap", cascade="all,delete,delete-orphan")
 
     @property
     def traits(self):
@@ -102,7 +117,7 @@ class CharacterClassMap(BaseObject):
     character_class_id = Column(Integer, ForeignKey("character_class.id"), nullable=False)
     level = Column(Integer, nullable=False, info={"min": 1, "max": 20}, default=1)
 
-    character_class = relationship("CharacterClass", lazy="immediate")
+    character_class = relationship("CharacterClass")
     character = relationship("Character", uselist=False, viewonly=True)
 
     def __repr__(self):
@@ -117,8 +132,8 @@ class CharacterClassAttributeMap(BaseObject):
     class_attribute_id = Column(Integer, ForeignKey("class_attribute.id"), nullable=False)
     option_id = Column(Integer, ForeignKey("class_attribute_option.id"), nullable=False)
 
-    class_attribute = relationship("ClassAttribute", lazy="immediate")
-    option = relationship("ClassAttributeOption", lazy="immediate")
+    class_attribute = relationship("ClassAttribute")
+    option = relationship("ClassAttributeOption")
 
     character_class = relationship(
         "CharacterClass",
@@ -160,6 +175,7 @@ class Character(BaseObject, ModifierMixin, SlugMixin, SavingThrowsMixin, SkillsM
 
     @property
     def modifiers(self):
+        load_modifier_maps([self.ancestry, *self.traits, self])
         unified = {}
         unified.update(**self.ancestry.modifiers)
         for trait in self.traits:
@@ -167,6 +183,14 @@ class Character(BaseObject, ModifierMixin, SlugMixin, SavingThrowsMixin, SkillsM
         unified.update(**super().modifiers)
         return unified
 
+    @generation_cached(lambda: ModifierMixin.modifier_generation)
+    def effective_modifiers(self):
+        """
+        The character's modifiers compiled into a dict of CompiledModifiers keyed on target. The
+        dict is built once and reused until a modifier, trait, ancestry or class changes.
+        """
+        return dict((target, CompiledModifiers.compile(modifiers)) for target, modifiers in self.modifiers.items())
+
     @property
     def classes(self):
         return dict([(mapping.character_class.name, mapping.character_class) for mapping in self.class_map])
@@ -247,57 +271,118 @@ class Character(BaseObject, ModifierMixin, SlugMixin, SavingThrowsMixin, SkillsM
     def class_attributes(self):
         return dict([(mapping.class_attribute.name, mapping.option) for mapping in self.character_class_attribute_map])
 
-    def add_class(self, newclass, level=1):
-        if level == 0:
-            return self.remove_class(newclass)
-        level_in_class = [mapping for mapping in self.class_map if mapping.character_class_id == newclass.id]
-        if level_in_class:
-            level_in_class = level_in_class[0]
-            level_in_class.level = level
-        else:
-            self.class_list.append(CharacterClassMap(character_id=self.id, character_class=newclass, level=level))
-        for lvl in range(1, level + 1):
-            if not newclass.attributes_by_level[lvl]:
+    def class_mapping(self, character_class):
+        """
+        The CharacterClassMap assigning the character a level in the given class, if there is one. Classes
+        are matched by id, so that an instance of the class from another session still matches; a class
+        that hasn't been saved yet only matches itself.
+        """
+        for mapping in self.class_map:
+            if mapping.character_class is character_class:
+                return mapping
+            if character_class.id is None:
                 continue
-            for attr_name, attr in newclass.attributes_by_level[lvl].items():
-                self.add_class_attribute(attr, attr.options[0])
+            class_id = mapping.character_class_id
+            if class_id is None and mapping.character_class is not None:
+                class_id = mapping.character_class.id
+            if class_id == character_class.id:
+                return mapping
+        return None
+
+    def class_granting(self, class_attribute):
+        """
+        The character's CharacterClass granting a class attribute at its current level, if any. This reads
+        only the class maps and class attributes a sheet already has loaded; unlike
+        CharacterClassAttributeMap.character_class, it is unambiguous for a character with several classes.
+        """
+        for mapping in self.class_map:
+            granted = mapping.character_class.attributes_up_to(mapping.level or 1).get(class_attribute.name)
+            if granted is not None and granted.id == class_attribute.id:
+                return mapping.character_class
+        return None
+
+    def set_class_level(self, character_class, level):
+        """
+        Set the character's level in a class, adding the class or removing it (at level 0) as needed, and
+        return the previous level. Only the difference between the levels is applied to the character's
+        class attributes: those gained on the way up are added, and those above the new level removed
+        unless another of the character's classes grants them too.
+        The new attribute maps are added to the session together, so they are inserted in a single flush.
+        """
+        mapping = self.class_mapping(character_class)
+        old_level = (mapping.level or 1) if mapping else 0
+        if level == old_level:
+            return old_level
+
+        if not mapping:
+            self.class_list.append(
+                CharacterClassMap(character_id=self.id, character_class=character_class, level=level)
+            )
+        elif level:
+            mapping.level = level
+        else:
+            self.class_map.remove(mapping)
+
+        if level > old_level:
+            existing = self.class_attributes
+            self.character_class_attribute_map.extend(
+                CharacterClassAttributeMap(character_id=self.id, class_attribute=attr, option=attr.options[0])
+                for name, attr in character_class.attributes_between(old_level, level).items()
+                if name not in existing
+            )
+        else:
+            dropped = set(character_class.attributes_between(level, old_level).values())
+            for other in self.class_map:
+                if dropped and other is not mapping:
+                    dropped.difference_update(other.character_class.attributes_up_to(other.level or 1).values())
+            if dropped:
+                self.character_class_attribute_map = [
+                    m for m in self.character_class_attribute_map if m.class_attribute not in dropped
+                ]
+        return old_level
+
+    def level_up(self, character_class, levels=1):
+        """
+        Gain one or more levels in a class, returning the new level.
+        """
+        mapping = self.class_mapping(character_class)
+        level = ((mapping.level or 1) if mapping else 0) + levels
+        self.set_class_level(character_class, level)
+        return level
+
+    def add_class(self, newclass, level=1):
+        self.set_class_level(newclass, level)
 
     def remove_class(self, target):
-        self.class_map = [m for m in self.class_map if m.id != target.id]
-        for mapping in self.character_class_attribute_map:
-            if mapping.character_class.id == target.id:
-                self.remove_class_attribute(mapping.class_attribute)
+        self.set_class_level(target, 0)
 
     def remove_class_attribute(self, attribute):
-        self.character_class_attribute_map = [m for m in self.character_class_attribute_map if m.id != attribute.id]
+        self.character_class_attribute_map = [
+            m for m in self.character_class_attribute_map if m.class_attribute is not attribute
+        ]
 
     def add_class_attribute(self, attribute, option):
-        for thisclass in self.classes.values():
-            current_level = self.levels[thisclass.name]
-            current_attributes = thisclass.attributes_by_level.get(current_level, {})
-            if attribute.name in current_attributes:
-                if attribute.name in self.class_attributes:
-                    return True
-                self.attribute_list.append(
-                    CharacterClassAttributeMap(character_id=self.id, class_attribute=attribute, option=option)
-                )
+        for mapping in self.class_map:
+            if attribute.name in mapping.character_class.attributes_up_to(mapping.level or 1):
+                if attribute.name not in self.class_attributes:
+                    self.attribute_list.append(
+                        CharacterClassAttributeMap(character_id=self.id, class_attribute=attribute, option=option)
+                    )
                 return True
         return False
 
     def apply_modifiers(self, target, initial):
-        modifiers = list(reversed(self.modifiers.get(target, [])))
         if initial is None:
             return initial
-        if isinstance(initial, int):
-            absolute = [mod for mod in modifiers if mod.absolute_value is not None]
-            if absolute:
-                return absolute[0].absolute_value
-            multiple = [mod for mod in modifiers if mod.multiply_value is not None]
-            if multiple:
-                return int(initial * multiple[0].multiply_value + 0.5)
-            return initial + sum(mod.relative_value for mod in modifiers if mod.relative_value is not None)
-
-        new = [mod for mod in modifiers if mod.new_value is not None]
-        if new:
-            return new[0].new_value
-        return initial
+        return self.effective_modifiers.get(target, NO_MODIFIERS).apply(initial)
+
+
+for _attr, _events in (
+    (Ancestry._traits, ("append", "remove")),
+    (AncestryTraitMap.trait, ("set",)),
+    (Character.ancestry, ("set",)),
+    (Character.ancestry_id, ("set",)),
+    (Character.class_map, ("append", "remove")),
+):
+    for _event in _events:
+        event.listen(_attr, _event, modifiers_changed)
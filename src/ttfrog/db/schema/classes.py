@@ -1,15 +1,16 @@
-from collections import defaultdict
+from bisect import bisect_right
 
-from sqlalchemy import Column, Enum, ForeignKey, Integer, String
+from sqlalchemy import Column, Enum, ForeignKey, Integer, String, event
 from sqlalchemy.orm import relationship
 
-from ttfrog.db.base import BaseObject, SavingThrowsMixin, SkillsMixin, StatsEnum
+from ttfrog.db.base import BaseObject, SavingThrowsMixin, SkillsMixin, StatsEnum, generation_cached
 
 __all__ = [
     "ClassAttributeMap",
     "ClassAttribute",
     "ClassAttributeOption",
     "CharacterClass",
+    "ClassAttributeIndex",
 ]
 
 
@@ -18,14 +19,14 @@ class ClassAttributeMap(BaseObject):
     class_attribute_id = Column(Integer, ForeignKey("class_attribute.id"), primary_key=True)
     character_class_id = Column(Integer, ForeignKey("character_class.id"), primary_key=True)
     level = Column(Integer, nullable=False, info={"min": 1, "max": 20}, default=1)
-    attribute = relationship("ClassAttribute", uselist=False, viewonly=True, lazy="immediate")
+    attribute = relationship("ClassAttribute", uselist=False, viewonly=True)
 
 
 class ClassAttribute(BaseObject):
     __tablename__ = "class_attribute"
     id = Column(Integer, primary_key=True, autoincrement=True)
     name = Column(String, nullable=False)
-    options = relationship("ClassAttributeOption", cascade="all,delete,delete-orphan", lazy="immediate")
+    options = relationship("ClassAttributeOption", cascade="all,delete,delete-orphan")
 
     def __repr__(self):
         return f"{self.id}: {self.name}"
@@ -38,6 +39,37 @@ class ClassAttributeOption(BaseObject):
     attribute_id = Column(Integer, ForeignKey("class_attribute.id"), nullable=False)
 
 
+class ClassAttributeIndex:
+    """
+    A class's attributes grouped by the level they are gained at, in level order, along with every
+    attribute gained at or below each of those levels.
+    """
+
+    def __init__(self, mappings):
+        self.by_level = {}
+        for mapping in sorted(mappings, key=lambda mapping: mapping.level or 1):
+            self.by_level.setdefault(mapping.level or 1, {})[mapping.attribute.name] = mapping.attribute
+        self._levels = list(self.by_level)
+        self._cumulative = []
+        total = {}
+        for attributes in self.by_level.values():
+            total = {**total, **attributes}
+            self._cumulative.append(total)
+
+    def up_to(self, level):
+        i = bisect_right(self._levels, level)
+        return self._cumulative[i - 1] if i else {}
+
+    def between(self, low, high):
+        """
+        The attributes gained above level low, up to and including level high.
+        """
+        attributes = {}
+        for level in self._levels[bisect_right(self._levels, low) : bisect_right(self._levels, high)]:
+            attributes.update(self.by_level[level])
+        return attributes
+
+
 class CharacterClass(BaseObject, SavingThrowsMixin, SkillsMixin):
     __tablename__ = "character_class"
     id = Column(Integer, primary_key=True, autoincrement=True)
@@ -45,11 +77,51 @@ class CharacterClass(BaseObject, SavingThrowsMixin, SkillsMixin):
     hit_dice = Column(String, default="1d6")
     hit_dice_stat = Column(Enum(StatsEnum))
     proficiencies = Column(String)
-    attributes = relationship("ClassAttributeMap", cascade="all,delete,delete-orphan", lazy="immediate")
+    attributes = relationship("ClassAttributeMap", cascade="all,delete,delete-orphan")
+
+    # Incremented whenever any class's attributes or the levels they are gained at change, so that
+    # cached attribute indexes built from an older generation can be discarded.
+    attribute_generation = 0
+
+    @generation_cached(lambda: CharacterClass.attribute_generation)
+    def attribute_index(self):
+        """
+        The class's attributes as a ClassAttributeIndex, built once and reused until they change.
+        """
+        return ClassAttributeIndex(self.attributes)
 
     @property
     def attributes_by_level(self):
-        by_level = defaultdict(list)
-        for mapping in self.attributes:
-            by_level[mapping.level] = {mapping.attribute.name: mapping.attribute}
-        return by_level
+        """
+        A dict of {level: {name: ClassAttribute}} for each level at which the class gains attributes.
+        """
+        return self.attribute_index.by_level
+
+    def attributes_up_to(self, level):
+        """
+        A dict of {name: ClassAttribute} for every attribute the class gains at or below the given level.
+        """
+        return self.attribute_index.up_to(level)
+
+    def attributes_between(self, low, high):
+        """
+        A dict of {name: ClassAttribute} for every attribute the class gains above level low, up to and
+        including level high.
+        """
+        return self.attribute_index.between(low, high)
+
+
+def attributes_changed(*args, **kwargs):
+    """
+    Event handler that invalidates every attribute index built from an older generation.
+    """
+    CharacterClass.attribute_generation += 1
+
+
+for _attr, _events in (
+    (CharacterClass.attributes, ("append", "remove")),
+    (ClassAttributeMap.level, ("set",)),
+    (ClassAttributeMap.class_attribute_id, ("set",)),
+):
+    for _event in _events:
+        event.listen(_attr, _event, attributes_changed)
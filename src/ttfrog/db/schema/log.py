@@ -1,13 +1,51 @@
-from sqlalchemy import Column, Integer, String, Text
+import json
+
+from sqlalchemy import Column, Float, Index, Integer, String, Text
 
 from ttfrog.db.base import BaseObject
 
-__all__ = ["TransactionLog"]
+__all__ = ["TransactionLog", "CharacterSnapshot"]
 
 
 class TransactionLog(BaseObject):
+    """
+    One change to one row: the operation (insert, update or delete), when it was flushed, and the
+    changed columns as a JSON object of {column: [old value, new value]}. Changes to the rows making up
+    a character also record the character's id. See ttfrog.db.transaction_log.
+    """
+
     __tablename__ = "transaction_log"
+    __table_args__ = (
+        Index("ix_transaction_log_row", "source_table_name", "primary_key", "id"),
+        Index("ix_transaction_log_character", "character_id", "id"),
+    )
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    source_table_name = Column(String, nullable=False)
+    primary_key = Column(Integer, nullable=False)
+    character_id = Column(Integer)
+    operation = Column(String, nullable=False)
+    timestamp = Column(Float, nullable=False)
+    diff = Column(Text, nullable=False)
+
+    @property
+    def changes(self):
+        return json.loads(self.diff)
+
+
+class CharacterSnapshot(BaseObject):
+    """
+    The rows making up a character, as of the TransactionLog entry with the id log_id, as a JSON object
+    of {table name: [row, ...]}. See ttfrog.db.transaction_log.snapshot_at.
+    """
+
+    __tablename__ = "character_snapshot"
+    __table_args__ = (Index("ix_character_snapshot_character", "character_id", "timestamp"),)
     id = Column(Integer, primary_key=True, autoincrement=True)
-    source_table_name = Column(String, index=True, nullable=False)
-    primary_key = Column(Integer, index=True)
-    diff = Column(Text)
+    character_id = Column(Integer, nullable=False)
+    timestamp = Column(Float, nullable=False)
+    log_id = Column(Integer, nullable=False)
+    data = Column(Text, nullable=False)
+
+    @property
+    def rows(self):
+        return dict((name, dict((row["id"], row) for row in rows)) for name, rows in json.loads(self.data).items())
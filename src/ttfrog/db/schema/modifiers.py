@@ -1,11 +1,34 @@
 from collections import defaultdict
+from typing import NamedTuple
 
-from sqlalchemy import Column, Float, ForeignKey, Integer, String, UniqueConstraint
+from sqlalchemy import Column, Float, ForeignKey, Index, Integer, SmallInteger, String, UniqueConstraint, event, tuple_
 from sqlalchemy.ext.declarative import declared_attr
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import Mapper, object_session, relationship
+from sqlalchemy.orm.attributes import set_committed_value
 
 from ttfrog.db.base import BaseObject
 
+# The integer stored in ModifierMap.primary_table for each table that uses the ModifierMixin. These
+# values are persisted, so existing entries must never be renumbered or reused.
+MODIFIER_TABLES = {
+    "ancestry": 1,
+    "ancestry_trait": 2,
+    "character": 3,
+}
+
+# the table named by each ModifierMap.primary_table value
+MODIFIER_TABLE_NAMES = dict((value, name) for name, value in MODIFIER_TABLES.items())
+
+
+def modifier_table(table_name):
+    """
+    Return the ModifierMap.primary_table discriminator for the named table.
+    """
+    try:
+        return MODIFIER_TABLES[table_name]
+    except KeyError:
+        raise KeyError(f"Table {table_name} must be added to MODIFIER_TABLES before it can use the ModifierMixin.")
+
 
 class ModifierMap(BaseObject):
     """
@@ -13,14 +36,21 @@ class ModifierMap(BaseObject):
     """
 
     __tablename__ = "modifier_map"
-    __table_args__ = (UniqueConstraint("primary_table_name", "primary_table_id", "modifier_id"),)
+    __table_args__ = (
+        UniqueConstraint("primary_table", "primary_table_id", "modifier_id"),
+        Index("ix_modifier_map_primary", "primary_table", "primary_table_id"),
+    )
     id = Column(Integer, primary_key=True, autoincrement=True)
     modifier_id = Column(Integer, ForeignKey("modifier.id"), nullable=False)
-    modifier = relationship("Modifier", uselist=False, lazy="immediate")
+    modifier = relationship("Modifier", uselist=False, lazy="joined")
 
-    primary_table_name = Column(String, nullable=False)
+    primary_table = Column(SmallInteger, nullable=False)
     primary_table_id = Column(Integer, nullable=False)
 
+    @property
+    def primary_table_name(self):
+        return MODIFIER_TABLE_NAMES[self.primary_table]
+
 
 class Modifier(BaseObject):
     """
@@ -41,6 +71,53 @@ class Modifier(BaseObject):
     description = Column(String)
 
 
+class CompiledModifiers(NamedTuple):
+    """
+    The net effect of a list of Modifiers on a single target, reduced so that it can be applied
+    to an initial value without walking the modifiers again.
+    """
+
+    absolute_value: int = None
+    multiply_value: float = None
+    relative_value: int = 0
+    new_value: str = None
+
+    @classmethod
+    def compile(cls, modifiers):
+        """
+        Reduce a list of modifiers, in the order they were added. Later absolute, multiply and new
+        values take precedence over earlier ones; relative values are summed.
+        """
+        absolute_value = multiply_value = new_value = None
+        relative_value = 0
+        for mod in modifiers:
+            if mod.absolute_value is not None:
+                absolute_value = mod.absolute_value
+            if mod.multiply_value is not None:
+                multiply_value = mod.multiply_value
+            if mod.relative_value is not None:
+                relative_value += mod.relative_value
+            if mod.new_value is not None:
+                new_value = mod.new_value
+        return cls(absolute_value, multiply_value, relative_value, new_value)
+
+    def apply(self, initial):
+        if initial is None:
+            return initial
+        if isinstance(initial, int):
+            if self.absolute_value is not None:
+                return self.absolute_value
+            if self.multiply_value is not None:
+                return int(initial * self.multiply_value + 0.5)
+            return initial + self.relative_value
+        if self.new_value is not None:
+            return self.new_value
+        return initial
+
+
+NO_MODIFIERS = CompiledModifiers()
+
+
 class ModifierMixin:
     """
     Add modifiers to an existing class.
@@ -64,13 +141,17 @@ class ModifierMixin:
         {'strength': [Modifier(id=1, target='strength', name='STR+1', relative_value=1 ... ]}
     """
 
+    # Incremented whenever a modifier, or the association of a modifier with any record, changes.
+    # Consumers of modifiers can compare generations to decide whether a cached result is stale.
+    modifier_generation = 0
+
     @declared_attr
     def modifier_map(cls):
         return relationship(
             "ModifierMap",
             primaryjoin=(
                 "and_("
-                f"foreign(ModifierMap.primary_table_name)=='{cls.__tablename__}', "
+                f"foreign(ModifierMap.primary_table)=={modifier_table(cls.__tablename__)}, "
                 f"foreign(ModifierMap.primary_table_id)=={cls.__name__}.id"
                 ")"
             ),
@@ -78,7 +159,6 @@ class ModifierMixin:
             overlaps="modifier_map,modifier_map",
             single_parent=True,
             uselist=True,
-            lazy="immediate",
         )
 
     @property
@@ -96,7 +176,7 @@ class ModifierMixin:
             return False
         self.modifier_map.append(
             ModifierMap(
-                primary_table_name=self.__tablename__,
+                primary_table=modifier_table(self.__tablename__),
                 primary_table_id=self.id,
                 modifier=modifier,
             )
@@ -108,3 +188,56 @@ class ModifierMixin:
             return False
         self.modifier_map = [mapping for mapping in self.modifier_map if mapping.modifier != modifier]
         return True
+
+
+def load_modifier_maps(owners):
+    """
+    Load the modifier_map of every owner in a single query, instead of one query per owner. Owners
+    may be instances of any model using the ModifierMixin; those that are not yet persistent or
+    whose modifier_map is already loaded are left alone.
+    """
+    unloaded = {}
+    for owner in owners:
+        if owner is None or owner.id is None or "modifier_map" in owner.__dict__:
+            continue
+        unloaded[(modifier_table(owner.__tablename__), owner.id)] = owner
+    if len(unloaded) < 2:
+        # the relationship's own lazy loader is cheaper for a single owner
+        return
+
+    session = object_session(next(iter(unloaded.values())))
+    maps = defaultdict(list)
+    query = (
+        session.query(ModifierMap)
+        .filter(tuple_(ModifierMap.primary_table, ModifierMap.primary_table_id).in_(list(unloaded)))
+        .order_by(ModifierMap.id)
+    )
+    for mapping in query:
+        maps[(mapping.primary_table, mapping.primary_table_id)].append(mapping)
+    for key, owner in unloaded.items():
+        set_committed_value(owner, "modifier_map", maps[key])
+
+
+def modifiers_changed(*args, **kwargs):
+    """
+    Event handler that invalidates every cache built from an older modifier generation.
+    """
+    ModifierMixin.modifier_generation += 1
+
+
+for _attr in (
+    Modifier.target,
+    Modifier.absolute_value,
+    Modifier.relative_value,
+    Modifier.multiply_value,
+    Modifier.new_value,
+):
+    event.listen(_attr, "set", modifiers_changed)
+event.listen(ModifierMap.modifier, "set", modifiers_changed)
+
+
+@event.listens_for(Mapper, "mapper_configured")
+def _watch_modifier_map(mapper, cls):
+    if issubclass(cls, ModifierMixin):
+        event.listen(cls.modifier_map, "append", modifiers_changed)
+        event.listen(cls.modifier_map, "remove", modifiers_changed)
@@ -0,0 +1,177 @@
+"""
+Evaluate character stats in bulk.
+
+Character's stat properties resolve one target for one character at a time. evaluate_stats() instead
+loads the columns and Modifier rows for a whole batch of characters with a handful of set-based
+queries, then applies the modifiers one target at a time across the batch:
+
+    >>> evaluate_stats(party, ["AC", "HP", "speed"])
+    {1: {'AC': 12, 'HP': 24, 'speed': 30}, 2: {'AC': 15, 'HP': 31, 'speed': 25}}
+
+The results are identical to reading the equivalent properties from each Character.
+"""
+
+from collections import defaultdict
+
+from sqlalchemy import select
+
+from ttfrog.db.manager import db
+from ttfrog.db.schema import Ancestry, AncestryTrait, AncestryTraitMap, Character, Modifier
+from ttfrog.db.schema.modifiers import NO_MODIFIERS, CompiledModifiers, ModifierMap, modifier_table
+
+# the maximum number of ids bound to a single IN clause
+BATCH_SIZE = 500
+
+# Character stat properties, mapped to the modifier target each property applies
+STAT_TARGETS = {
+    "AC": "armor_class",
+    "HP": "max_hit_points",
+    "STR": "strength",
+    "DEX": "dexterity",
+    "CON": "constitution",
+    "INT": "intelligence",
+    "WIS": "wisdom",
+    "CHA": "charisma",
+    "speed": "speed",
+    "climb_speed": "climb_speed",
+    "swim_speed": "swim_speed",
+    "fly_speed": "fly_speed",
+    "size": "size",
+    "vision": "vision",
+    "vision_in_darkness": "vision_in_darkness",
+}
+
+# functions computing the unmodified value of each stat from a row of character and ancestry columns
+INITIAL_VALUES = {
+    "AC": lambda row: row.armor_class,
+    "HP": lambda row: row.max_hit_points,
+    "STR": lambda row: row.strength,
+    "DEX": lambda row: row.dexterity,
+    "CON": lambda row: row.constitution,
+    "INT": lambda row: row.intelligence,
+    "WIS": lambda row: row.wisdom,
+    "CHA": lambda row: row.charisma,
+    "speed": lambda row: row.walk_speed,
+    "climb_speed": lambda row: row._climb_speed or int(row.walk_speed / 2),
+    "swim_speed": lambda row: row._swim_speed or int(row.walk_speed / 2),
+    "fly_speed": lambda row: row._fly_speed,
+    "size": lambda row: row.size,
+    "vision": lambda row: row._vision,
+}
+
+
+def _batches(ids):
+    ids = list(ids)
+    for i in range(0, len(ids), BATCH_SIZE):
+        yield ids[i : i + BATCH_SIZE]
+
+
+def _load_characters(character_ids):
+    query = select(
+        Character.id,
+        Character.ancestry_id,
+        Character.armor_class,
+        Character.max_hit_points,
+        Character.strength,
+        Character.dexterity,
+        Character.constitution,
+        Character.intelligence,
+        Character.wisdom,
+        Character.charisma,
+        Character._vision,
+        Ancestry.walk_speed,
+        Ancestry._climb_speed,
+        Ancestry._swim_speed,
+        Ancestry._fly_speed,
+        Ancestry.size,
+    ).join(Ancestry, Character.ancestry_id == Ancestry.id)
+    rows = []
+    for batch in _batches(character_ids):
+        rows.extend(db.session.execute(query.where(Character.id.in_(batch))))
+    return rows
+
+
+def _load_traits(ancestry_ids):
+    traits = defaultdict(list)
+    query = select(AncestryTraitMap.ancestry_id, AncestryTraitMap.ancestry_trait_id).order_by(AncestryTraitMap.id)
+    for batch in _batches(ancestry_ids):
+        for row in db.session.execute(query.where(AncestryTraitMap.ancestry_id.in_(batch))):
+            traits[row.ancestry_id].append(row.ancestry_trait_id)
+    return traits
+
+
+def _load_modifiers(owners):
+    """
+    Return the compiled modifiers of every owner, keyed on (table name, id) and then on target.
+    """
+    query = (
+        select(
+            ModifierMap.primary_table,
+            ModifierMap.primary_table_id,
+            Modifier.target,
+            Modifier.absolute_value,
+            Modifier.relative_value,
+            Modifier.multiply_value,
+            Modifier.new_value,
+        )
+        .join(Modifier, ModifierMap.modifier_id == Modifier.id)
+        .order_by(ModifierMap.id)
+    )
+    by_owner = defaultdict(lambda: defaultdict(list))
+    for table_name, ids in owners.items():
+        for batch in _batches(ids):
+            clause = (ModifierMap.primary_table == modifier_table(table_name)) & ModifierMap.primary_table_id.in_(batch)
+            for row in db.session.execute(query.where(clause)):
+                by_owner[(table_name, row.primary_table_id)][row.target].append(row)
+    return dict(
+        (owner, dict((target, CompiledModifiers.compile(rows)) for target, rows in targets.items()))
+        for owner, targets in by_owner.items()
+    )
+
+
+def evaluate_stats(characters, targets=None):
+    """
+    Evaluate the named stat properties (all of them, by default) for every character in a batch.
+    Characters may be given as Character instances or ids. Returns a dict of dicts, keyed on
+    character id and then on target.
+    """
+    targets = list(targets or STAT_TARGETS)
+    character_ids = set(getattr(char, "id", char) for char in characters)
+    rows = _load_characters(character_ids)
+    ancestry_ids = set(row.ancestry_id for row in rows)
+    traits = _load_traits(ancestry_ids)
+    compiled = _load_modifiers(
+        {
+            Character.__tablename__: character_ids,
+            Ancestry.__tablename__: ancestry_ids,
+            AncestryTrait.__tablename__: set(trait_id for trait_ids in traits.values() for trait_id in trait_ids),
+        }
+    )
+
+    # Merge modifiers per character the same way Character.modifiers does: trait modifiers replace the
+    # ancestry's modifiers for the same target, and the character's own replace both.
+    effective = []
+    for row in rows:
+        merged = dict(compiled.get((Ancestry.__tablename__, row.ancestry_id), {}))
+        for trait_id in traits[row.ancestry_id]:
+            merged.update(compiled.get((AncestryTrait.__tablename__, trait_id), {}))
+        merged.update(compiled.get((Character.__tablename__, row.id), {}))
+        effective.append(merged)
+
+    # apply each target as a column across the whole batch
+    columns = {}
+    for name in set(targets) | ({"vision"} if "vision_in_darkness" in targets else set()):
+        if name not in STAT_TARGETS:
+            raise KeyError(f"{name} is not a Character stat. Valid stats are: {', '.join(STAT_TARGETS)}")
+        if name == "vision_in_darkness":
+            continue
+        initial = map(INITIAL_VALUES[name], rows)
+        target = STAT_TARGETS[name]
+        columns[name] = [mods.get(target, NO_MODIFIERS).apply(val) for mods, val in zip(effective, initial)]
+    if "vision_in_darkness" in targets:
+        columns["vision_in_darkness"] = [
+            mods.get("vision_in_darkness", NO_MODIFIERS).apply(vision if vision is not None else 0)
+            for mods, vision in zip(effective, columns["vision"])
+        ]
+
+    return dict((row.id, dict((name, columns[name][i]) for name in targets)) for i, row in enumerate(rows))
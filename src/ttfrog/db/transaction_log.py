@@ -1,37 +1,384 @@
+"""
+A column-level log of the changes made to rows, so that they can be undone:
+
+    >>> with db.transaction():
+    ...     transaction_log.capture()
+    ...     character.name = "Sabetha"
+    >>> with db.transaction():
+    ...     transaction_log.restore(character)
+    >>> character.name
+    'Sabetha of Waterdeep'
+
+Once capture() has been called, every row the session inserts, updates or deletes is logged until its
+transaction ends. The changes are read from the attribute history SQLAlchemy keeps for each instance
+when it is flushed, so only the columns that changed are logged, and the log is inserted with one
+statement per flush in the same transaction as the changes themselves.
+
+Each entry is keyed on the table and primary key of the row it changed, so finding the latest change
+to a row, or every change to it since some time, is a single indexed lookup. Restoring a row applies
+the old values to that row alone, through the ORM, so the model caches see the change.
+
+Changes to the rows making up a character (see CHARACTER_TABLES) are also keyed on the character, and
+a snapshot of all of those rows is taken on the first change to a character and every SNAPSHOT_INTERVAL
+changes after that. snapshot_at() rebuilds a character as it was at any time from the nearest snapshot
+and the changes between the two, so its cost is bounded by the interval rather than the length of the
+history, and compact() deletes changes older than a time that snapshots have made redundant.
+
+Only models with a single-column integer primary key are logged, and like the caches in ttfrog.db.cache,
+changes made by Core statements are not seen. The old values of columns that were changed without being
+loaded first are read before the flush, with one query per instance.
+"""
+
 import json
-import logging
+import time
+from datetime import datetime
+from functools import cache
+
+from sqlalchemy import Enum, Integer, delete, event, func, insert, inspect, select
+from sqlalchemy.orm.attributes import NO_VALUE
+
+from ttfrog.db.base import serializer
+from ttfrog.db.manager import Session, db
+from ttfrog.db.schema import Character, CharacterClassAttributeMap, CharacterClassMap, CharacterSnapshot, TransactionLog
+from ttfrog.db.schema.modifiers import ModifierMap, modifier_table
+
+INSERT = "insert"
+UPDATE = "update"
+DELETE = "delete"
+
+# the key in Session.info marking a session whose changes are logged
+CAPTURE = "transaction_log"
+
+# the number of changes to a character between snapshots of it
+SNAPSHOT_INTERVAL = 100
+
+# the tables holding the rows that make up a character, and the column of each naming the character
+CHARACTER_TABLES = {
+    Character.__tablename__: "id",
+    CharacterClassMap.__tablename__: "character_id",
+    CharacterClassAttributeMap.__tablename__: "character_id",
+    ModifierMap.__tablename__: "primary_table_id",
+}
+
+# the key in Session.info of the old values read before a flush, keyed on instance state
+UNLOADED = "transaction_log_unloaded"
+
+
+def capture(session=None):
+    """
+    Log the changes made by the session (by default db.session) until its current transaction ends.
+    """
+    (session or db.session).info[CAPTURE] = True
+
+
+@cache
+def _logged_columns(model):
+    """
+    Return the (key, converter) pairs of a model's columns from its serializer, or None if it isn't logged.
+    """
+    mapper = inspect(model)
+    if model is TransactionLog or len(mapper.primary_key) != 1 or not isinstance(mapper.primary_key[0].type, Integer):
+        return None
+    return serializer(model).columns
+
+
+@cache
+def _parsers(model):
+    """
+    Return the functions converting logged values of a model's columns back, keyed on column.
+    """
+    parsers = {}
+    for attr in inspect(model).column_attrs:
+        column_type = attr.columns[0].type
+        if isinstance(column_type, Enum) and column_type.enum_class:
+            parsers[attr.key] = column_type.enum_class
+    return parsers
+
+
+def _character_id(state, value):
+    """
+    Return the id of the character a row belongs to, if it is one of the rows making up a character.
+    """
+    table_name = state.mapper.local_table.name
+    if table_name not in CHARACTER_TABLES:
+        return None
+    if table_name == ModifierMap.__tablename__ and value("primary_table") != modifier_table(Character.__tablename__):
+        return None
+    return value(CHARACTER_TABLES[table_name])
+
+
+def _entry(obj, operation, timestamp, unloaded):
+    columns = _logged_columns(type(obj))
+    if columns is None:
+        return None
+    state = inspect(obj)
+
+    def value(key):
+        return state.dict[key] if key in state.dict else unloaded.get(state, {}).get(key)
+
+    changes = {}
+    for key, convert in columns:
+        if operation == UPDATE:
+            history = state.attrs[key].history
+            if not history.added and not history.deleted:
+                continue
+            old = history.deleted[0] if history.deleted else unloaded.get(state, {}).get(key)
+            new = history.added[0] if history.added else None
+        elif operation == INSERT:
+            if key not in state.dict:
+                continue
+            old, new = None, state.dict[key]
+        else:
+            old, new = value(key), None
+        # enum columns may have been assigned the name of a member rather than the member itself
+        changes[key] = [convert(v) if convert and v is not None and not isinstance(v, str) else v for v in (old, new)]
+    if not changes:
+        return None
+    return dict(
+        source_table_name=state.mapper.local_table.name,
+        primary_key=state.mapper.primary_key_from_instance(obj)[0],
+        character_id=_character_id(state, value),
+        operation=operation,
+        timestamp=timestamp,
+        diff=json.dumps(changes, separators=(",", ":")),
+    )
+
 
-from ttfrog.db.manager import db
-from ttfrog.db.schema import TransactionLog
+@event.listens_for(Session, "before_flush")
+def _flushing(session, flush_context, instances):
+    # Attribute history only has the old value of a column if it was loaded before being changed, and
+    # a deleted row is logged in full, so read any columns that aren't loaded before the flush.
+    if not session.info.get(CAPTURE):
+        return
+    unloaded = {}
+    for obj in list(session.dirty) + list(session.deleted):
+        if _logged_columns(type(obj)) is None:
+            continue
+        state = inspect(obj)
+        if not state.key:
+            continue
+        keys = [
+            attr.key
+            for attr in state.mapper.column_attrs
+            if attr.key not in state.dict or state.committed_state.get(attr.key) is NO_VALUE
+        ]
+        if not keys:
+            continue
+        mapper = state.mapper
+        query = select(*[mapper.column_attrs[key].columns[0] for key in keys]).where(
+            mapper.primary_key[0] == state.key[1][0]
+        )
+        row = session.connection().execute(query).one()
+        unloaded[state] = dict(zip(keys, row))
+    session.info[UNLOADED] = unloaded
 
 
-def record(previous, new):
-    logging.debug(f"{previous = }, {new = }")
-    diff = list((set(previous.items()) ^ set(dict(new).items())))
-    if not diff:
+@event.listens_for(Session, "after_flush")
+def _flushed(session, flush_context):
+    if not session.info.get(CAPTURE):
+        return
+    unloaded = session.info.pop(UNLOADED, {})
+    timestamp = time.time()
+    entries = []
+    for operation, objects in ((INSERT, session.new), (UPDATE, session.dirty), (DELETE, session.deleted)):
+        for obj in objects:
+            entry = _entry(obj, operation, timestamp, unloaded)
+            if entry:
+                entries.append(entry)
+    if not entries:
         return
+    connection = session.connection()
+    connection.execute(insert(TransactionLog), entries)
+    for character_id in sorted(set(entry["character_id"] for entry in entries if entry["character_id"])):
+        _snapshot_if_due(connection, character_id, timestamp)
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _transaction_ended(session, transaction):
+    if transaction.parent is None:
+        session.info.pop(CAPTURE, None)
+
+
+def changes(rec, since=None):
+    """
+    Return a statement selecting the logged changes to a record, newest first, optionally only those made
+    after a time, given as a datetime or a timestamp.
+    """
+    state = inspect(rec)
+    query = (
+        select(TransactionLog)
+        .where(
+            TransactionLog.source_table_name == state.mapper.local_table.name,
+            TransactionLog.primary_key == state.mapper.primary_key_from_instance(rec)[0],
+        )
+        .order_by(TransactionLog.id.desc())
+    )
+    if since is not None:
+        if isinstance(since, datetime):
+            since = since.timestamp()
+        query = query.where(TransactionLog.timestamp > since)
+    return query
 
-    rec = TransactionLog(
-        source_table_name=new.__tablename__,
-        primary_key=new.id,
-        diff=json.dumps(diff),
+
+def undo(entry):
+    """
+    Reverse one logged change to a row, on db.session.
+    """
+    model = db.models[entry.source_table_name]
+    parsers = _parsers(model)
+    values = dict(
+        (key, parsers[key](old) if key in parsers and old is not None else old)
+        for key, (old, new) in entry.changes.items()
     )
-    with db.transaction():
-        db.add(rec)
-        logging.debug(f"Saved restore point: {dict(rec)}")
-        return rec
+    if entry.operation == DELETE:
+        obj = model()
+        for key, value in values.items():
+            setattr(obj, key, value)
+        db.session.add(obj)
+        return entry
+    obj = db.session.get(model, entry.primary_key)
+    if obj is None:
+        return entry
+    if entry.operation == INSERT:
+        db.session.delete(obj)
+    else:
+        for key, value in values.items():
+            setattr(obj, key, value)
+    return entry
 
 
 def restore(rec, log_id=None):
+    """
+    Undo the latest change to a record, or the given log entry, returning the entry undone, if any. Changes
+    are made on db.session, so this should be called inside db.transaction().
+    """
     if log_id:
-        log = db.query(TransactionLog).filter_by(id=log_id).one()
+        entry = db.session.get(TransactionLog, log_id)
     else:
-        log = db.query(TransactionLog).filter_by(source_table_name=rec.__tablename__, primary_key=rec.id).one()
-    logging.debug(f"Located restore point {log = }")
-    diff = json.loads(log.diff)
-    updates = dict(diff[::2])
-    if not updates:
+        entry = db.session.scalars(changes(rec).limit(1)).first()
+    return undo(entry) if entry else None
+
+
+def restore_to(rec, since):
+    """
+    Undo every change to a record made after a time, returning the entries undone, newest first.
+    """
+    entries = db.session.scalars(changes(rec, since=since)).all()
+    for entry in entries:
+        undo(entry)
+    return entries
+
+
+def _character_rows(connection, character_id):
+    """
+    Read the rows making up a character, as {table name: {primary key: row}}.
+    """
+    rows = {}
+    for table_name, column in CHARACTER_TABLES.items():
+        model = db.models[table_name]
+        serialize = serializer(model)
+        query = serialize.select().where(getattr(model, column) == character_id)
+        if model is ModifierMap:
+            query = query.where(ModifierMap.primary_table == modifier_table(Character.__tablename__))
+        rows[table_name] = dict((row["id"], row) for row in map(serialize.row, connection.execute(query)))
+    return rows
+
+
+def _snapshot_if_due(connection, character_id, timestamp):
+    last_log_id = connection.execute(
+        select(func.max(CharacterSnapshot.log_id)).where(CharacterSnapshot.character_id == character_id)
+    ).scalar()
+    count, log_id = connection.execute(
+        select(func.count(), func.max(TransactionLog.id)).where(
+            TransactionLog.character_id == character_id, TransactionLog.id > (last_log_id or 0)
+        )
+    ).one()
+    if last_log_id is not None and count < SNAPSHOT_INTERVAL:
         return
-    logging.debug(f"{updates = }")
-    with db.transaction():
-        db.query(db.tables[log.source_table_name]).update(updates)
+    rows = _character_rows(connection, character_id)
+    connection.execute(
+        insert(CharacterSnapshot).values(
+            character_id=character_id,
+            timestamp=timestamp,
+            log_id=log_id,
+            data=json.dumps(dict((name, list(rows[name].values())) for name in rows), separators=(",", ":")),
+        )
+    )
+
+
+def _apply(rows, entry, reverse=False):
+    """
+    Apply a logged change to rows read by _character_rows(), or reverse it.
+    """
+    table = rows.setdefault(entry.source_table_name, {})
+    values = dict((key, change[0 if reverse else 1]) for key, change in entry.changes.items())
+    operation = entry.operation
+    if reverse and operation != UPDATE:
+        operation = DELETE if operation == INSERT else INSERT
+    if operation == INSERT:
+        table[entry.primary_key] = values
+    elif operation == DELETE:
+        table.pop(entry.primary_key, None)
+    elif entry.primary_key in table:
+        table[entry.primary_key].update(values)
+
+
+def snapshot_at(character, timestamp):
+    """
+    Return the rows making up a character as they were at a time, given as a datetime or a timestamp, as
+    {table name: {primary key: row}}, with rows in the form of db.dump().
+
+    The latest snapshot taken at or before the time is brought forward by the changes made since; a time
+    before the first snapshot is reached by reversing the changes from the first snapshot back. Times
+    before compact() was last run are only as precise as the snapshots it kept.
+    """
+    if isinstance(timestamp, datetime):
+        timestamp = timestamp.timestamp()
+    character_id = character.id if isinstance(character, Character) else character
+    snapshots = select(CharacterSnapshot).where(CharacterSnapshot.character_id == character_id)
+    log = select(TransactionLog).where(TransactionLog.character_id == character_id)
+
+    snapshot = db.session.scalars(
+        snapshots.where(CharacterSnapshot.timestamp <= timestamp)
+        .order_by(CharacterSnapshot.timestamp.desc(), CharacterSnapshot.id.desc())
+        .limit(1)
+    ).first()
+    if snapshot:
+        rows = snapshot.rows
+        changes = log.where(TransactionLog.id > snapshot.log_id, TransactionLog.timestamp <= timestamp)
+        for entry in db.session.scalars(changes.order_by(TransactionLog.id)):
+            _apply(rows, entry)
+        return rows
+
+    snapshot = db.session.scalars(snapshots.order_by(CharacterSnapshot.id).limit(1)).first()
+    if not snapshot:
+        # nothing has been logged, so the character is as it was
+        return _character_rows(db.session.connection(), character_id)
+    rows = snapshot.rows
+    changes = log.where(TransactionLog.id <= snapshot.log_id, TransactionLog.timestamp > timestamp)
+    for entry in db.session.scalars(changes.order_by(TransactionLog.id.desc())):
+        _apply(rows, entry, reverse=True)
+    return rows
+
+
+def compact(before, session=None):
+    """
+    Delete the logged changes to characters made before a time that are older than the latest snapshot of
+    each character taken before it, returning the number of changes deleted. Times before then can only be
+    rebuilt as of one of the snapshots.
+    """
+    if isinstance(before, datetime):
+        before = before.timestamp()
+    session = session or db.session
+    latest = (
+        select(func.max(CharacterSnapshot.log_id))
+        .where(CharacterSnapshot.character_id == TransactionLog.character_id, CharacterSnapshot.timestamp < before)
+        .scalar_subquery()
+    )
+    result = session.execute(
+        delete(TransactionLog).where(
+            TransactionLog.character_id.is_not(None), TransactionLog.timestamp < before, TransactionLog.id <= latest
+        ),
+        execution_options=dict(synchronize_session=False),
+    )
+    return result.rowcount
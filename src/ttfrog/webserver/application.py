@@ -1,26 +1,159 @@
 import logging
+import os
+import signal
+import socket
+import sys
+import time
 from wsgiref.simple_server import make_server
 
 from pyramid.config import Configurator
+from pyramid.tweens import INGRESS
+from pyramid_sqlalchemy import init_sqlalchemy
 
+from ttfrog.db import cache, querystats
 from ttfrog.db.manager import db
 from ttfrog.webserver.routes import routes
+from ttfrog.webserver.tweens import query_stats_enabled
+
+# the least time, in seconds, between starting a worker and starting another in its place
+RESPAWN_DELAY = 1.0
 
 
 def configuration():
-    config = Configurator(settings={"sqlalchemy.url": db.url, "jinja2.directories": "ttfrog.assets:templates/"})
+    config = Configurator(settings={"jinja2.directories": "ttfrog.assets:templates/"})
     config.include("pyramid_tm")
-    config.include("pyramid_sqlalchemy")
     config.include("pyramid_jinja2")
     config.add_static_view(name="/static", path="ttfrog.assets:static/")
     config.add_jinja2_renderer(".html", settings_prefix="jinja2.")
 
+    # Bind the scoped session to the database manager's engine, so that the web application and the
+    # rest of TableTop Frog share one connection pool.
+    init_sqlalchemy(db.engine)
+
+    # outermost, so that the statements run by pyramid_tm when the transaction ends are counted too
+    if query_stats_enabled():
+        querystats.install(db.engine)
+        config.add_tween("ttfrog.webserver.tweens.query_stats_tween_factory", under=INGRESS)
+
     return config
 
 
-def start(host: str, port: int, debug: bool = False) -> None:
-    logging.debug(f"Configuring webserver with {host=}, {port=}, {debug=}")
+def application():
     config = configuration()
     config.include(routes)
     config.scan("ttfrog.webserver.views")
-    make_server(host, int(port), config.make_wsgi_app()).serve_forever()
+    return config.make_wsgi_app()
+
+
+def start(
+    host: str,
+    port: int,
+    debug: bool = False,
+    production: bool = False,
+    workers: int = 1,
+    threads: int = 4,
+    backlog: int = 1024,
+    connection_limit: int = 100,
+    channel_timeout: int = 120,
+) -> None:
+    logging.debug(f"Configuring webserver with {host=}, {port=}, {debug=}, {production=}")
+    app = application()
+    if not production:
+        make_server(host, int(port), app).serve_forever()
+        return
+    serve(
+        app,
+        host,
+        port,
+        workers=workers,
+        threads=threads,
+        backlog=backlog,
+        connection_limit=connection_limit,
+        channel_timeout=channel_timeout,
+    )
+
+
+def serve(app, host: str, port: int, workers: int = 1, **adjustments) -> None:
+    """
+    Serve the application with waitress from one or more worker processes sharing a single listening
+    socket. Each worker handles requests on a pool of threads; adjustments are passed to waitress:
+
+        threads          - request threads per worker
+        backlog          - the size of the queue of connections waiting to be accepted
+        connection_limit - the maximum number of open connections per worker
+        channel_timeout  - seconds an idle keep-alive connection is held open
+
+    SIGTERM and SIGINT stop the workers from accepting new connections and give in-flight requests a
+    few seconds to complete before exiting. With more than one worker, the workers are forked from a
+    master process that replaces any worker that exits until it is told to stop.
+    """
+    sock = socket.create_server((host, int(port)), backlog=adjustments.get("backlog", 1024))
+    logging.info(f"Serving on http://{host}:{port} with {workers} worker(s) and {adjustments}")
+
+    if workers <= 1:
+        _serve_worker(app, sock, adjustments)
+        return
+
+    # let every worker see the cache invalidations made by the others
+    cache.share_versions()
+
+    children = {}
+    for _ in range(workers):
+        children[_fork_worker(app, sock, adjustments)] = time.monotonic()
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        started = children.pop(pid, None)
+        if started is None or stopping:
+            continue
+        logging.warning(f"Worker {pid} exited with status {os.waitstatus_to_exitcode(status)}; starting another")
+        # a worker failing as soon as it starts would otherwise be restarted as fast as it can fail
+        if time.monotonic() - started < RESPAWN_DELAY:
+            time.sleep(RESPAWN_DELAY)
+        if not stopping:
+            children[_fork_worker(app, sock, adjustments)] = time.monotonic()
+    sock.close()
+
+
+def _fork_worker(app, sock, adjustments):
+    """
+    Fork a worker process serving from the listening socket, returning its pid.
+    """
+    pid = os.fork()
+    if pid == 0:  # pragma: no cover
+        # workers forked after the master installed its own handler must not inherit it
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        try:
+            _serve_worker(app, sock, adjustments)
+        finally:
+            os._exit(0)
+    return pid
+
+
+def _serve_worker(app, sock, adjustments):
+    from waitress.server import create_server
+
+    # pooled connections must never be shared between processes
+    db.engine.dispose(close=False)
+
+    # waitress finishes in-flight requests when the run loop exits on SystemExit
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    server = create_server(app, sockets=[sock], **adjustments)
+    logging.debug(f"Worker {os.getpid()} accepting connections")
+    server.run()
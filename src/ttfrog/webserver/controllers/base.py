@@ -1,19 +1,32 @@
 import logging
 import re
 from collections import defaultdict
+from typing import NamedTuple
 
 from pyramid.httpexceptions import HTTPFound
 from pyramid.interfaces import IRoutesMapper
+from sqlalchemy import func, select
 
+from ttfrog.db import cache, transaction_log
+from ttfrog.db.base import slug_uri
+from ttfrog.db.cache import ModelCache
 from ttfrog.db.manager import db
 
+# the number of records listed on each page of the record index
+PAGE_SIZE = 100
 
-def get_all_routes(request):
+record_counts = ModelCache()
+
+
+def route_prefixes(registry):
+    """
+    Map the name of every route to the fixed prefix of its pattern, for building URLs in templates.
+    """
     routes = {
         "static": "/static",
     }
     uri_pattern = re.compile(r"^([^\{\*]+)")
-    mapper = request.registry.queryUtility(IRoutesMapper)
+    mapper = registry.queryUtility(IRoutesMapper)
     for route in mapper.get_routes():
         if route.name.startswith("__"):
             continue
@@ -23,10 +36,109 @@ def get_all_routes(request):
     return routes
 
 
+def cache_route_prefixes(event):
+    """
+    ApplicationCreated subscriber storing the route prefixes on the registry, once every route is configured.
+    """
+    event.app.registry.route_prefixes = route_prefixes(event.app.registry)
+
+
+def get_all_routes(request):
+    prefixes = getattr(request.registry, "route_prefixes", None)
+    if prefixes is None:
+        prefixes = request.registry.route_prefixes = route_prefixes(request.registry)
+    return prefixes
+
+
+class RecordIndexEntry(NamedTuple):
+    id: int
+    slug: str
+    name: str
+
+    @property
+    def uri(self):
+        return slug_uri(self.slug, self.name)
+
+
+class RecordIndex:
+    """
+    One page of a model's records, ordered by id and loading only the columns needed to link to
+    them. Pages are selected by the id of the last record on the previous page, so the cost of
+    loading a page does not grow with the size of the table.
+    """
+
+    def __init__(self, model, after=0, page_size=PAGE_SIZE):
+        self.model = model
+        query = select(model.id, model.slug, model.name).where(model.id > after).order_by(model.id).limit(page_size + 1)
+        self.records = [RecordIndexEntry(*row) for row in db.session.execute(query)]
+        self.next_page = None
+        if len(self.records) > page_size:
+            self.records = self.records[:page_size]
+            self.next_page = self.records[-1].id
+
+    @property
+    def count(self):
+        """
+        The total number of records, cached until the table is next modified.
+        """
+        return record_counts.get(
+            self.model, "count", lambda: db.session.execute(select(func.count(self.model.id))).scalar()
+        )
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __len__(self):
+        return len(self.records)
+
+
+class TemplateContext:
+    """
+    The c object templates are rendered with. Each of the controller's template values is resolved the
+    first time the template reads it and kept in a slot for the rest of the render, so that a template
+    which never touches the record index, say, never queries for it. Any other values are given as
+    keyword arguments; those named like a template value replace it.
+
+    Controllers with values of their own use a subclass declaring them as further slots.
+    """
+
+    __slots__ = ("_controller", "_extra", "config", "request", "form", "record", "routes", "resources", "record_index")
+
+    # the names of the template values, which are the public slots of the class and its bases
+    values = frozenset(name for name in __slots__ if not name.startswith("_"))
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.values = cls.values.union(name for name in cls.__slots__ if not name.startswith("_"))
+
+    def __init__(self, controller, **extra):
+        self._controller = controller
+        self._extra = extra
+        for name in self.values.intersection(extra):
+            setattr(self, name, extra.pop(name))
+
+    def __getattr__(self, name):
+        # only called for values that haven't been resolved yet, and for names that aren't slots at all
+        if name in self.values:
+            value = getattr(self._controller, name)
+            setattr(self, name, value)
+            return value
+        try:
+            return self._extra[name]
+        except KeyError:
+            raise AttributeError(f"{type(self).__name__} has no value {name!r}")
+
+
 class BaseController:
     model = None
     model_form = None
 
+    # the loading profile used to load the controller's record; see ttfrog.db.loading
+    profile = None
+
+    # the class of the c object templates are rendered with
+    context_class = TemplateContext
+
     def __init__(self, request):
         self.request = request
         self.attrs = defaultdict(str)
@@ -48,7 +160,7 @@ class BaseController:
     def record(self):
         if not self._record and self.model:
             try:
-                self._record = db.query(self.model).filter(self.model.slug == self.slug)[0]
+                self._record = db.query(self.model, profile=self.profile).filter(self.model.slug == self.slug)[0]
             except IndexError:
                 logging.warning(f"Could not load record with slug {self.slug}")
                 self._record = self.model()
@@ -76,21 +188,25 @@ class BaseController:
             {"type": "style", "uri": "css/styles.css"},
         ]
 
+    @property
+    def record_index(self):
+        if not self.model:
+            return
+        try:
+            after = int(self.request.params.get("after", 0))
+        except ValueError:
+            after = 0
+        return RecordIndex(self.model, after=after)
+
     def configure_for_model(self):
-        if "all_records" not in self.attrs:
-            self.attrs["all_records"] = db.query(self.model).all()
-
-    def template_context(self, **kwargs) -> dict:
-        return dict(
-            config=self.config,
-            request=self.request,
-            form=self.form,
-            record=self.record,
-            routes=get_all_routes(self.request),
-            resources=self.resources,
-            **self.attrs,
-            **kwargs,
-        )
+        pass
+
+    @property
+    def routes(self):
+        return get_all_routes(self.request)
+
+    def template_context(self, **kwargs) -> TemplateContext:
+        return self.context_class(self, **self.attrs, **kwargs)
 
     def populate(self):
         self.form.populate_obj(self.record)
@@ -118,13 +234,14 @@ class BaseController:
         if not self.validate():
             return
         logging.debug(f"{self.form.data = }")
-        # previous = dict(self.record)
         logging.debug(f"{self.record = }")
         self.populate()
-        # transaction_log.record(previous, self.record)
         with db.transaction():
-            db.add(self.record)
+            transaction_log.capture()
+            db.session.add(self.record)
             self.save_callback()
+            if self.record.id:
+                cache.invalidate_row(self.model, self.record.id, session=db.session)
             logging.debug(f"Saved {self.record = }")
             location = self.request.current_route_path()
             if self.record.slug not in location:
@@ -136,12 +253,16 @@ class BaseController:
         if not self.record.id:
             return
         with db.transaction():
-            db.query(self.model).filter_by(id=self.record.id).delete()
+            # deleted through the session, so that the rows it cascades to are deleted and logged with it
+            transaction_log.capture()
+            cache.invalidate_row(self.model, self.record.id, session=db.session)
+            db.session.delete(self.record)
             location = self.request.current_route_path()
             return HTTPFound(location=location)
 
     def response(self):
-        if not self.form:
+        # only a POST saves or deletes, so other requests needn't build the form to find that out
+        if self.request.method != "POST" or not self.form:
             return
         elif self.form.save.data:
             return self.save()
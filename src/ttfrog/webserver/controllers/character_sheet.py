@@ -1,6 +1,9 @@
 import logging
 
 from markupsafe import Markup
+from pyramid.httpexceptions import HTTPNotModified
+from pyramid.renderers import render
+from sqlalchemy import select
 from wtforms import ValidationError
 from wtforms.fields import FieldList, FormField, HiddenField, SelectField, SelectMultipleField, SubmitField
 from wtforms.validators import Optional
@@ -10,20 +13,24 @@ from wtforms_alchemy import ModelForm
 
 from ttfrog.db.base import STATS
 from ttfrog.db.manager import db
-from ttfrog.db.schema import (
-    Ancestry,
-    Character,
-    CharacterClass,
-    CharacterClassAttributeMap,
-    CharacterClassMap,
-    ClassAttributeOption,
-)
-from ttfrog.webserver.controllers.base import BaseController
+from ttfrog.db.schema import Ancestry, Character, CharacterClass, CharacterClassAttributeMap, CharacterClassMap
+from ttfrog.webserver.controllers.base import BaseController, TemplateContext
 from ttfrog.webserver.forms import DeferredSelectField, NullableDeferredSelectField
+from ttfrog.webserver.sheet_cache import sheet_version, sheets
 
 VALID_LEVELS = range(1, 21)
 
 
+def instance_of(model, obj):
+    """
+    Return obj if it is an instance of model, and otherwise look it up by primary key. Records loaded by
+    the controller's loading profile are returned from the session without querying the database.
+    """
+    if obj is None or isinstance(obj, model):
+        return obj
+    return db.session.get(model, obj)
+
+
 class ClassAttributeWidget:
     def __call__(self, field, **kwargs):
         kwargs.setdefault("id", field.id)
@@ -44,9 +51,12 @@ class ClassAttributesFormField(FormField):
 
     def process(self, *args, **kwargs):
         super().process(*args, **kwargs)
-        self.character_class_map = db.query(CharacterClassAttributeMap).get(self.data["id"])
+        self.character_class_map = self.form.attribute_map or instance_of(CharacterClassAttributeMap, self.data["id"])
         if self.character_class_map:
-            self.label.text = self.character_class_map.character_class.name
+            character = instance_of(Character, self.character_class_map.character_id)
+            character_class = character.class_granting(self.character_class_map.class_attribute)
+            if character_class:
+                self.label.text = character_class.name
 
 
 class ClassAttributesForm(ModelForm):
@@ -58,12 +68,12 @@ class ClassAttributesForm(ModelForm):
     def __init__(self, formdata=None, obj=None, prefix=None):
         if obj:
             logging.debug(f"Loading existing attribute {self = } {formdata = } {obj = }")
-            obj = db.query(CharacterClassAttributeMap).get(obj)
+            obj = instance_of(CharacterClassAttributeMap, obj)
         super().__init__(formdata=formdata, obj=obj, prefix=prefix)
 
+        self.attribute_map = obj
         if obj:
-            options = db.query(ClassAttributeOption).filter_by(attribute_id=obj.class_attribute.id)
-            self.option_id.choices = [(rec.id, rec.name) for rec in options.all()]
+            self.option_id.choices = [(rec.id, rec.name) for rec in obj.class_attribute.options]
 
 
 class MulticlassForm(ModelForm):
@@ -81,7 +91,7 @@ class MulticlassForm(ModelForm):
         """
         logging.debug(f"Loading existing class {self = } {formdata = } {obj = }")
         if obj:
-            obj = db.query(CharacterClassMap).get(obj)
+            obj = instance_of(CharacterClassMap, obj)
         super().__init__(formdata=formdata, obj=obj, prefix=prefix)
 
 
@@ -103,9 +113,23 @@ class CharacterForm(ModelForm):
     saving_throws = SelectMultipleField("Saving Throws", validate_choice=True, choices=STATS)
 
 
+class SheetContext(TemplateContext):
+    __slots__ = ("sheet",)
+
+
 class CharacterSheet(BaseController):
+    """
+    The sheet profile loads the record's class and attribute maps along with their classes, attributes
+    and options, so that the multiclass and class attribute subforms are built without further queries.
+
+    The rendered sheet is cached, and GETs of a page the client already has are answered with 304 Not
+    Modified without loading the record; see ttfrog.webserver.sheet_cache.
+    """
+
     model = CharacterForm.Meta.model
     model_form = CharacterForm
+    profile = "sheet"
+    context_class = SheetContext
 
     @property
     def resources(self):
@@ -113,6 +137,47 @@ class CharacterSheet(BaseController):
             {"type": "script", "uri": "js/character_sheet.js"},
         ]
 
+    @property
+    def cacheable(self):
+        return self.request.method == "GET" and bool(self.slug)
+
+    @property
+    def sheet(self):
+        """
+        The sheet rendered as HTML, from the cache if it is current.
+        """
+        if self.cacheable:
+            cached = sheets.get(self.slug)
+            if cached:
+                self.set_etag()
+                return Markup(cached.html)
+        # The version is read before the record is loaded, so that a change saved in between leaves the
+        # cached sheet out of date, rather than caching the sheet as it was under the new version.
+        character_id = version = None
+        if self.cacheable and self._record is None:
+            character_id = db.session.scalar(select(Character.id).where(Character.slug == self.slug))
+            version = sheet_version(character_id) if character_id else None
+        html = render("sheet.html", {"c": TemplateContext(self)}, request=self.request)
+        if version:
+            sheets.put(self.slug, character_id, version, html)
+            self.set_etag()
+        return Markup(html)
+
+    def etag(self):
+        return sheets.etag(self.slug, self.request.query_string) if self.cacheable else None
+
+    def set_etag(self):
+        etag = self.etag()
+        if etag:
+            self.request.response.etag = etag
+            self.request.response.cache_control = "no-cache"
+
+    def response(self):
+        etag = self.etag()
+        if etag and etag in self.request.if_none_match:
+            return HTTPNotModified(etag=etag)
+        return super().response()
+
     def validate_callback(self):
         """
         Validate multiclass fields in form data.
@@ -140,9 +205,8 @@ class CharacterSheet(BaseController):
         # step through the list of class mappings for this character
         for class_name, class_def in self.record.classes.items():
             logging.error(f"{class_name = }, {class_def = }")
-            for level in range(1, self.record.levels[class_name] + 1):
-                for attr in class_def.attributes_by_level.get(level, None):
-                    self.record.add_class_attribute(attr, attr.options[0])
+            for attr in class_def.attributes_up_to(self.record.levels[class_name]).values():
+                self.record.add_class_attribute(attr, attr.options[0])
 
     def save_callback(self):
         #  self.add_class_attributes()
@@ -1,21 +1,203 @@
 from pyramid.httpexceptions import exception_response
+from pyramid.response import Response
+from sqlalchemy import select, tuple_
+from sqlalchemy.orm import Session
 
-from ttfrog.db import schema
-from ttfrog.db.manager import db
+from ttfrog.db.loading import profile_options
+from ttfrog.db.manager import AlchemyEncoder, db
+from ttfrog.db.registry import tables
 
 from .base import BaseController
 
+# the default and maximum number of records in one page of JSON
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# the number of rows fetched from the cursor and written to the response at once when streaming
+STREAM_BATCH_SIZE = 1000
+
+# the maximum depth of relationships included in each record
+MAX_DEPTH = 2
+
+FORMATS = ["json", "ndjson"]
+
+# query parameters that are not filters on the table's columns
+RESERVED_PARAMS = ["limit", "after", "fields", "format", "depth"]
+
+
+def _int_param(params, name, default, minimum=None):
+    try:
+        value = int(params.get(name, default))
+    except ValueError:
+        raise exception_response(400, detail=f"{name} must be an integer.")
+    if minimum is not None and value < minimum:
+        raise exception_response(400, detail=f"{name} must be at least {minimum}.")
+    return value
+
 
 class JsonData(BaseController):
+    """
+    The records of one table, named by table or model name, as JSON, optionally filtered on column values:
+
+        /_/Character?slug=G7TyA                 records matching the filter
+        /_/Character?fields=id,name&limit=10    the ids and names of the first ten records
+        /_/Character?after=10                   the page of records following the record with id 10
+        /_/ClassAttributeMap?after=1,2          the same, for a table with a composite primary key
+        /_/Character?format=ndjson              every record, streamed one per line
+        /_/Character?depth=1                    records including their ancestry, class_map and so on
+
+    Filters must include a column that is indexed (see ttfrog.db.registry), so that no request can make
+    the database scan a whole table to find the records matching it.
+
+    JSON responses are a page of at most limit records, ordered by primary key, with the key to request the
+    next page after.
+    NDJSON responses are unlimited by default, and are streamed from the database cursor in batches
+    so that exporting a whole table runs in bounded memory.
+
+    By default records are selected as rows of column values. With a depth, records are loaded along
+    with their relationships by the json loading profile, and serialized with BaseObject.__json__.
+    """
+
     model = None
     model_form = None
+    table = None
 
     def configure_for_model(self):
-        try:
-            self.model = getattr(schema, self.request.matchdict.get("table_name"))
-        except AttributeError:
+        self.table = tables.get(self.request.matchdict.get("table_name"))
+        if not self.table:
             raise exception_response(404)
+        self.model = self.table.model
+
+    @property
+    def fields(self):
+        columns = list(self.table.columns)
+        fields = self.request.params.get("fields")
+        if not fields:
+            return columns
+        fields = [name.strip() for name in fields.split(",") if name.strip()]
+        invalid = [name for name in fields if name not in columns]
+        if invalid:
+            raise exception_response(400, detail=f"{self.model.__name__} has no column(s) {', '.join(invalid)}")
+        return fields
+
+    @property
+    def filters(self):
+        filters = dict((key, val) for key, val in self.request.params.items() if key not in RESERVED_PARAMS)
+        invalid = [key for key in filters if key not in self.table.columns]
+        if invalid:
+            raise exception_response(400, detail=f"Cannot filter {self.model.__name__} on {', '.join(invalid)}")
+        if filters and self.table.indexed.isdisjoint(filters):
+            raise exception_response(
+                400,
+                detail=(
+                    f"Cannot filter {self.model.__name__} on {', '.join(filters)} alone, since none of them are "
+                    f"indexed; filter on one of {', '.join(sorted(self.table.indexed))} as well"
+                ),
+            )
+        return filters
+
+    @property
+    def depth(self):
+        return min(_int_param(self.request.params, "depth", 0, minimum=0), MAX_DEPTH)
+
+    @property
+    def after(self):
+        """
+        The primary key of the record to start after, or None. A composite key is given as its values
+        separated by commas, in the order of the key's columns.
+        """
+        after = self.request.params.get("after")
+        if after is None:
+            return None
+        key = self.table.primary_key
+        try:
+            values = tuple(int(value) for value in after.split(","))
+        except ValueError:
+            values = ()
+        if len(values) != len(key):
+            raise exception_response(400, detail=f"after must be the {', '.join(key)} of a record.")
+        return values
+
+    def cursor(self, record):
+        """
+        The value of after requesting the page following a record.
+        """
+        values = [getattr(record, name) for name in self.table.primary_key]
+        return values[0] if len(values) == 1 else ",".join(str(value) for value in values)
+
+    def query(self, fields, limit=None):
+        key = [getattr(self.model, name) for name in self.table.primary_key]
+        if self.depth:
+            query = select(self.model).options(*profile_options("json", self.model, depth=self.depth))
+        else:
+            query = select(*[getattr(self.model, name) for name in fields])
+        query = query.filter_by(**self.filters).order_by(*key)
+        after = self.after
+        if after:
+            query = query.where(key[0] > after[0] if len(key) == 1 else tuple_(*key) > tuple_(*after))
+        if limit is not None:
+            query = query.limit(limit)
+        return query
+
+    def serialize(self, records, fields):
+        """
+        Convert records, which are either rows of column values or model instances, to dicts.
+        """
+        if not self.depth:
+            return [dict((name, getattr(row, name)) for name in fields) for row in records]
+        omitted = set(self.table.columns).difference(fields)
+        results = []
+        for record in records:
+            values = record.__json__(depth=self.depth)
+            for name in omitted:
+                values.pop(name, None)
+            results.append(values)
+        return results
 
     def response(self):
-        query = db.query(self.model).filter_by(**self.request.params)
-        return {"table_name": self.model.__tablename__, "records": query.all()}
+        output = self.request.params.get("format", "json")
+        if output not in FORMATS:
+            raise exception_response(
+                400, detail=f"Unsupported format {output}; valid formats are: {', '.join(FORMATS)}"
+            )
+        if output == "ndjson":
+            return self.stream()
+
+        limit = min(_int_param(self.request.params, "limit", PAGE_SIZE, minimum=1), MAX_PAGE_SIZE)
+        fields = self.fields
+        # the key of the last record is the cursor for the next page, so select it even if it wasn't asked for
+        selected = [name for name in self.table.primary_key if name not in fields] + fields
+        result = db.session.execute(self.query(selected, limit=limit + 1))
+        records = (result.scalars() if self.depth else result).all()
+        next_page = None
+        if len(records) > limit:
+            records = records[:limit]
+            next_page = self.cursor(records[-1])
+        return {
+            "table_name": self.model.__tablename__,
+            "records": self.serialize(records, fields),
+            "next": next_page,
+        }
+
+    def stream(self):
+        limit = None
+        if "limit" in self.request.params:
+            limit = _int_param(self.request.params, "limit", None, minimum=1)
+        query = self.query(self.fields, limit=limit)
+        return Response(
+            app_iter=self._ndjson(query),
+            content_type="application/x-ndjson",
+            charset="utf-8",
+        )
+
+    def _ndjson(self, query):
+        # The response is written after the view has returned and the request's transaction has ended,
+        # so the rows are read from a connection of their own rather than through the session.
+        encoder = AlchemyEncoder()
+        fields = self.fields
+        with db.engine.connect() as conn, Session(bind=conn) as session:
+            result = session.execute(query, execution_options=dict(yield_per=STREAM_BATCH_SIZE))
+            if self.depth:
+                result = result.scalars()
+            for records in result.partitions():
+                yield "".join(encoder.encode(rec) + "\n" for rec in self.serialize(records, fields)).encode("utf-8")
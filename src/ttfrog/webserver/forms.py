@@ -1,18 +1,36 @@
 from wtforms.fields import SelectField, SelectMultipleField
 
+from ttfrog.db.cache import ModelCache
 from ttfrog.db.manager import db
 
+choices_cache = ModelCache()
+
+
+def model_choices(model):
+    """
+    Return (id, name) choices for every record of a model. The choices are shared by all forms and
+    requests, and are reloaded only after the model's table has been modified.
+    """
+
+    def load():
+        return [
+            (rec.id, rec.name if hasattr(rec, "name") else str(rec))
+            for rec in db.query(model, profile="list").order_by(model.id)
+        ]
+
+    return list(choices_cache.get(model, "choices", load))
+
 
 class DeferredSelectMultipleField(SelectMultipleField):
     def __init__(self, *args, model=None, **kwargs):
         super().__init__(*args, **kwargs)
-        self.choices = [(rec.id, rec.name) for rec in db.query(model).all()]
+        self.choices = model_choices(model)
 
 
 class DeferredSelectField(SelectField):
     def __init__(self, *args, model=None, **kwargs):
         super().__init__(*args, **kwargs)
-        self.choices = [(rec.id, getattr(rec, "name", str(rec))) for rec in db.query(model).all()]
+        self.choices = model_choices(model)
 
 
 class NullableDeferredSelectField(DeferredSelectField):
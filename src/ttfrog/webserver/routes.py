@@ -1,4 +1,8 @@
+from pyramid.events import ApplicationCreated
+
+
 def routes(config):
     config.add_route("index", "/")
     config.add_route("sheet", "/c{uri:.*}", factory="ttfrog.webserver.controllers.CharacterSheet")
     config.add_route("data", "/_/{table_name}{uri:.*}", factory="ttfrog.webserver.controllers.JsonData")
+    config.add_subscriber("ttfrog.webserver.controllers.base.cache_route_prefixes", ApplicationCreated)
@@ -0,0 +1,140 @@
+"""
+Rendered character sheets, cached by slug so that a sheet is rendered again only once something it
+shows has changed. Each sheet is stored along with the version it was rendered from:
+
+    - the version of the character's row, which is also incremented when its class maps, class
+      attribute maps or modifier maps change; see ttfrog.db.cache.row_version
+    - the versions of the rules content tables that every sheet shows or offers as choices, like
+      Ancestry and CharacterClass
+
+A cached sheet is current while its version is; none of this requires a query. Pages built around
+a sheet are identified by an ETag of the sheet's version, the version of the Character table (for the
+list of characters on every page) and the query string, so that a client holding an unchanged page can
+be answered with 304 Not Modified before the database is touched at all.
+
+Like the other caches in ttfrog.db.cache, changes made by Core statements are not seen.
+"""
+
+import threading
+import uuid
+import zlib
+from collections import OrderedDict
+from typing import NamedTuple
+
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+
+from ttfrog.db import cache
+from ttfrog.db.schema import (
+    Ancestry,
+    AncestryTrait,
+    AncestryTraitMap,
+    Character,
+    CharacterClass,
+    CharacterClassAttributeMap,
+    CharacterClassMap,
+    ClassAttribute,
+    ClassAttributeMap,
+    ClassAttributeOption,
+    Modifier,
+)
+from ttfrog.db.schema.modifiers import ModifierMap, modifier_table
+
+# the most sheets kept at once; the least recently used are discarded first
+SHEET_CACHE_SIZE = 1000
+
+# the rules content shown on, or offered as choices by, every sheet
+SHARED_MODELS = [
+    Ancestry,
+    AncestryTrait,
+    AncestryTraitMap,
+    CharacterClass,
+    ClassAttribute,
+    ClassAttributeMap,
+    ClassAttributeOption,
+    Modifier,
+]
+
+# Versions start from zero in every new server, so ETags include a value unique to this one; otherwise a
+# client could hold a page from an earlier server with the same versions but different contents.
+_server_id = uuid.uuid4().hex[:8]
+
+
+def sheet_version(character_id) -> tuple:
+    return (cache.row_version(Character, character_id), *(cache.version(model) for model in SHARED_MODELS))
+
+
+class CachedSheet(NamedTuple):
+    character_id: int
+    version: tuple
+    html: str
+
+
+class SheetCache:
+    def __init__(self, size=SHEET_CACHE_SIZE):
+        self.size = size
+        self._sheets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, slug):
+        """
+        Return the CachedSheet for a slug if there is one and it is still current, or None.
+        """
+        with self._lock:
+            sheet = self._sheets.get(slug)
+            if not sheet:
+                return None
+            if sheet.version != sheet_version(sheet.character_id):
+                del self._sheets[slug]
+                return None
+            self._sheets.move_to_end(slug)
+            return sheet
+
+    def put(self, slug, character_id, version, html):
+        """
+        Cache a sheet rendered from the given version, which should be read before the sheet is rendered.
+        """
+        with self._lock:
+            self._sheets[slug] = CachedSheet(character_id, version, html)
+            self._sheets.move_to_end(slug)
+            while len(self._sheets) > self.size:
+                self._sheets.popitem(last=False)
+
+    def etag(self, slug, query_string=""):
+        """
+        Return the ETag of the page showing the cached sheet for a slug, or None if it isn't cached.
+        """
+        sheet = self.get(slug)
+        if not sheet:
+            return None
+        page = repr((sheet.version, cache.version(Character), query_string))
+        return f"{_server_id}-{slug}-{zlib.crc32(page.encode()):08x}"
+
+    def clear(self):
+        with self._lock:
+            self._sheets.clear()
+
+
+sheets = SheetCache()
+
+
+@event.listens_for(CharacterClassMap, "after_insert")
+@event.listens_for(CharacterClassMap, "after_update")
+@event.listens_for(CharacterClassMap, "after_delete")
+@event.listens_for(CharacterClassAttributeMap, "after_insert")
+@event.listens_for(CharacterClassAttributeMap, "after_update")
+@event.listens_for(CharacterClassAttributeMap, "after_delete")
+def _character_map_changed(mapper, connection, target):
+    cache.invalidate_row(Character, target.character_id, session=object_session(target))
+
+
+@event.listens_for(ModifierMap, "after_insert")
+@event.listens_for(ModifierMap, "after_update")
+@event.listens_for(ModifierMap, "after_delete")
+def _modifier_map_changed(mapper, connection, target):
+    session = object_session(target)
+    if target.primary_table == modifier_table(Character.__tablename__):
+        cache.invalidate_row(Character, target.primary_table_id, session=session)
+    else:
+        # the modifiers of ancestries and their traits are rules content, like the ancestries themselves
+        cache.invalidate(Ancestry, session)
@@ -0,0 +1,33 @@
+import json
+import logging
+import os
+
+from ttfrog.db import querystats
+
+logger = logging.getLogger("ttfrog.querystats")
+
+
+def query_stats_enabled():
+    return bool(os.environ.get("QUERY_STATS") or os.environ.get("DEBUG"))
+
+
+def query_stats_tween_factory(handler, registry):
+    """
+    Collect statistics about the queries run by each request. They are available to templates as
+    request.query_stats while the request is handled, and are added to the response as X-Query-* headers
+    and logged as JSON afterwards.
+    """
+
+    def query_stats_tween(request):
+        with querystats.collect() as stats:
+            request.query_stats = stats
+            response = handler(request)
+        response.headers["X-Query-Count"] = str(stats.count)
+        response.headers["X-Query-Time"] = f"{stats.seconds * 1000:.3f}"
+        response.headers["X-Query-Duplicates"] = str(stats.duplicates)
+        logger.info(
+            json.dumps(dict(method=request.method, path=request.path, status=response.status_code, **stats.as_dict()))
+        )
+        return response
+
+    return query_stats_tween
@@ -1,13 +1,12 @@
 from pyramid.response import Response
 from pyramid.view import view_config
 
-from ttfrog.attribute_map import AttributeMap
 from ttfrog.db.manager import db
 from ttfrog.db.schema import Ancestry
 
 
 def response_from(controller):
-    return controller.response() or AttributeMap.from_dict({"c": controller.template_context()})
+    return controller.response() or {"c": controller.template_context()}
 
 
 @view_config(route_name="index")
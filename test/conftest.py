@@ -1,23 +1,49 @@
 import json
+import logging
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
 from pathlib import Path
 from unittest.mock import MagicMock
 
 import pytest
+from sqlalchemy import event
 
 from ttfrog.db import schema
+from ttfrog.db.bulk import bulk_import
 from ttfrog.db.manager import db as _db
 
 FIXTURE_PATH = Path(__file__).parent / "fixtures"
 
+# Benchmark results are written to latest.json here after every run, and compared with baseline.json if it
+# exists. Set BENCHMARK_SAVE=1 to save the results of a run as the new baseline.
+BENCHMARK_PATH = Path(os.environ.get("BENCHMARK_PATH", Path(__file__).parent.parent / ".benchmarks"))
+
+# how much slower than the baseline a measurement may be before it counts as a regression
+BENCHMARK_TOLERANCE = float(os.environ.get("BENCHMARK_TOLERANCE", 1.5))
+
+# The ttfrog commands whose imports are checked by test_cli_imports, and the most time, in seconds, each may
+# spend importing modules, which is checked with the benchmarks since it depends on the machine running them.
+# {tmp} is a temporary directory, which is also the command's DATA_PATH. serve itself is exempt, since it is
+# the one command that needs the web application, and imports it once to run for as long as the server does.
+CLI_IMPORT_BUDGETS = {
+    "--help": 0.25,
+    "db --help": 0.25,
+    "serve --help": 0.25,
+    "db list": 0.6,
+    "db --root {tmp} setup": 0.6,
+    "db dump -o {tmp}/dump.json": 0.6,
+    "db load {tmp}/dump.json": 0.6,
+    "db compact": 0.6,
+}
+
 
 def load_fixture(db, fixture_name):
     with db.transaction():
         data = json.loads((FIXTURE_PATH / f"{fixture_name}.json").read_text())
-        for schema_name in data:
-            for record in data[schema_name]:
-                print(f"Loading {schema_name} {record = }")
-                obj = getattr(schema, schema_name)(**record)
-                db.session.add(obj)
+        print(f"Loaded {fixture_name}: {bulk_import(data)}")
 
 
 @pytest.fixture(autouse=True)
@@ -30,6 +56,63 @@ def db(monkeypatch):
     _db.metadata.drop_all(bind=_db.engine)
 
 
+@pytest.fixture
+def queries(db):
+    """
+    A list of every SQL statement executed while the fixture is active.
+    """
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+    yield statements
+    event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+
+
+class ImportTimes:
+    """
+    The modules imported by running a command, parsed from the output of python -X importtime, and the
+    total time spent importing them.
+    """
+
+    def __init__(self, stderr):
+        self.modules = {}
+        self.seconds = 0.0
+        for line in stderr.splitlines():
+            if not line.startswith("import time:") or "[us]" in line:
+                continue
+            _, cumulative, name = line.split("|")
+            self.modules[name.strip()] = int(cumulative) / 1e6
+            # nested imports are indented, and already counted by the module that imported them
+            if not name.startswith("  "):
+                self.seconds += int(cumulative) / 1e6
+
+
+@pytest.fixture
+def cli_imports(tmp_path):
+    """
+    A function running a ttfrog command, such as "db list", returning its ImportTimes. A load command is
+    given a dump of the empty database to load.
+    """
+
+    def run(command):
+        if command.startswith("db load"):
+            run("db dump -o {tmp}/dump.json")
+        args = command.format(tmp=tmp_path).split()
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-m", "ttfrog.cli", *args],
+            capture_output=True,
+            text=True,
+            env=dict(os.environ, DATA_PATH=str(tmp_path)),
+        )
+        assert result.returncode == 0, result.stderr[-2000:]
+        return ImportTimes(result.stderr)
+
+    return run
+
+
 @pytest.fixture
 def classes_factory(db):
     load_fixture(db, "classes")
@@ -48,3 +131,121 @@ def ancestries_factory(db):
         return dict((rec.name, rec) for rec in db.session.query(schema.Ancestry).all())
 
     return factory
+
+
+class BenchmarkResults:
+    """
+    The measurements taken by benchmarks in this run, and the baseline they are compared with.
+    """
+
+    def __init__(self, path=BENCHMARK_PATH):
+        self.path = path
+        self.measurements = {}
+        baseline = path / "baseline.json"
+        self.baseline = json.loads(baseline.read_text()) if baseline.exists() else {}
+
+    def regressions(self, name):
+        """
+        Return descriptions of the ways a measurement is worse than its baseline.
+        """
+        current = self.measurements[name]
+        baseline = self.baseline.get(name)
+        if not baseline:
+            return []
+        regressions = []
+        if current["seconds"] > baseline["seconds"] * BENCHMARK_TOLERANCE:
+            regressions.append(
+                f"{name} took {current['seconds']:.6f}s per operation; baseline {baseline['seconds']:.6f}s"
+            )
+        if current["queries"] > baseline["queries"]:
+            regressions.append(f"{name} ran {current['queries']} queries per operation; baseline {baseline['queries']}")
+        if "peak_memory" in baseline and current.get("peak_memory", 0) > baseline["peak_memory"] * BENCHMARK_TOLERANCE:
+            regressions.append(
+                f"{name} used {current['peak_memory']} bytes at peak; baseline {baseline['peak_memory']}"
+            )
+        return regressions
+
+    def save(self):
+        self.path.mkdir(parents=True, exist_ok=True)
+        (self.path / "latest.json").write_text(json.dumps(self.measurements, indent=2, sort_keys=True))
+        if os.environ.get("BENCHMARK_SAVE"):
+            (self.path / "baseline.json").write_text(
+                json.dumps(dict(self.baseline, **self.measurements), indent=2, sort_keys=True)
+            )
+
+
+class Benchmark:
+    """
+    Times operations and counts the queries they run, recording the results under the test's name.
+    """
+
+    def __init__(self, results, queries, prefix):
+        self.results = results
+        self.queries = queries
+        self.prefix = prefix
+
+    def __call__(self, name, func, operations=1, repeat=3, memory=False):
+        """
+        Call func, which performs the given number of operations, repeat times. The best time and the
+        number of queries per operation are recorded, and the test fails if either has regressed. With
+        memory=True, func is called once more while tracing allocations, and the peak memory it used is
+        recorded too.
+        """
+        times = []
+        queries = 0
+        for _ in range(repeat):
+            self.queries.clear()
+            start = time.perf_counter()
+            result = func()
+            times.append(time.perf_counter() - start)
+            queries = len(self.queries)
+        name = f"{self.prefix}.{name}"
+        measurement = {
+            "seconds": min(times) / operations,
+            "per_second": operations / min(times),
+            "queries": queries / operations,
+        }
+        if memory:
+            measurement["peak_memory"] = self.peak_memory(func)
+        self.results.measurements[name] = measurement
+        logging.info(
+            f"{name}: {measurement['seconds'] * 1000:.3f}ms, {measurement['per_second']:.1f}/s, "
+            f"{measurement['queries']:.2f} queries per operation"
+            + (f", {measurement['peak_memory'] / 1024:.1f}KiB peak memory" if memory else "")
+        )
+        regressions = self.results.regressions(name)
+        assert not regressions, "; ".join(regressions)
+        return result
+
+    def peak_memory(self, func):
+        """
+        Return the most memory, in bytes, held at once by allocations made while calling func.
+        """
+        tracemalloc.start()
+        try:
+            func()
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    def seconds(self, name):
+        """
+        Return the time per operation recorded for a measurement taken by this benchmark.
+        """
+        return self.results.measurements[f"{self.prefix}.{name}"]["seconds"]
+
+
+@pytest.fixture(scope="session")
+def benchmark_results():
+    results = BenchmarkResults()
+    yield results
+    if results.measurements:
+        results.save()
+
+
+@pytest.fixture
+def benchmark(request, benchmark_results, queries):
+    """
+    Measure operations against the stored baseline; see Benchmark.
+    """
+    return Benchmark(benchmark_results, queries, request.node.name.replace("test_", "").replace("_benchmark", ""))
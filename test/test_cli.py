@@ -0,0 +1,19 @@
+import pytest
+from conftest import CLI_IMPORT_BUDGETS
+
+# packages only the web application needs
+WEB_PACKAGES = ["pyramid", "pyramid_jinja2", "pyramid_tm", "jinja2", "wtforms", "wtforms_alchemy", "webob", "waitress"]
+
+
+@pytest.mark.parametrize("command", CLI_IMPORT_BUDGETS)
+def test_cli_imports(cli_imports, command):
+    imports = cli_imports(command)
+    assert "typer" in imports.modules
+    assert [name for name in imports.modules if name.split(".")[0] in WEB_PACKAGES] == []
+    if command.endswith("--help"):
+        assert "sqlalchemy" not in imports.modules
+    else:
+        assert "ttfrog.db.schema" in imports.modules
+    if command == "--help":
+        # the callback that loads the environment and configures logging only runs for a command
+        assert [name for name in ("dotenv", "rich.logging") if name in imports.modules] == []
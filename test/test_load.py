@@ -1,16 +1,374 @@
+import logging
+import threading
+import time
+from collections import defaultdict
+
 import pytest
+from conftest import CLI_IMPORT_BUDGETS
+from pyramid.request import Request as PyramidRequest
+from sqlalchemy import insert, select
+from sqlalchemy.orm import Session
+from webob import Request
 
 from ttfrog.db import schema
+from ttfrog.db.base import genslug, slug_uri
+from ttfrog.db.bulk import bulk_import
+from ttfrog.db.loading import profile_options
+from ttfrog.db.manager import SQLITE_PRAGMAS, SQLDatabaseManager
+from ttfrog.db.schema.modifiers import modifier_table, modifiers_changed
+
+# the number of characters in the campaign seeded for benchmarks
+CAMPAIGN_SIZE = 2000
 
 
-@pytest.mark.skip
 def test_many_records(db):
     with db.transaction():
-        for i in range(1, 1000):
-            obj = schema.Ancestry(name=f"{i}-ancestry")
-            db.add_or_update(obj)
-            assert obj.id == i
-
-        for i in range(1, 1000):
-            obj = schema.Character(name=f"{i}-char")
-            db.add_or_update(obj)
+        counts = bulk_import(
+            {
+                "Ancestry": [dict(name=f"{i}-ancestry") for i in range(1, 1000)],
+                "Character": [dict(name=f"{i}-char", ancestry=f"{i}-ancestry") for i in range(1, 1000)],
+            }
+        )
+        assert counts == {"Ancestry": 999, "Character": 999}
+        assert db.Ancestry.filter_by(name="500-ancestry").one().id == 500
+        assert db.Character.filter_by(name="999-char").one().ancestry.name == "999-ancestry"
+
+
+@pytest.mark.benchmark
+def test_evaluate_stats_benchmark(db, ancestries_factory, benchmark):
+    from ttfrog.db.stats import STAT_TARGETS, evaluate_stats
+
+    count = 10000
+    with db.transaction():
+        ancestries = list(ancestries_factory().values())
+        ancestries[0].add_modifier(schema.Modifier(name="Tough", target="max_hit_points", relative_value=5))
+        hasted = schema.Modifier(name="Hasted", target="speed", multiply_value=2.0)
+        db.add_or_update([ancestries[0], hasted])
+        db.session.execute(
+            insert(schema.Character),
+            [
+                dict(name=f"{i}-char", slug=f"b{i}", ancestry_id=ancestries[i % len(ancestries)].id)
+                for i in range(count)
+            ],
+        )
+        db.session.execute(
+            insert(schema.modifiers.ModifierMap),
+            [
+                dict(primary_table=modifier_table("character"), primary_table_id=i, modifier_id=hasted.id)
+                for i in range(1, count + 1, 3)
+            ],
+        )
+
+        def per_object():
+            db.session.expunge_all()
+            return dict(
+                (char.id, dict((name, getattr(char, name)) for name in STAT_TARGETS)) for char in db.Character.all()
+            )
+
+        expected = benchmark("per_object", per_object, operations=count, repeat=1)
+        actual = benchmark("batched", lambda: evaluate_stats(expected.keys()), operations=count, repeat=1)
+        assert actual == expected
+        assert benchmark.seconds("batched") < benchmark.seconds("per_object")
+
+
+def test_read_during_save(tmp_path):
+    manager = SQLDatabaseManager(sqlite_busy_timeout=100)
+    manager.url = f"sqlite:///{tmp_path / 'frog.db'}"
+    manager.metadata.create_all(manager.engine)
+    with Session(manager.engine) as session:
+        session.add(schema.Character(name="sabetha", slug=genslug(), hit_points=10))
+        session.commit()
+
+    # take the lock a rollback journal would need to commit a save, and hold it
+    with manager.engine.connect() as writer:
+        writer.exec_driver_sql("BEGIN EXCLUSIVE")
+        writer.exec_driver_sql("UPDATE character SET hit_points = 5")
+        with Session(manager.engine) as session:
+            sheet = select(schema.Character).options(*profile_options("sheet", schema.Character))
+            assert session.execute(sheet).unique().scalar_one().hit_points == 10
+        writer.exec_driver_sql("COMMIT")
+    manager.engine.dispose()
+
+
+def _read_while_saving(path, settings, readers=4, duration=2.0):
+    """
+    Read character sheets from several threads while another thread repeatedly saves one, returning the
+    read latencies and the number of saves.
+    """
+    manager = SQLDatabaseManager(**settings)
+    manager.url = f"sqlite:///{path}"
+    manager.metadata.create_all(manager.engine)
+    with Session(manager.engine) as session:
+        session.add_all([schema.Character(name=f"{i}-char", slug=genslug()) for i in range(100)])
+        session.commit()
+
+    stop = threading.Event()
+    latencies = []
+    saves = []
+    sheet = select(schema.Character).options(*profile_options("sheet", schema.Character))
+
+    def save():
+        while not stop.is_set():
+            with Session(manager.engine) as session:
+                char = session.get(schema.Character, 1)
+                char.hit_points = char.hit_points % 100 + 1
+                session.flush()
+                # the time a request spends between writing a sheet and committing it
+                time.sleep(0.005)
+                session.commit()
+                saves.append(1)
+
+    def read(offset):
+        i = offset
+        while not stop.is_set():
+            start = time.perf_counter()
+            with Session(manager.engine) as session:
+                session.execute(sheet.where(schema.Character.id == i % 100 + 1)).unique().scalar_one()
+            latencies.append(time.perf_counter() - start)
+            i += readers
+
+    threads = [threading.Thread(target=save)] + [threading.Thread(target=read, args=(i,)) for i in range(readers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    manager.engine.dispose()
+    return sorted(latencies), len(saves)
+
+
+@pytest.mark.benchmark
+def test_read_contention_benchmark(tmp_path):
+    sqlite_defaults = dict((f"sqlite_{name}", "") for name in SQLITE_PRAGMAS)
+    results = {}
+    for name, settings in (("sqlite defaults", sqlite_defaults), ("tuned", {})):
+        latencies, saves = _read_while_saving(tmp_path / f"{len(results)}.db", settings)
+        worst = latencies[-1] * 1000
+        p99 = latencies[int(len(latencies) * 0.99)] * 1000
+        logging.info(f"{name}: {len(latencies)} reads, {saves} saves, p99 {p99:.1f}ms, max {worst:.1f}ms")
+        results[name] = (len(latencies), saves)
+
+    # in WAL mode a save never waits for readers to finish before committing, nor readers for the save
+    assert results["tuned"][1] > results["sqlite defaults"][1]
+
+
+@pytest.mark.benchmark
+def test_json_serialization_benchmark(db, ancestries_factory, benchmark):
+    count = 5000
+    with db.transaction():
+        ancestries = list(ancestries_factory().values())
+        db.session.execute(
+            insert(schema.Character),
+            [
+                dict(name=f"{i}-char", slug=f"b{i}", ancestry_id=ancestries[i % len(ancestries)].id)
+                for i in range(count)
+            ],
+        )
+        characters = db.query(schema.Character, profile="json").all()
+
+        benchmark("dict", lambda: [dict(char) for char in characters], operations=count)
+        benchmark("json", lambda: [char.__json__(depth=1) for char in characters], operations=count)
+        assert benchmark.seconds("json") < benchmark.seconds("dict")
+
+
+def campaign_data(characters=CAMPAIGN_SIZE):
+    """
+    Return the records of a campaign with the given number of characters, for bulk_import(). Every
+    character has an ancestry with traits, one to three classes with the class attributes of their
+    levels, and some have modifiers of their own.
+    """
+    data = defaultdict(list)
+    for i in range(1, 9):
+        data["Ancestry"].append(
+            dict(
+                id=i, name=f"Ancestry {i}", modifiers=[dict(name=f"Ancestry {i}", target="strength", relative_value=1)]
+            )
+        )
+        for j in range(2):
+            trait_id = (i - 1) * 2 + j + 1
+            data["AncestryTrait"].append(
+                dict(
+                    id=trait_id,
+                    name=f"Trait {trait_id}",
+                    modifiers=[dict(name=f"Trait {trait_id}", target="vision_in_darkness", absolute_value=60)],
+                )
+            )
+            data["AncestryTraitMap"].append(dict(ancestry_id=i, ancestry_trait_id=trait_id, level=1))
+
+    # six classes with attributes at levels 1, 3 and 6, and a seventh no one has taken yet
+    class_attributes = defaultdict(list)
+    for i in range(1, 8):
+        data["CharacterClass"].append(dict(id=i, name=f"Class {i}", hit_dice="1d8", hit_dice_stat="CON"))
+        for j, level in enumerate([1, 3, 6]):
+            attribute_id = (i - 1) * 3 + j + 1
+            data["ClassAttribute"].append(dict(id=attribute_id, name=f"Attribute {attribute_id}"))
+            data["ClassAttributeMap"].append(dict(class_attribute_id=attribute_id, character_class_id=i, level=level))
+            for k in range(2):
+                option_id = (attribute_id - 1) * 2 + k + 1
+                data["ClassAttributeOption"].append(
+                    dict(id=option_id, attribute_id=attribute_id, name=f"Option {option_id}")
+                )
+            class_attributes[i].append((level, attribute_id, (attribute_id - 1) * 2 + 1))
+
+    blessed = dict(name="Blessed", target="charisma", relative_value=1)
+    hasted = dict(name="Hasted", target="speed", multiply_value=2.0)
+    for i in range(1, characters + 1):
+        modifiers = [mod for n, mod in [(3, blessed), (5, hasted)] if i % n == 0]
+        data["Character"].append(
+            dict(id=i, name=f"Character {i}", slug=f"c{i}", ancestry_id=i % 8 + 1, modifiers=modifiers)
+        )
+        for j in range(i % 3 + 1):
+            class_id = (i + j) % 6 + 1
+            level = (i + j) % 6 + 1
+            data["CharacterClassMap"].append(dict(character_id=i, character_class_id=class_id, level=level))
+            for attribute_level, attribute_id, option_id in class_attributes[class_id]:
+                if attribute_level <= level:
+                    data["CharacterClassAttributeMap"].append(
+                        dict(character_id=i, class_attribute_id=attribute_id, option_id=option_id)
+                    )
+    return data
+
+
+@pytest.fixture
+def campaign(db):
+    with db.transaction():
+        return bulk_import(campaign_data())
+
+
+@pytest.fixture
+def app(db):
+    from ttfrog.webserver.application import application
+
+    return application()
+
+
+def get(app, path):
+    response = Request.blank(path).get_response(app)
+    assert response.status_code == 200, response.text[:1000]
+    return response
+
+
+@pytest.mark.benchmark
+def test_bootstrap_benchmark(db, benchmark):
+    from ttfrog.db.bootstrap import bootstrap
+
+    benchmark("bootstrap", bootstrap)
+
+
+@pytest.mark.benchmark
+def test_seed_benchmark(db, benchmark):
+    def seed():
+        db.session.remove()
+        db.metadata.drop_all(bind=db.engine)
+        db.init()
+        with db.transaction():
+            return bulk_import(campaign_data())
+
+    counts = benchmark("bulk_import", seed, operations=CAMPAIGN_SIZE)
+    assert counts["Character"] == CAMPAIGN_SIZE
+
+
+@pytest.mark.benchmark
+def test_sheet_benchmark(db, campaign, benchmark, monkeypatch):
+    from ttfrog.webserver.application import application
+    from ttfrog.webserver.controllers import CharacterSheet
+    from ttfrog.webserver.sheet_cache import sheets
+    from ttfrog.webserver.views import response_from
+
+    # without the debugging output, which loads the character on every request
+    monkeypatch.delenv("DEBUG")
+    app = application()
+
+    uris = [slug_uri(f"c{i}", f"Character {i}") for i in range(1, CAMPAIGN_SIZE + 1, CAMPAIGN_SIZE // 50)]
+
+    def render():
+        sheets.clear()
+        return [len(get(app, f"/c/{uri}").body) for uri in uris]
+
+    benchmark("render", render, operations=len(uris), memory=True)
+    benchmark("cached", lambda: [len(get(app, f"/c/{uri}").body) for uri in uris], operations=len(uris))
+    benchmark("index", lambda: get(app, "/c"))
+
+    etags = dict((uri, get(app, f"/c/{uri}").etag) for uri in uris)
+
+    def not_modified():
+        for uri in uris:
+            request = Request.blank(f"/c/{uri}")
+            request.if_none_match = etags[uri]
+            assert request.get_response(app).status_code == 304
+
+    benchmark("not_modified", not_modified, operations=len(uris))
+
+    # building the template context, and reading every value from it as base.html does
+    def contexts():
+        for uri in uris:
+            request = PyramidRequest.blank(f"/c/{uri}")
+            request.registry = app.registry
+            request.matchdict = {"uri": f"/{uri}"}
+            c = response_from(CharacterSheet(request))["c"]
+            for name in ["config", "resources", "routes", "record_index", "record", "form", "request"]:
+                getattr(c, name)
+
+    with db.transaction():
+        benchmark("context", contexts, operations=len(uris), memory=True)
+
+
+@pytest.mark.benchmark
+def test_json_benchmark(campaign, app, benchmark):
+    def pages(path):
+        records = 0
+        after = 0
+        while after is not None:
+            page = get(app, f"{path}&after={after}").json
+            records += len(page["records"])
+            after = page["next"]
+        return records
+
+    assert benchmark("page", lambda: pages("/_/Character?limit=1000"), operations=CAMPAIGN_SIZE) == CAMPAIGN_SIZE
+    benchmark("page_depth", lambda: pages("/_/Character?limit=100&depth=1"), operations=CAMPAIGN_SIZE)
+    lines = benchmark(
+        "ndjson", lambda: get(app, "/_/Character?format=ndjson").body.count(b"\n"), operations=CAMPAIGN_SIZE
+    )
+    assert lines == CAMPAIGN_SIZE
+
+
+@pytest.mark.benchmark
+def test_apply_modifiers_benchmark(db, campaign, benchmark):
+    from ttfrog.db.stats import STAT_TARGETS
+
+    with db.transaction():
+        characters = db.query(schema.Character, profile="sheet").filter(schema.Character.id <= 500).all()
+
+        def evaluate(invalidate):
+            if invalidate:
+                modifiers_changed()
+            return [[getattr(char, name) for name in STAT_TARGETS] for char in characters]
+
+        benchmark("cold", lambda: evaluate(True), operations=len(characters))
+        benchmark("warm", lambda: evaluate(False), operations=len(characters))
+
+
+@pytest.mark.benchmark
+def test_add_class_benchmark(db, campaign, benchmark):
+    with db.transaction():
+        newclass = db.CharacterClass.filter_by(name="Class 7").one()
+        characters = db.query(schema.Character, profile="sheet").filter(schema.Character.id <= 200).all()
+
+        def add_class(level):
+            for char in characters:
+                char.add_class(newclass, level=level)
+            db.session.flush()
+
+        benchmark("add", lambda: add_class(1), operations=len(characters), repeat=1)
+        benchmark("level_up", lambda: add_class(6), operations=len(characters), repeat=1)
+        benchmark("level_20", lambda: add_class(20), operations=len(characters), repeat=1)
+
+
+@pytest.mark.benchmark
+def test_cli_startup_benchmark(db, benchmark, cli_imports):
+    for command, budget in CLI_IMPORT_BUDGETS.items():
+        words = [word.strip("-") for word in command.split() if word not in ("--root", "-o") and "{" not in word]
+        imports = benchmark("_".join(words), lambda: cli_imports(command))
+        logging.info(f"{command}: {imports.seconds * 1000:.1f}ms importing {len(imports.modules)} modules")
+        assert imports.seconds < budget, f"ttfrog {command} spent {imports.seconds:.3f}s importing; budget {budget}s"
@@ -0,0 +1,69 @@
+import pytest
+from sqlalchemy.exc import InvalidRequestError
+
+from ttfrog.db import schema
+from ttfrog.db.stats import STAT_TARGETS
+
+
+@pytest.fixture
+def character(db, classes_factory, ancestries_factory, monkeypatch):
+    with db.transaction():
+        classes = classes_factory()
+        ancestries = ancestries_factory()
+        darkvision = db.AncestryTrait.filter_by(name="Darkvision")[0]
+        darkvision.add_modifier(schema.Modifier(name="Darkvision", target="vision_in_darkness", absolute_value=60))
+        ancestries["tiefling"].add_modifier(schema.Modifier(name="Infernal", target="charisma", relative_value=2))
+        char = schema.Character(name="Sabetha", ancestry=ancestries["tiefling"])
+        char.add_modifier(schema.Modifier(name="Hasted", target="speed", multiply_value=2.0))
+        db.add_or_update(char)
+        char.add_class(classes["fighter"], level=2)
+        char.add_class(classes["rogue"], level=1)
+        db.add_or_update(char)
+        slug = char.slug
+    db.session.expunge_all()
+    monkeypatch.setenv("STRICT_LOADING", "1")
+    return slug
+
+
+def test_sheet_profile(db, queries, character):
+    with db.transaction():
+        queries.clear()
+        char = db.query(schema.Character, profile="sheet").filter_by(slug=character).one()
+        assert len(queries) == 10
+
+        # everything the sheet touches was loaded by the profile
+        assert dict((name, getattr(char, name)) for name in STAT_TARGETS)
+        assert char.levels == {"fighter": 2, "rogue": 1}
+        assert list(char.class_attributes) == ["Fighting Style"]
+        # the class granting an attribute comes from the class maps, even though the character has two
+        for mapping in char.character_class_attribute_map:
+            assert char.class_granting(mapping.class_attribute).name == "fighter"
+            assert mapping.class_attribute.options
+        for character_class in char.classes.values():
+            assert character_class.attributes_by_level is not None
+        assert repr(char)
+        assert len(queries) == 10
+
+        # anything else raises
+        with pytest.raises(InvalidRequestError):
+            char.class_map[0].character
+
+
+def test_list_profile(db, queries, character):
+    with db.transaction():
+        queries.clear()
+        records = db.query(schema.Character, profile="list").all()
+        assert [rec.uri for rec in records] == [f"{character}-Sabetha"]
+        assert len(queries) == 1
+        with pytest.raises(InvalidRequestError):
+            records[0].ancestry
+
+
+def test_json_profile(db, queries, character):
+    with db.transaction():
+        queries.clear()
+        ancestries = db.query(schema.Ancestry, profile="json").all()
+        assert [dict(ancestry) for ancestry in ancestries]
+        assert len(queries) == 3
+        with pytest.raises(InvalidRequestError):
+            ancestries[0]._traits[0].trait
@@ -1,6 +1,14 @@
+import io
 import json
+import time
+
+import pytest
+from sqlalchemy import create_engine, delete
+from sqlalchemy import inspect as sa_inspect
+from sqlalchemy import text
 
 from ttfrog.db import schema
+from ttfrog.db.schema.modifiers import ModifierMap, modifier_table
 
 
 def test_manage_character(db, classes_factory, ancestries_factory):
@@ -154,6 +162,7 @@ def test_modifiers(db, classes_factory, ancestries_factory):
         # reduce speed by 10
         assert carl.add_modifier(cold)
         assert carl.speed == 20
+        assert [mapping.primary_table_name for mapping in carl.modifier_map] == ["character"]
 
         # make sure modifiers only apply to carl. Carl is having a bad day.
         assert marx.speed == 30
@@ -183,3 +192,585 @@ def test_modifiers(db, classes_factory, ancestries_factory):
         # modifiers can modify string values too
         assert carl.add_modifier(reduced)
         assert carl.size == "Tiny"
+
+
+def test_modifier_cache(db, classes_factory, ancestries_factory):
+    with db.transaction():
+        classes = classes_factory()
+        ancestries = ancestries_factory()
+
+        char = schema.Character(name="Cache Money", ancestry=ancestries["elf"])
+        db.add_or_update(char)
+        assert char.STR == 10
+
+        # the compiled modifiers are reused between reads
+        compiled = char.effective_modifiers
+        assert char.effective_modifiers is compiled
+
+        # modifying the ancestry invalidates the character's compiled modifiers
+        ancestries["elf"].add_modifier(schema.Modifier(name="Elf Strength", target="strength", relative_value=2))
+        db.add_or_update(ancestries["elf"])
+        assert char.effective_modifiers is not compiled
+        assert char.STR == 12
+
+        # so does switching ancestry
+        char.ancestry = ancestries["human"]
+        db.add_or_update(char)
+        assert char.STR == 10
+
+        # ...and adding a trait to the character's ancestry
+        mighty = schema.AncestryTrait(name="Mighty")
+        mighty.add_modifier(schema.Modifier(name="Mighty", target="strength", absolute_value=19))
+        ancestries["human"].add_trait(mighty)
+        db.add_or_update(ancestries["human"])
+        assert char.STR == 19
+
+        # ...and changing an existing modifier
+        mighty.modifiers["strength"][0].absolute_value = 21
+        assert char.STR == 21
+
+        # class changes invalidate, too
+        compiled = char.effective_modifiers
+        char.add_class(classes["fighter"], level=1)
+        assert char.effective_modifiers is not compiled
+
+
+def test_class_attributes(db, classes_factory, ancestries_factory):
+    with db.transaction():
+        fighter = classes_factory()["fighter"]
+        ancestries_factory()
+
+        # two attributes gained at the same level are both indexed
+        second_wind = schema.ClassAttribute(name="Second Wind")
+        second_wind.options = [schema.ClassAttributeOption(name="1d10")]
+        db.add_or_update(second_wind)
+        fighter.attributes.append(schema.ClassAttributeMap(class_attribute_id=second_wind.id, level=2))
+        db.add_or_update(fighter)
+        assert sorted(fighter.attributes_by_level[2]) == ["Fighting Style", "Second Wind"]
+        assert fighter.attributes_up_to(1) == {}
+        assert sorted(fighter.attributes_up_to(20)) == ["Fighting Style", "Second Wind"]
+
+        # the index is reused until the attributes change
+        index = fighter.attribute_index
+        assert fighter.attribute_index is index
+        fighter.attributes[-1].level = 3
+        assert fighter.attribute_index is not index
+        assert list(fighter.attributes_by_level) == [2, 3]
+        assert list(fighter.attributes_up_to(2)) == ["Fighting Style"]
+
+        # and until the class is expired, since its attributes are then loaded again
+        db.session.flush()
+        index = fighter.attribute_index
+        db.session.expire(fighter)
+        assert fighter.attribute_index is not index
+        assert list(fighter.attributes_by_level) == [2, 3]
+
+        # a class taken above level 1 grants every attribute up to that level
+        char = schema.Character(name="Fighter")
+        db.add_or_update(char)
+        char.add_class(fighter, level=3)
+        db.add_or_update(char)
+        assert sorted(char.class_attributes) == ["Fighting Style", "Second Wind"]
+        assert char.add_class_attribute(second_wind, second_wind.options[0]) is True
+        assert len(char.character_class_attribute_map) == 2
+
+
+def test_level_changes(db, classes_factory, ancestries_factory, queries):
+    with db.transaction():
+        fighter = classes_factory()["fighter"]
+        ancestries_factory()
+        for level, name in [(3, "Martial Archetype"), (5, "Extra Attack")]:
+            attribute = schema.ClassAttribute(name=name, options=[schema.ClassAttributeOption(name=name)])
+            db.add_or_update(attribute)
+            fighter.attributes.append(schema.ClassAttributeMap(class_attribute_id=attribute.id, level=level))
+        db.add_or_update(fighter)
+
+        party = [schema.Character(name=f"Fighter {i}") for i in range(5)]
+        db.add_or_update(party)
+        for char in party:
+            assert char.set_class_level(fighter, 1) == 0
+
+        # only the attributes gained since the previous level are added...
+        for char in party:
+            assert char.level_up(fighter, 2) == 3
+            assert sorted(char.class_attributes) == ["Fighting Style", "Martial Archetype"]
+
+        # leveling the party up runs no queries, and the flush inserts only the new attribute maps
+        db.session.flush()
+        queries.clear()
+        for char in party:
+            assert char.set_class_level(fighter, 20) == 3
+        assert queries == []
+        db.session.flush()
+        assert sorted(set(statement.split(" (")[0] for statement in queries)) == [
+            "INSERT INTO character_class_attribute_map",
+            "UPDATE class_map SET level=? WHERE class_map.id = ?",
+        ]
+        assert len(queries) == len(party) + 1
+        assert sorted(party[0].class_attributes) == ["Extra Attack", "Fighting Style", "Martial Archetype"]
+
+        # losing levels removes the attributes above the new level
+        party[0].set_class_level(fighter, 4)
+        db.add_or_update(party[0])
+        assert sorted(party[0].class_attributes) == ["Fighting Style", "Martial Archetype"]
+
+        # adding a class that isn't saved yet does not match the classes the character already has
+        wizard = schema.CharacterClass(name="wizard")
+        party[0].add_class(wizard, level=1)
+        assert party[0].levels == {"fighter": 4, "wizard": 1}
+
+
+def test_multiclass_levels(db, classes_factory, ancestries_factory):
+    with db.transaction():
+        classes = classes_factory()
+        fighter, rogue = classes["fighter"], classes["rogue"]
+        ancestries_factory()
+        fighting_style = db.ClassAttribute.filter_by(name="Fighting Style").one()
+        rogue.attributes.append(schema.ClassAttributeMap(class_attribute_id=fighting_style.id, level=2))
+        db.add_or_update(rogue)
+
+        char = schema.Character(name="Multiclass")
+        db.add_or_update(char)
+        char.add_class(fighter, level=2)
+        char.add_class(rogue, level=2)
+        db.add_or_update(char)
+        assert list(char.class_attributes) == ["Fighting Style"]
+
+        # classes are matched by id, whichever instance of the class is given
+        assert char.class_mapping(schema.CharacterClass(id=rogue.id, name="rogue")) is char.class_map[1]
+
+        # an attribute granted by two classes is kept until neither grants it
+        char.remove_class(rogue)
+        db.add_or_update(char)
+        assert char.levels == {"fighter": 2}
+        assert list(char.class_attributes) == ["Fighting Style"]
+        char.set_class_level(fighter, 1)
+        db.add_or_update(char)
+        assert char.class_attributes == {}
+
+        # a pending map that names its class by id alone is matched too, rather than adding a second map
+        char.class_map.append(schema.CharacterClassMap(character_id=char.id, character_class_id=rogue.id, level=1))
+        assert char.set_class_level(rogue, 3) == 1
+        db.add_or_update(char)
+        assert char.levels == {"fighter": 1, "rogue": 3}
+        assert list(char.class_attributes) == ["Fighting Style"]
+
+
+def test_evaluate_stats(db, classes_factory, ancestries_factory):
+    from ttfrog.db.stats import STAT_TARGETS, evaluate_stats
+
+    with db.transaction():
+        ancestries = ancestries_factory()
+        darkvision = db.AncestryTrait.filter_by(name="Darkvision")[0]
+        darkvision.add_modifier(schema.Modifier(name="Darkvision", target="vision_in_darkness", absolute_value=60))
+        ancestries["tiefling"].add_modifier(schema.Modifier(name="Infernal", target="charisma", relative_value=2))
+
+        carl = schema.Character(name="Carl", ancestry=ancestries["elf"])
+        marx = schema.Character(name="Marx", ancestry=ancestries["tiefling"])
+        zed = schema.Character(name="Zed", ancestry=ancestries["dragonborn"], _vision=30)
+        db.add_or_update([carl, marx, zed])
+        carl.add_modifier(schema.Modifier(name="Hasted", target="speed", multiply_value=2.0))
+        carl.add_modifier(schema.Modifier(name="Reduced", target="size", new_value="Tiny"))
+        marx.add_modifier(schema.Modifier(name="Cursed", target="charisma", relative_value=-1))
+        zed.add_modifier(schema.Modifier(name="Restrained", target="speed", absolute_value=0))
+        db.add_or_update([carl, marx, zed])
+
+        stats = evaluate_stats([carl, marx.id, zed])
+        for char in [carl, marx, zed]:
+            assert stats[char.id] == dict((name, getattr(char, name)) for name in STAT_TARGETS)
+        assert stats[carl.id]["speed"] == 60
+        assert stats[marx.id]["CHA"] == 9
+        assert stats[zed.id]["vision_in_darkness"] == 60
+
+        assert evaluate_stats([carl], ["AC", "size"]) == {carl.id: {"AC": 10, "size": "Tiny"}}
+
+
+def test_modifier_queries(db, queries):
+    def load_character(trait_count):
+        with db.transaction():
+            ancestry = schema.Ancestry(name=f"{trait_count} traits")
+            ancestry.add_modifier(schema.Modifier(name="Sturdy", target="constitution", relative_value=1))
+            for i in range(trait_count):
+                trait = schema.AncestryTrait(name=f"Trait {i}")
+                trait.add_modifier(schema.Modifier(name=f"Trait {i}", target="strength", relative_value=1))
+                ancestry.add_trait(trait)
+            char = schema.Character(name=f"{trait_count} traits", ancestry=ancestry)
+            char.add_modifier(schema.Modifier(name="Clumsy", target="dexterity", relative_value=-1))
+            db.add_or_update(char)
+            slug = char.slug
+        db.session.expunge_all()
+
+        with db.transaction():
+            queries.clear()
+            char = db.Character.filter_by(slug=slug).one()
+            assert (char.STR, char.DEX, char.CON) == (10 + min(trait_count, 1), 9, 11)
+            return len(queries)
+
+    # character, ancestry, trait maps with traits, and one batch of modifier maps with modifiers
+    assert load_character(1) == load_character(10) == 4
+
+
+def test_json_serialization(db, ancestries_factory, queries):
+    with db.transaction():
+        ancestries_factory()
+        char = schema.Character(name="Sabetha", ancestry=db.Ancestry.filter_by(name="tiefling")[0])
+        db.add_or_update(char)
+        slug = char.slug
+    db.session.expunge_all()
+
+    with db.transaction():
+        char = db.Character.filter_by(slug=slug).one()
+        queries.clear()
+
+        # only the loaded columns are serialized, and no relationships are loaded to do it
+        record = char.__json__(depth=2)
+        assert record["name"] == "Sabetha"
+        assert "ancestry" not in record
+        assert len(queries) == 0
+
+        char = db.query(schema.Character, profile="json").filter_by(slug=slug).one()
+        record = char.__json__(depth=1)
+        assert record["ancestry"]["name"] == "tiefling"
+        assert record["ancestry"]["size"] == "Medium"
+        assert "_traits" not in record["ancestry"]
+        assert record["class_map"] == []
+        assert json.loads(json.dumps(record)) == record
+
+
+def test_dump_and_load(db, classes_factory, ancestries_factory):
+    with db.transaction():
+        ancestries_factory()
+        classes_factory()
+        char = schema.Character(name="Sabetha", ancestry=db.Ancestry.filter_by(name="tiefling")[0])
+        char.add_modifier(schema.Modifier(name="Cursed", target="charisma", relative_value=-1))
+        db.add_or_update(char)
+    expected = json.loads(db.dump())
+    assert expected["character"][0]["name"] == "Sabetha"
+    assert expected["ancestry"][0]["creature_type"] == "humanoid"
+
+    for format in ["json", "ndjson"]:
+        output = io.StringIO()
+        db.dump_to(output, format=format)
+        db.session.remove()
+        db.metadata.drop_all(bind=db.engine)
+        db.init()
+
+        output.seek(0)
+        counts = db.load_from(output, format=format)
+        assert counts["modifier_map"] == 1
+        assert json.loads(db.dump()) == expected
+        with db.transaction():
+            assert db.Character.one().CHA == 9
+
+
+def test_bulk_import(db, ancestries_factory):
+    from ttfrog.db.bulk import bulk_import
+
+    infernal = dict(name="Infernal", target="charisma", relative_value=2)
+    with db.transaction():
+        ancestries_factory()
+        counts = bulk_import(
+            {
+                "Character": [
+                    dict(name="Sabetha", ancestry="tiefling", modifiers=[infernal]),
+                    dict(name="Bob", ancestry_id="human", modifiers=[infernal, dict(infernal, relative_value=1)]),
+                ],
+                "Ancestry": [dict(name="halfling", size="Small", modifiers=[infernal])],
+                "AncestryTraitMap": [dict(ancestry_id="halfling", ancestry_trait_id="Darkvision", level=1)],
+                "CharacterClass": [dict(name="wizard", saving_throws=["INT", "WIS"])],
+            }
+        )
+        assert counts == {
+            "Ancestry": 1,
+            "CharacterClass": 1,
+            "AncestryTraitMap": 1,
+            "Character": 2,
+            "Modifier": 2,
+            "ModifierMap": 4,
+        }
+
+        sabetha = db.Character.filter_by(name="Sabetha").one()
+        assert sabetha.ancestry.name == "tiefling"
+        assert sabetha.CHA == 12
+        assert db.Character.filter_by(name="Bob").one().CHA == 13
+        assert db.Ancestry.filter_by(name="halfling").one().traits[0].name == "Darkvision"
+        assert db.CharacterClass.filter_by(name="wizard").one().saving_throws == ["INT", "WIS"]
+
+        # existing modifiers are reused
+        bulk_import({"AncestryTrait": [dict(name="Fiendish", modifiers=[infernal])]})
+        assert db.Modifier.count() == 2
+
+        with pytest.raises(ValueError):
+            bulk_import({"Character": [dict(name="Nobody", ancestry="gnome")]})
+
+
+def test_transaction_log(db, classes_factory, ancestries_factory, queries):
+    from ttfrog.db import transaction_log
+
+    with db.transaction():
+        fighter = classes_factory()["fighter"]
+        ancestries = ancestries_factory()
+        char = schema.Character(name="Sabetha", ancestry=ancestries["human"])
+        db.add_or_update(char)
+        human, tiefling = ancestries["human"].id, ancestries["tiefling"].id
+        char_id = char.id
+
+    # changes are not logged unless the session is capturing them
+    assert db.TransactionLog.count() == 0
+
+    with db.transaction():
+        transaction_log.capture()
+        char = db.Character.filter_by(name="Sabetha").one()
+        char.name = "Sabetha of Waterdeep"
+        char.hit_points = 5
+        ancestries["tiefling"].size = "Small"
+        char.add_class(fighter, level=1)
+        db.session.flush()
+        before = time.time()
+
+        # the log is written in the same transaction as the changes, by one statement per flush
+        char.ancestry = ancestries["tiefling"]
+        char.level_up(fighter)
+        queries.clear()
+        db.session.flush()
+        assert len([statement for statement in queries if statement.startswith("INSERT INTO transaction_log")]) == 1
+        assert not any(statement.startswith("COMMIT") for statement in queries)
+
+    entries = db.TransactionLog.order_by(schema.TransactionLog.id).all()
+    assert sorted((entry.source_table_name, entry.operation) for entry in entries) == [
+        ("ancestry", "update"),
+        ("character", "update"),
+        ("character", "update"),
+        ("character_class_attribute_map", "insert"),
+        ("class_map", "insert"),
+        ("class_map", "update"),
+    ]
+    logged = dict(((entry.source_table_name, entry.operation, *entry.changes), entry) for entry in entries)
+    renamed = logged[("character", "update", "name", "hit_points")]
+    assert renamed.changes == {"name": ["Sabetha", "Sabetha of Waterdeep"], "hit_points": [1, 5]}
+    assert logged[("ancestry", "update", "size")].changes == {"size": ["Medium", "Small"]}
+    moved = logged[("character", "update", "ancestry_id")]
+    assert moved.changes == {"ancestry_id": [human, tiefling]}
+    class_added = next(
+        entry for entry in entries if entry.source_table_name == "class_map" and entry.operation == "insert"
+    )
+
+    # the capture ended with the transaction
+    with db.transaction():
+        char = db.session.get(schema.Character, char_id)
+        char.name = "Sabetha the Bold"
+    assert db.TransactionLog.count() == len(entries)
+
+    with db.transaction():
+        char = db.session.get(schema.Character, char_id)
+
+        # undoing the latest change is one indexed lookup
+        queries.clear()
+        assert transaction_log.restore(char).id == moved.id
+        assert len(queries) == 1
+        statement = transaction_log.changes(char).compile(compile_kwargs={"literal_binds": True})
+        assert "ix_transaction_log_row" in str(db.session.execute(text(f"EXPLAIN QUERY PLAN {statement}")).all())
+        db.session.flush()
+        assert char.ancestry.name == "human"
+
+        # as is restoring the record to a point in time
+        queries.clear()
+        assert [entry.id for entry in transaction_log.restore_to(char, before - 1)] == [moved.id, renamed.id]
+        assert len(queries) == 1
+        assert char.name == "Sabetha"
+        assert char.hit_points == 1
+
+        # enum values are restored as members of the enum
+        tiefling = db.Ancestry.filter_by(name="tiefling").one()
+        transaction_log.restore(tiefling)
+        assert tiefling.size.value == "Medium"
+
+        # an insert is undone by deleting the row
+        class_map = db.session.get(schema.CharacterClassMap, class_added.primary_key)
+        transaction_log.restore(class_map, log_id=class_added.id)
+        db.session.flush()
+        assert db.session.get(schema.CharacterClassMap, class_added.primary_key) is None
+
+    # only the restored rows were changed
+    assert db.Character.filter_by(name="Sabetha").count() == 1
+
+
+def test_snapshots(db, classes_factory, ancestries_factory, queries, monkeypatch):
+    from ttfrog.db import transaction_log
+
+    monkeypatch.setattr(transaction_log, "SNAPSHOT_INTERVAL", 3)
+    with db.transaction():
+        fighter = classes_factory()["fighter"]
+        ancestries_factory()
+        char = schema.Character(name="Sabetha")
+        db.add_or_update(char)
+        char_id, fighter_id = char.id, fighter.id
+    created = time.time()
+
+    # save the character a number of times, noting the time after each save
+    times = []
+    for hit_points in range(2, 12):
+        time.sleep(0.001)
+        with db.transaction():
+            transaction_log.capture()
+            char = db.session.get(schema.Character, char_id)
+            char.hit_points = hit_points
+            if hit_points == 4:
+                char.add_class(db.session.get(schema.CharacterClass, fighter_id), level=1)
+            elif hit_points > 4:
+                char.level_up(db.session.get(schema.CharacterClass, fighter_id))
+        times.append(time.time())
+
+    # the first change and every SNAPSHOT_INTERVAL changes after it are snapshotted
+    snapshots = db.CharacterSnapshot.order_by(schema.CharacterSnapshot.id).all()
+    assert len(snapshots) > 1
+    assert all(later.log_id - earlier.log_id >= 3 for earlier, later in zip(snapshots, snapshots[1:]))
+
+    def levels(rows):
+        return [row["level"] for row in rows["class_map"].values()]
+
+    with db.transaction():
+        # before the first change, the character is rebuilt by reversing the changes
+        rows = transaction_log.snapshot_at(char_id, created)
+        assert rows["character"][char_id]["hit_points"] == 1
+        assert rows["class_map"] == {}
+
+        for hit_points, moment in zip(range(2, 12), times):
+            # every other time is rebuilt from the latest snapshot before it and the changes since
+            queries.clear()
+            rows = transaction_log.snapshot_at(char_id, moment)
+            assert len(queries) == 2
+            assert rows["character"][char_id]["hit_points"] == hit_points
+            assert levels(rows) == ([] if hit_points < 4 else [hit_points - 3])
+            assert len(rows["character_class_attribute_map"]) == (1 if hit_points > 4 else 0)
+
+        # with nothing logged since the last save, the latest snapshot is brought up to date
+        char = db.session.get(schema.Character, char_id)
+        assert transaction_log.snapshot_at(char, time.time()) == transaction_log._character_rows(
+            db.session.connection(), char_id
+        )
+
+    # compacting deletes the changes older than the latest snapshot before the given time...
+    with db.transaction():
+        last_snapshot = (
+            db.CharacterSnapshot.filter(schema.CharacterSnapshot.timestamp < times[6])
+            .order_by(schema.CharacterSnapshot.id.desc())
+            .first()
+        )
+        last_log_id, last_timestamp = last_snapshot.log_id, last_snapshot.timestamp
+        logged = db.TransactionLog.count()
+        assert transaction_log.compact(times[6]) == logged - db.TransactionLog.count() > 0
+        assert db.TransactionLog.filter(schema.TransactionLog.id <= last_log_id).count() == 0
+        assert db.TransactionLog.filter(schema.TransactionLog.id > last_log_id).count() > 0
+
+    # ...leaving every time since then as it was
+    with db.transaction():
+        for hit_points, moment in zip(range(2, 12), times):
+            if moment >= last_timestamp:
+                assert transaction_log.snapshot_at(char_id, moment)["character"][char_id]["hit_points"] == hit_points
+
+
+def test_migrations(db, tmp_path):
+    from ttfrog.db import migrations
+
+    # a database created before schema versions were recorded
+    engine = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    unchanged = [table for name, table in db.tables.items() if name not in ("modifier_map", "transaction_log")]
+    with engine.begin() as conn:
+        db.metadata.create_all(conn, tables=[table for table in unchanged if table.name != "character_snapshot"])
+        conn.execute(
+            text(
+                "CREATE TABLE modifier_map (id INTEGER PRIMARY KEY, modifier_id INTEGER NOT NULL REFERENCES "
+                "modifier (id), primary_table_name VARCHAR NOT NULL, primary_table_id INTEGER NOT NULL, "
+                "UNIQUE (primary_table_name, primary_table_id, modifier_id))"
+            )
+        )
+        conn.execute(
+            text(
+                "CREATE TABLE transaction_log (id INTEGER PRIMARY KEY, source_table_name VARCHAR NOT NULL, "
+                "primary_key INTEGER, diff TEXT)"
+            )
+        )
+        conn.execute(
+            text("INSERT INTO modifier (id, name, target, relative_value) VALUES (1, 'Strong', 'strength', 2)")
+        )
+        conn.execute(
+            text(
+                "INSERT INTO modifier_map (modifier_id, primary_table_name, primary_table_id) "
+                "VALUES (1, 'ancestry', 1), (1, 'character', 5)"
+            )
+        )
+
+    # every migration is run, once
+    assert migrations.migrate(engine, db.metadata) == migrations.MIGRATIONS
+    assert migrations.migrate(engine, db.metadata) == []
+    with engine.connect() as conn:
+        assert migrations.current_version(conn) == migrations.latest_version()
+        rows = conn.execute(text("SELECT primary_table, primary_table_id FROM modifier_map ORDER BY id")).all()
+        assert rows == [(modifier_table("ancestry"), 1), (modifier_table("character"), 5)]
+
+    # leaving the schema as the models would have created it
+    migrated = sa_inspect(engine)
+    for table in db.tables.values():
+        assert sorted(col["name"] for col in migrated.get_columns(table.name)) == sorted(table.columns.keys())
+        assert sorted(index["name"] for index in migrated.get_indexes(table.name)) == sorted(
+            index.name for index in table.indexes
+        )
+    engine.dispose()
+
+
+def test_bootstrap(db, queries):
+    from ttfrog.db.bootstrap import bootstrap, seed
+
+    counts = bootstrap()
+    assert counts["Character"] == 2
+    assert counts["CharacterClassMap"] == 2
+
+    with db.transaction():
+        sabetha = db.Character.filter_by(name="Sabetha").one()
+        assert sabetha.levels == {"fighter": 2, "rogue": 3}
+        assert sabetha.CHA == 12
+        assert [trait.name for trait in sabetha.traits] == ["Darkvision"]
+
+        # users' changes are kept
+        sabetha.name = "Sabetha the Bold"
+        db.session.delete(db.Character.filter_by(name="Bob").one())
+
+    # seeding again inserts nothing, and takes the same few queries however much is in the database
+    queries.clear()
+    assert bootstrap() == {}
+    assert len(queries) < 15
+    with db.transaction():
+        assert sorted(char.name for char in db.Character) == ["Sabetha the Bold"]
+
+    # missing rules content is added back, along with the records that belong to it
+    with db.transaction():
+        db.session.execute(delete(schema.AncestryTraitMap))
+        db.session.execute(delete(schema.AncestryTrait))
+        db.session.execute(delete(ModifierMap).where(ModifierMap.primary_table == modifier_table("ancestry_trait")))
+    assert seed() == {"AncestryTrait": 1, "AncestryTraitMap": 1, "ModifierMap": 1}
+
+
+def test_table_registry(db, queries):
+    from ttfrog.db.registry import tables
+
+    assert tables["trait_map"] is tables["AncestryTraitMap"] is tables["ancestry_trait_map"]
+    assert tables["class_map"].model is schema.CharacterClassMap
+    assert tables["Character"].primary_key == ("id",)
+    assert tables["Character"].indexed == {"id", "slug"}
+    assert "nope" not in tables and tables.get("nope") is None
+    with pytest.raises(KeyError):
+        tables["nope"]
+
+    # tables are listed in dependency order, as the manager lists them
+    names = tables.names()
+    assert names.index("ancestry") < names.index("character") < names.index("class_map")
+    assert list(db.tables) == names
+    assert db.models["character"] is schema.Character
+
+    # models are looked up as attributes of the manager by model name only, without reflecting on the schema
+    assert db.Character.count() == 0
+    with pytest.raises(AttributeError):
+        db.character
+    with pytest.raises(AttributeError):
+        db.ModifierMixin
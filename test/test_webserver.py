@@ -0,0 +1,529 @@
+import json
+import os
+import re
+import signal
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+from pathlib import Path
+
+import pytest
+from pyramid.httpexceptions import HTTPBadRequest, HTTPNotFound
+from pyramid.testing import DummyRequest
+from sqlalchemy import insert, select
+from webob import Request
+from wtforms import Form
+
+from ttfrog.db import schema
+from ttfrog.db.base import genslug
+from ttfrog.webserver.controllers.base import RecordIndex
+from ttfrog.webserver.controllers.json_data import JsonData
+from ttfrog.webserver.forms import DeferredSelectField, NullableDeferredSelectField
+
+
+def test_record_index(db, ancestries_factory, queries):
+    with db.transaction():
+        ancestries_factory()
+        db.session.execute(insert(schema.Character), [dict(name=f"Char {i}", slug=genslug()) for i in range(25)])
+
+        page = RecordIndex(schema.Character, page_size=10)
+        assert [rec.name for rec in page] == [f"Char {i}" for i in range(10)]
+        assert page.records[0].uri == f"{page.records[0].slug}-Char0"
+        assert page.next_page == 10
+
+        page = RecordIndex(schema.Character, after=page.next_page, page_size=10)
+        assert [rec.id for rec in page] == list(range(11, 21))
+
+        page = RecordIndex(schema.Character, after=page.next_page, page_size=10)
+        assert len(page) == 5
+        assert page.next_page is None
+
+        # the count is cached until the table changes
+        queries.clear()
+        assert page.count == 25
+        assert page.count == 25
+        assert len(queries) == 1
+        db.add_or_update(schema.Character(name="Char 25"))
+        queries.clear()
+        assert page.count == 26
+        assert len(queries) == 1
+
+
+def test_deferred_select_choices(db, ancestries_factory, queries):
+    class AncestryForm(Form):
+        ancestry_id = DeferredSelectField(model=schema.Ancestry)
+        nullable_ancestry_id = NullableDeferredSelectField(model=schema.Ancestry)
+
+    with db.transaction():
+        ancestries_factory()
+        queries.clear()
+        form = AncestryForm()
+        assert form.ancestry_id.choices == [(1, "human"), (2, "dragonborn"), (3, "tiefling"), (4, "elf")]
+        assert form.nullable_ancestry_id.choices[0] == (0, "---")
+        assert len(queries) == 1
+
+        # choices are shared between forms
+        AncestryForm()
+        assert len(queries) == 1
+
+        # and reloaded when the table changes
+        db.add_or_update(schema.Ancestry(name="halfling"))
+        queries.clear()
+        assert AncestryForm().ancestry_id.choices[-1] == (5, "halfling")
+        assert len(queries) == 1
+
+
+def test_character_form_queries(db, ancestries_factory, queries, monkeypatch):
+    from ttfrog.webserver.controllers.character_sheet import CharacterForm
+
+    ancestries_factory()
+
+    def render_form(attribute_count):
+        with db.transaction():
+            wizard = schema.CharacterClass(name=f"wizard {attribute_count}")
+            char = schema.Character(name=f"{attribute_count} attributes")
+            for i in range(attribute_count):
+                attribute = schema.ClassAttribute(name=f"Attribute {i}")
+                attribute.options = [schema.ClassAttributeOption(name=f"Option {j}") for j in range(3)]
+                db.add_or_update(attribute)
+                wizard.attributes.append(schema.ClassAttributeMap(class_attribute_id=attribute.id, level=1))
+                char.attribute_list.append(
+                    schema.CharacterClassAttributeMap(class_attribute=attribute, option=attribute.options[0])
+                )
+            char.class_list.append(schema.CharacterClassMap(character_class=wizard, level=1))
+            db.add_or_update(char)
+            slug = char.slug
+        db.session.expunge_all()
+
+        with db.transaction():
+            monkeypatch.setenv("STRICT_LOADING", "1")
+            record = db.query(schema.Character, profile="sheet").filter_by(slug=slug).one()
+            queries.clear()
+            form = CharacterForm(obj=record)
+            assert len(form.attribute_list) == attribute_count
+            for field in form.attribute_list:
+                assert field.label.text == f"wizard {attribute_count}"
+                assert len(field.option_id.choices) == 3
+                assert field()
+            for field in form.class_list:
+                assert field()
+            monkeypatch.delenv("STRICT_LOADING")
+            return len(queries)
+
+    # select field choices are loaded on the first render and cached thereafter
+    assert render_form(1) == 2
+    assert render_form(2) == render_form(10) == 1
+
+
+def test_json_data(db, ancestries_factory):
+    with db.transaction():
+        ancestries_factory()
+        db.session.execute(insert(schema.Character), [dict(name=f"Char {i}", slug=genslug()) for i in range(25)])
+
+    def get(table_name="Character", **params):
+        request = DummyRequest(params=params, matchdict={"table_name": table_name})
+        return JsonData(request).response()
+
+    # every column is selected unless fields are given
+    page = get(limit="10")
+    assert set(page["records"][0]) == set(schema.Character.__mapper__.columns.keys())
+    assert page["next"] == 10
+
+    page = get(limit="10", fields="id,name")
+    assert page["records"][0] == {"id": 1, "name": "Char 0"}
+    assert len(page["records"]) == 10
+    assert page["next"] == 10
+
+    page = get(limit="10", after="20", fields="name")
+    assert page["records"] == [{"name": f"Char {i}"} for i in range(20, 25)]
+    assert page["next"] is None
+
+    assert get(id="4", name="Char 3")["records"][0]["name"] == "Char 3"
+    assert get(id="4", name="Char 4")["records"] == []
+
+    # tables can be named by table name or model name, and filtered on indexed columns
+    assert [rec["name"] for rec in get("ancestry", name="tiefling")["records"]] == ["tiefling"]
+    assert get("AncestryTraitMap")["records"] == get("trait_map")["records"]
+    with pytest.raises(HTTPNotFound):
+        get("Nope")
+    with pytest.raises(HTTPNotFound):
+        get("ModifierMixin")
+
+    response = get(format="ndjson", fields="id,name", after="5")
+    assert response.content_type == "application/x-ndjson"
+    lines = [json.loads(line) for line in b"".join(response.app_iter).decode().splitlines()]
+    assert lines == [{"id": i + 1, "name": f"Char {i}"} for i in range(5, 25)]
+
+    page = get(limit="1", fields="name", depth="1")
+    assert set(page["records"][0]) == set(
+        ["name", "ancestry", "class_map", "modifier_map", "character_class_attribute_map"]
+    )
+    assert page["records"][0]["ancestry"]["name"] == "human"
+
+    response = get(format="ndjson", limit="2", fields="id", depth="1")
+    lines = [json.loads(line) for line in b"".join(response.app_iter).decode().splitlines()]
+    assert [line["id"] for line in lines] == [1, 2]
+
+    # a filter on unindexed columns alone would scan the whole table, and so would a limit below one
+    for params in [
+        dict(fields="id,nope"),
+        dict(nope="1"),
+        dict(name="Char 3"),
+        dict(limit="ten"),
+        dict(limit="0"),
+        dict(limit="-1"),
+        dict(limit="-2"),
+        dict(format="ndjson", limit="0"),
+        dict(format="ndjson", limit="-2"),
+        dict(depth="-1"),
+        dict(format="xml"),
+    ]:
+        with pytest.raises(HTTPBadRequest):
+            get(**params)
+
+
+def test_json_data_composite_key(db, classes_factory):
+    with db.transaction():
+        classes = classes_factory()
+        attributes = [schema.ClassAttribute(name=f"Attribute {i}") for i in range(3)]
+        db.add_or_update(attributes)
+        for attribute in attributes:
+            for character_class in classes.values():
+                character_class.attributes.append(
+                    schema.ClassAttributeMap(class_attribute_id=attribute.id, level=attribute.id)
+                )
+        db.add_or_update(list(classes.values()))
+        expected = [
+            (row.class_attribute_id, row.character_class_id)
+            for row in db.ClassAttributeMap.order_by("class_attribute_id", "character_class_id")
+        ]
+
+    def get(**params):
+        request = DummyRequest(params=params, matchdict={"table_name": "ClassAttributeMap"})
+        return JsonData(request).response()
+
+    def keys(records):
+        return [(rec["class_attribute_id"], rec["character_class_id"]) for rec in records]
+
+    # tables with a composite primary key are paged on the whole key
+    page = get(limit="3")
+    assert keys(page["records"]) == expected[:3]
+    assert page["next"] == "%d,%d" % expected[2]
+    page = get(limit="3", after=page["next"])
+    assert keys(page["records"]) == expected[3:6]
+    assert get(fields="level", limit="2")["records"] == [dict(level=rec["level"]) for rec in get(limit="2")["records"]]
+
+    response = get(format="ndjson", after="%d,%d" % expected[0])
+    lines = [json.loads(line) for line in b"".join(response.app_iter).decode().splitlines()]
+    assert keys(lines) == expected[1:]
+
+    for after in ["1", "1,2,3", "one,two"]:
+        with pytest.raises(HTTPBadRequest):
+            get(after=after)
+
+
+def test_query_stats(db, ancestries_factory, classes_factory, queries, monkeypatch, caplog):
+    from ttfrog.webserver.application import application
+
+    monkeypatch.setenv("QUERY_STATS", "1")
+    with db.transaction():
+        ancestries_factory()
+        char = schema.Character(name="Sabetha", ancestry=db.Ancestry.filter_by(name="tiefling")[0])
+        char.add_class(classes_factory()["fighter"], level=2)
+        db.add_or_update(char)
+        uri = char.uri
+    app = application()
+
+    queries.clear()
+    response = Request.blank(f"/c/{uri}").get_response(app)
+    assert response.status_code == 200
+    assert int(response.headers["X-Query-Count"]) == len(queries)
+    assert float(response.headers["X-Query-Time"]) > 0
+    assert int(response.headers["X-Query-Duplicates"]) == len(queries) - len(set(queries))
+    assert "id='query_stats'" in response.text
+
+    logged = [json.loads(rec.message) for rec in caplog.records if rec.name == "ttfrog.querystats"]
+    assert logged[-1]["path"] == f"/c/{uri}"
+    assert logged[-1]["count"] == len(queries)
+    assert len(logged[-1]["slowest"]) == min(5, len(queries))
+
+
+def test_route_prefixes(db, monkeypatch):
+    from ttfrog.webserver.application import application
+    from ttfrog.webserver.controllers import base
+
+    app = application()
+    assert app.registry.route_prefixes == {"static": "/static", "index": "/", "sheet": "/c", "data": "/_/"}
+
+    # the prefixes are computed once, when the application is created, rather than on every request
+    def route_prefixes(registry):
+        raise AssertionError("route prefixes were recomputed")
+
+    monkeypatch.setattr(base, "route_prefixes", route_prefixes)
+    response = Request.blank("/c").get_response(app)
+    assert response.status_code == 200
+    assert 'href="/static/css/styles.css"' in response.text
+
+
+def test_template_context(db, ancestries_factory, queries):
+    from ttfrog.webserver.controllers import CharacterSheet
+
+    with db.transaction():
+        ancestries_factory()
+        db.add_or_update(schema.Character(name="Sabetha"))
+        controller = CharacterSheet(DummyRequest(matchdict={"uri": ""}))
+        controller.attrs["title"] = "Sheet"
+
+        # values are resolved only when they are read, and only once
+        queries.clear()
+        c = controller.template_context(config={"project_name": "Test"})
+        assert queries == []
+        assert c.title == "Sheet"
+        assert c.config == {"project_name": "Test"}
+        assert c.record_index is c.record_index
+        assert [rec.name for rec in c.record_index] == ["Sabetha"]
+        assert len(queries) == 1
+
+        with pytest.raises(AttributeError):
+            c.nope
+
+
+def test_sheet_cache(db, ancestries_factory, classes_factory, queries, monkeypatch):
+    from ttfrog.webserver.application import application
+    from ttfrog.webserver.sheet_cache import sheets
+
+    monkeypatch.delenv("DEBUG")
+    sheets.clear()
+    with db.transaction():
+        ancestries_factory()
+        classes = classes_factory()
+        db.add_or_update([schema.Character(name="Sabetha"), schema.Character(name="Bob")])
+        uri = db.Character.filter_by(name="Sabetha").one().uri
+    app = application()
+
+    def get(etag=None):
+        request = Request.blank(f"/c/{uri}")
+        if etag:
+            request.if_none_match = etag
+        queries.clear()
+        return request.get_response(app)
+
+    # the first request renders the sheet, and later ones reuse it without loading the character
+    first = get()
+    assert first.status_code == 200
+    rendered = len(queries)
+    assert first.etag
+    second = get()
+    assert second.text == first.text
+    assert second.etag == first.etag
+    cached = len(queries)
+    assert cached < rendered
+
+    # a client holding the current page is answered without touching the database
+    response = get(etag=first.etag)
+    assert response.status_code == 304
+    assert queries == []
+
+    # changing the character renders the sheet again
+    with db.transaction():
+        db.Character.filter_by(name="Sabetha").one().add_class(classes["fighter"], level=1)
+    response = get(etag=first.etag)
+    assert response.status_code == 200
+    assert response.etag != first.etag
+    assert len(queries) > cached
+    assert 'selected value="1">fighter' in response.text
+
+    # changing another character changes the list of characters on the page, but not the sheet
+    with db.transaction():
+        db.Character.filter_by(name="Bob").one().name = "Robert"
+    response = get()
+    assert "Robert" in response.text
+    assert len(queries) == cached
+
+    # changing the rules content it shows renders it again
+    with db.transaction():
+        db.Ancestry.filter_by(name="human").one().walk_speed = 25
+    response = get()
+    assert len(queries) > cached
+
+
+def test_delete_can_be_undone(db, ancestries_factory, classes_factory):
+    from ttfrog.db import transaction_log
+    from ttfrog.webserver.application import application
+
+    with db.transaction():
+        ancestries_factory()
+        classes = classes_factory()
+        char = schema.Character(name="Sabetha")
+        db.add_or_update(char)
+        char.add_class(classes["fighter"], level=2)
+        db.add_or_update(char)
+        uri, character_id = char.uri, char.id
+    deleted_at = time.time()
+
+    response = Request.blank(f"/c/{uri}", POST={"delete": "Delete"}).get_response(application())
+    assert response.status_code == 302
+
+    # the character and the rows cascading from it are deleted through the session, and logged
+    with db.transaction():
+        assert db.Character.count() == 0
+        assert db.CharacterClassMap.count() == db.CharacterClassAttributeMap.count() == 0
+        entries = db.session.scalars(
+            select(schema.TransactionLog)
+            .where(schema.TransactionLog.timestamp >= deleted_at)
+            .order_by(schema.TransactionLog.id)
+        ).all()
+        assert sorted(entry.source_table_name for entry in entries) == [
+            "character",
+            "character_class_attribute_map",
+            "class_map",
+        ]
+        assert set(entry.operation for entry in entries) == {transaction_log.DELETE}
+        assert set(entry.character_id for entry in entries) == {character_id}
+        rows = transaction_log.snapshot_at(character_id, deleted_at)
+        assert rows["character"][character_id]["name"] == "Sabetha"
+
+        # and undoing the deletes, newest first, restores the character as it was
+        for entry in reversed(entries):
+            transaction_log.undo(entry)
+    with db.transaction():
+        char = db.Character.filter_by(id=character_id).one()
+        assert char.uri == uri
+        assert char.levels == {"fighter": 2}
+        assert list(char.class_attributes) == ["Fighting Style"]
+
+
+@pytest.fixture
+def production_server(tmp_path):
+    """
+    A function starting ttfrog serve --production with some workers, returning the process and its URL
+    once it accepts requests. The servers started are stopped afterwards.
+    """
+    servers = []
+
+    def start(workers):
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        # a database of its own, rather than the in-memory one the db fixture configures
+        env = dict(os.environ, DATA_PATH=str(tmp_path), DEBUG="")
+        env.pop("DATABASE_URL", None)
+        process = subprocess.Popen(
+            [sys.executable, "-m", "ttfrog.cli", "serve", "127.0.0.1", str(port), "--production"]
+            + ["--workers", str(workers)],
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        servers.append(process)
+        url = f"http://127.0.0.1:{port}"
+        for _ in range(100):
+            try:
+                urllib.request.urlopen(f"{url}/c", timeout=5)
+                return process, url
+            except OSError:
+                assert process.poll() is None, "the server exited"
+                time.sleep(0.1)
+        raise AssertionError("the server never accepted a request")
+
+    yield start
+    for process in servers:
+        process.terminate()
+        process.wait(timeout=10)
+
+
+def worker_pids(process):
+    return set(int(pid) for pid in Path(f"/proc/{process.pid}/task/{process.pid}/children").read_text().split())
+
+
+def test_production_server(production_server):
+    process, url = production_server(workers=1)
+    response = urllib.request.urlopen(f"{url}/c", timeout=5)
+    assert response.status == 200
+    assert "Sabetha" in response.read().decode()
+
+    # stopping the server lets it exit cleanly
+    process.terminate()
+    assert process.wait(timeout=10) == 0
+
+
+@pytest.mark.skipif(not Path("/proc/self/task").exists(), reason="finds the workers in /proc")
+def test_production_workers_replaced(production_server):
+    process, url = production_server(workers=2)
+    workers = worker_pids(process)
+    assert len(workers) == 2
+
+    # a worker that dies is replaced, and the server keeps serving
+    crashed = workers.pop()
+    os.kill(crashed, signal.SIGKILL)
+    for _ in range(50):
+        replaced = worker_pids(process)
+        if len(replaced) == 2 and crashed not in replaced:
+            break
+        time.sleep(0.1)
+    assert len(replaced) == 2 and workers < replaced and crashed not in replaced
+    for _ in range(4):
+        assert urllib.request.urlopen(f"{url}/c", timeout=5).status == 200
+
+    # stopping the server stops every worker, and none are started in their place
+    process.terminate()
+    assert process.wait(timeout=10) == 0
+    assert not any(Path(f"/proc/{pid}").exists() for pid in replaced)
+
+
+def test_sheet_cache_race(db, ancestries_factory, monkeypatch):
+    from ttfrog.db import cache
+    from ttfrog.webserver.application import application
+    from ttfrog.webserver.controllers.character_sheet import CharacterSheet
+    from ttfrog.webserver.sheet_cache import sheets
+
+    monkeypatch.delenv("DEBUG")
+    sheets.clear()
+    with db.transaction():
+        ancestries_factory()
+        char = schema.Character(name="Sabetha")
+        db.add_or_update(char)
+        uri, slug = char.uri, char.slug
+
+    # another request saves the character just after this one has loaded it
+    load = CharacterSheet.record.fget
+
+    def record(self):
+        loading = self._record is None
+        rec = load(self)
+        if loading:
+            cache.invalidate_row(schema.Character, rec.id)
+        return rec
+
+    monkeypatch.setattr(CharacterSheet, "record", property(record))
+    response = Request.blank(f"/c/{uri}").get_response(application())
+    assert response.status_code == 200
+
+    # so the sheet rendered from what was loaded is out of date, and isn't served from the cache
+    assert sheets.get(slug) is None
+    monkeypatch.undo()
+    assert Request.blank(f"/c/{uri}").get_response(application()).status_code == 200
+    assert sheets.get(slug) is not None
+
+
+def test_sheet_script_elements(db, ancestries_factory):
+    from ttfrog.path import assets
+    from ttfrog.webserver.application import application
+
+    with db.transaction():
+        ancestries_factory()
+        char = schema.Character(name="Sabetha")
+        db.add_or_update(char)
+        uri = char.uri
+    html = Request.blank(f"/c/{uri}").get_response(application()).text
+    assert "js/character_sheet.js" in html
+
+    # every stat the sheet's script reads, and the bonus it writes for it, is on the sheet
+    script = (assets() / "static" / "js" / "character_sheet.js").read_text()
+    stats = re.findall(r"'(\w+)'", re.search(r"const stats = \[(.*?)\]", script).group(1))
+    assert stats == ["strength", "dexterity", "constitution", "intelligence", "wisdom", "charisma"]
+    for stat in stats:
+        assert f'id="{stat}"' in html
+        assert f"id='{stat}_bonus'" in html